@@ -0,0 +1,16 @@
+#!/usr/bin/env python
+
+"""This is a one-off script to convert the pickled contexts in email_queue to JSON."""
+
+import sys
+
+from gratipay import wireup
+from gratipay.utils.email_worker import reencode_queue
+
+env = wireup.env()
+db = wireup.db(env)
+
+converted, failed = reencode_queue(db)
+
+print("Converted %i, failed %i." % (converted, failed))
+sys.exit(1 if failed else 0)
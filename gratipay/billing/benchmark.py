@@ -0,0 +1,328 @@
+"""Benchmark payday against a large synthetic dataset.
+
+Run it against a scratch database. The data is loaded with COPY, and reports
+are written as JSON with sorted keys, so that reports from two commits can be
+compared with plain ``diff``.
+
+    $ python -m gratipay.billing.benchmark prepare --participants 100000
+    $ python -m gratipay.billing.benchmark payday --participants 100000 -o payday.json
+
+The ``prepare`` benchmark times the snapshot build in ``sql/payday.sql``
+against the one it replaced, which is kept as a test fixture (see
+:py:data:`LEGACY_PAYDAY`). It also checks that both produce the same snapshot.
+Nothing is committed: it all happens inside a transaction that is rolled back
+at the end.
+
+The ``payday`` benchmark runs a whole payday, timing each stage, against
+:py:class:`~gratipay.testing.fake_braintree.FakeBraintree`. Payday works in
+transactions of its own, so this one does commit, and it refuses to run unless
+the database is empty.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import argparse
+import datetime
+import json
+import random
+import subprocess
+import sys
+import time
+from cStringIO import StringIO
+from os.path import dirname, join, realpath
+
+from gratipay.billing.executor import Executor
+from gratipay.billing.payday import PAYDAY, Payday
+
+
+#: The snapshot build that used correlated subqueries, as ``sql/payday.sql``
+#: had it before the set-based rewrite.
+LEGACY_PAYDAY = join(realpath(join(dirname(__file__), '..', '..')),
+                     'tests', 'py', 'fixtures', 'payday-legacy.sql')
+
+
+COPY_BATCH_SIZE = 50000
+
+
+def _copy(cursor, table, columns, rows):
+    """Load rows into a table with COPY, in batches of ``COPY_BATCH_SIZE``.
+    """
+    sql = "COPY {} ({}) FROM STDIN".format(table, ', '.join(columns))
+    buf, n = StringIO(), 0
+    for row in rows:
+        buf.write('\t'.join('\\N' if v is None else unicode(v) for v in row).encode('utf8'))
+        buf.write(b'\n')
+        n += 1
+        if n % COPY_BATCH_SIZE == 0:
+            buf.seek(0)
+            cursor.copy_expert(sql, buf)
+            buf = StringIO()
+    buf.seek(0)
+    cursor.copy_expert(sql, buf)
+    return n
+
+
+def populate(cursor, nparticipants, nteams=None, seed=0):
+    """Load synthetic participants, teams, exchange routes and payment instructions.
+
+    Participants get an elsewhere account each, and their balances come with
+    the exchanges that funded them, so that :py:func:`~gratipay.models.check_db`
+    passes.
+
+    :param cursor: the cursor to load through, its transaction isn't committed
+    :param int nparticipants: how many participants to make
+    :param int nteams: how many teams to make, one per hundred participants by default
+    :param int seed: seeds the random number generator, for repeatable datasets
+
+    Return a dict of row counts per table.
+
+    """
+    rand = random.Random(seed)
+    nteams = nteams or max(1, nparticipants // 100)
+    now = datetime.datetime.utcnow()
+    ago = lambda days: (now - datetime.timedelta(days=days)).isoformat() + '+00'
+    first_id = cursor.one("SELECT COALESCE(max(id), 0) + 1 FROM participants")
+    first_team_id = cursor.one("SELECT COALESCE(max(id), 0) + 1 FROM teams")
+    participant_ids = range(first_id, first_id + nparticipants)
+    team_ids = range(first_team_id, first_team_id + nteams)
+    username = lambda i: 'synthetic-{}'.format(i)
+    counts = {}
+
+    balances = {}
+    def participants():
+        for i in participant_ids:
+            balance = rand.choice((0, 0, 0, rand.randint(1, 5000) / 100))
+            if balance:
+                balances[i] = balance
+            suspicious = 'true' if rand.random() < 0.01 else 'false'
+            yield (i, username(i), username(i), ago(rand.randint(8, 1000)), balance, suspicious,
+                   'cus-{}'.format(i))
+    counts['participants'] = _copy(cursor, 'participants',
+        ('id', 'username', 'username_lower', 'claimed_time', 'balance', 'is_suspicious',
+         'braintree_customer_id'),
+        participants())
+
+    # check_db wants every participant to have an elsewhere account, and every
+    # balance to be backed by exchanges.
+    counts['elsewhere'] = _copy(cursor, 'elsewhere',
+        ('platform', 'user_id', 'participant', 'user_name'),
+        (('github', i, username(i), username(i)) for i in participant_ids))
+    counts['exchanges'] = _copy(cursor, 'exchanges',
+        ('timestamp', 'amount', 'fee', 'participant', 'status'),
+        ((ago(1000), balances[i], 0, username(i), 'succeeded') for i in sorted(balances)))
+
+    def teams():
+        for i, owner in zip(team_ids, participant_ids):
+            slug = 'synthetic-team-{}'.format(i)
+            yield (i, slug, slug, slug, '', '', username(owner), 'true', ago(rand.randint(8, 1000)))
+    counts['teams'] = _copy(cursor, 'teams',
+        ('id', 'slug', 'slug_lower', 'name', 'homepage', 'product_or_service', 'owner',
+         'is_approved', 'ctime'),
+        teams())
+
+    def routes():
+        for i in participant_ids[:nteams]:
+            yield (i, 'paypal', 'synthetic-{}@example.com'.format(i), '')
+        for i in participant_ids:
+            if rand.random() < 0.7:
+                error = 'declined' if rand.random() < 0.02 else ''
+                yield (i, 'braintree-cc', 'card-{}'.format(i), error)
+    counts['exchange_routes'] = _copy(cursor, 'exchange_routes',
+        ('participant', 'network', 'address', 'error'), routes())
+
+    def payment_instructions():
+        for i in participant_ids:
+            for team_id in rand.sample(team_ids, min(nteams, rand.randint(1, 3))):
+                ctime = ago(rand.randint(8, 1000))
+                amount = rand.choice((0, rand.randint(50, 2000) / 100))
+                due = rand.choice((0, 0, 0, 0, 0, 0, 0, 0, 0, amount))
+                yield (ctime, ctime, i, team_id, amount, due)
+    counts['payment_instructions'] = _copy(cursor, 'payment_instructions',
+        ('ctime', 'mtime', 'participant_id', 'team_id', 'amount', 'due'),
+        payment_instructions())
+
+    cursor.run("""
+        SELECT setval('participants_id_seq', (SELECT max(id) FROM participants));
+        SELECT setval('teams_id_seq', (SELECT max(id) FROM teams));
+        ANALYZE participants;
+        ANALYZE elsewhere;
+        ANALYZE exchanges;
+        ANALYZE teams;
+        ANALYZE exchange_routes;
+        ANALYZE payment_instructions;
+    """)
+    return counts
+
+
+def fingerprint(cursor):
+    """Return a digest of the payday_* tables, to compare snapshot builds.
+    """
+    return cursor.one("""
+        SELECT md5(
+                   ( SELECT COALESCE(string_agg(concat_ws(':', id, old_balance, has_credit_card,
+                                                          giving_today), ',' ORDER BY id), '')
+                       FROM payday_participants ) ||
+                   ( SELECT COALESCE(string_agg(id::text, ',' ORDER BY id), '')
+                       FROM payday_teams ) ||
+                   ( SELECT COALESCE(string_agg(concat_ws(':', id, amount, due), ','
+                                                ORDER BY id), '')
+                       FROM payday_payment_instructions )
+               )
+    """)
+
+
+def start_payday(cursor):
+    """Open a payday inside our transaction, unless one is open already.
+    """
+    if cursor.one("SELECT id FROM current_payday()") is None:
+        cursor.run("INSERT INTO paydays DEFAULT VALUES")
+
+
+def legacy_payday(path=LEGACY_PAYDAY):
+    """Return the legacy snapshot build stored at ``path``.
+    """
+    with open(path) as f:
+        return f.read().decode('utf8')
+
+
+def bench_prepare(db, nparticipants, repeat=3, seed=0, legacy_path=LEGACY_PAYDAY):
+    """Time the current snapshot build against the legacy one.
+
+    Return a JSON-serializable report with the time of each run, in seconds.
+
+    """
+    report = { 'participants': nparticipants
+             , 'repeat': repeat
+             , 'seed': seed
+             , 'legacy_path': legacy_path
+              }
+    legacy = legacy_payday(legacy_path)
+    with db.get_connection() as connection:  # always rolls back
+        cursor = connection.cursor()
+        start = time.time()
+        report['rows'] = populate(cursor, nparticipants, seed=seed)
+        report['populate_time'] = time.time() - start
+        start_payday(cursor)
+        runs = {'legacy': [], 'current': []}
+        fingerprints = {}
+        for i in range(repeat):
+            for name, sql in (('legacy', legacy), ('current', PAYDAY)):
+                start = time.time()
+                cursor.run(sql)
+                runs[name].append(time.time() - start)
+                fingerprints[name] = fingerprint(cursor)
+    report['runs'] = runs
+    report['best'] = {name: min(times) for name, times in runs.items()}
+    report['speedup'] = report['best']['legacy'] / report['best']['current']
+    report['same_snapshot'] = fingerprints['legacy'] == fingerprints['current']
+    return report
+
+
+def timed(timings, name, func):
+    """Wrap ``func`` so that each call appends its wall time to ``timings``.
+    """
+    def wrapper(*a, **kw):
+        start = time.time()
+        try:
+            return func(*a, **kw)
+        finally:
+            timings.append({'name': name, 'wall_time': time.time() - start})
+    return wrapper
+
+
+def bench_payday(db, nparticipants, seed=0, latency=(0, 0), threads=5, engine='trigger'):
+    """Run a whole payday on synthetic data and time each of its stages.
+
+    Braintree is replaced by a :py:class:`FakeBraintree` with the given
+    ``latency`` range, in seconds. Card holds are made by an :py:class:`Executor`
+    with ``threads`` threads.
+
+    Return a JSON-serializable report.
+
+    """
+    from gratipay.testing.fake_braintree import FakeBraintree
+
+    if db.one("SELECT count(*) FROM participants"):
+        raise Exception("The database isn't empty, please use a scratch database.")
+    report = { 'participants': nparticipants
+             , 'seed': seed
+             , 'latency': list(latency)
+             , 'threads': threads
+             , 'engine': engine
+              }
+    with db.get_cursor() as cursor:
+        start = time.time()
+        report['rows'] = populate(cursor, nparticipants, seed=seed)
+        report['populate_time'] = time.time() - start
+
+    stages = []
+    executor, Payday.executor = Payday.executor, Executor(threads=threads)
+    try:
+        with FakeBraintree(latency=latency, seed=seed) as bt:
+            payday = Payday.start(engine=engine)
+            names = ['payin_' + stage for stage in Payday.PAYIN_STAGES]
+            names += ['update_stats', 'end', 'notify_participants']
+            for name in names:
+                setattr(payday, name, timed(stages, name, getattr(payday, name)))
+            start = time.time()
+            payday.run()
+            report['total'] = time.time() - start
+    finally:
+        Payday.executor = executor
+
+    report['stages'] = stages
+    report['braintree_calls'] = dict(bt.calls)
+    report['payday'] = db.one("""
+        SELECT nusers, nteams, volume::text
+          FROM paydays
+         WHERE id = %s
+    """, (payday.id,), back_as=dict)
+    return report
+
+
+def git_commit():
+    """Return the commit we're benchmarking, or None if we can't tell.
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark payday on synthetic data.')
+    parser.add_argument('-o', '--output', metavar='PATH', default='-',
+                        help='where to write the JSON report (default: stdout)')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    prepare = subparsers.add_parser('prepare', help='compare snapshot builds')
+    prepare.add_argument('--participants', type=int, default=100000)
+    prepare.add_argument('--repeat', type=int, default=3)
+    prepare.add_argument('--seed', type=int, default=0)
+    prepare.add_argument('--legacy', metavar='PATH', default=LEGACY_PAYDAY,
+                         help='the legacy snapshot build to compare against')
+    payday = subparsers.add_parser('payday', help='time a whole payday (commits!)')
+    payday.add_argument('--participants', type=int, default=100000)
+    payday.add_argument('--seed', type=int, default=0)
+    payday.add_argument('--latency', type=float, nargs=2, default=(0, 0), metavar=('MIN', 'MAX'),
+                        help='how long the fake Braintree takes to respond, in seconds')
+    payday.add_argument('--threads', type=int, default=5)
+    payday.add_argument('--engine', choices=Payday.ENGINES, default='trigger')
+    args = parser.parse_args()
+
+    from gratipay import wireup
+    env = wireup.env()
+    db = wireup.db(env)
+
+    if args.benchmark == 'payday':
+        report = bench_payday(db, args.participants, args.seed, tuple(args.latency),
+                              args.threads, args.engine)
+    else:
+        report = bench_prepare(db, args.participants, args.repeat, args.seed, args.legacy)
+    report['commit'] = git_commit()
+    out = sys.stdout if args.output == '-' else open(args.output, 'w')
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,7 @@ import braintree
 
 from aspen import log
 from aspen.utils import typecheck
+from gratipay.billing.executor import throttle
 from gratipay.exceptions import NegativeBalance, NotWhitelisted
 from gratipay.models.exchange_route import ExchangeRoute
 
@@ -75,7 +76,7 @@ def create_card_hold(db, participant, amount):
     hold = None
     error = ""
     try:
-        result = braintree.Transaction.sale({
+        result = throttle('sale', braintree.Transaction.sale, {
             'amount': str(cents/100.0),
             'customer_id': route.participant.braintree_customer_id,
             'payment_method_token': route.address,
@@ -96,6 +97,7 @@ def create_card_hold(db, participant, amount):
 
     if error == '':
         log(msg + "succeeded.")
+        journal_card_hold(db, 'hold', participant.id, hold)
     else:
         log(msg + "failed: %s" % error)
         record_exchange(db, route, amount, fee, participant, 'failed', error)
@@ -125,7 +127,9 @@ def capture_card_hold(db, participant, amount, hold):
 
     error = ''
     try:
-        result = braintree.Transaction.submit_for_settlement(hold.id, str(cents/100.00))
+        result = throttle( 'submit_for_settlement', braintree.Transaction.submit_for_settlement
+                         , hold.id, str(cents/100.00)
+                          )
         assert result.is_success
         if result.transaction.status != 'submitted_for_settlement':
             error = result.transaction.status
@@ -134,23 +138,76 @@ def capture_card_hold(db, participant, amount, hold):
 
     if error == '':
         record_exchange_result(db, e_id, 'succeeded', None, participant)
+        journal_card_hold(db, 'capture', participant.id, hold)
         log("Captured " + amount_str + " on Braintree for " + username)
     else:
         record_exchange_result(db, e_id, 'failed', error, participant)
         raise Exception(error)
 
 
-def cancel_card_hold(hold):
+def cancel_card_hold(hold, db=None):
     """Cancel the previously created hold on the participant's credit card.
+
+    Pass ``db`` to note the cancellation in the card hold journal.
+
     """
-    result = braintree.Transaction.void(hold.id)
+    result = throttle('void', braintree.Transaction.void, hold.id)
     assert result.is_success
 
     amount = hold.amount
     participant_id = hold.custom_fields['participant_id']
+    if db is not None:
+        journal_card_hold(db, 'cancel', int(participant_id), hold)
     log("Canceled a ${:.2f} hold for {}.".format(amount, participant_id))
 
 
+def journal_card_hold(db, action, participant_id, hold):
+    """Note a card hold we've created, reused, captured or canceled.
+
+    Entries are written right away (outside of payday's transaction) and are
+    tied to the payday that's running, if any. A payday that crashes uses them
+    to pick up its holds again: they tell it which of the holds it finds at
+    Braintree to keep.
+
+    """
+    db.run("""
+        INSERT INTO card_hold_journal
+                    (payday, participant_id, action, transaction_id, amount, token)
+             VALUES (current_payday_id(), %s, %s, %s, %s, %s)
+    """, (participant_id, action, hold.id, hold.amount, hold.credit_card['token']))
+
+
+def get_open_card_holds(db, payday_id):
+    """Return the holds journaled during a payday that are still open.
+
+    The return value is None if nothing was journaled for that payday, and
+    otherwise a dict of participant ids to ``braintree.Transaction`` objects,
+    rebuilt from the journal without asking Braintree.
+
+    """
+    entries = db.all("""
+        SELECT DISTINCT ON (transaction_id) *
+          FROM card_hold_journal
+         WHERE payday = %s
+      ORDER BY transaction_id, id DESC
+    """, (payday_id,))
+    if not entries:
+        return None
+    holds = {}
+    for e in entries:
+        if e.action not in ('hold', 'reuse'):
+            continue
+        holds[e.participant_id] = braintree.Transaction(None, {
+            'id': e.transaction_id,
+            'amount': e.amount,
+            'tax_amount': None,
+            'status': 'authorized',
+            'custom_fields': {'participant_id': unicode(e.participant_id)},
+            'credit_card': {'token': e.token},
+        })
+    return holds
+
+
 def _prep_hit(unrounded):
     """Takes an amount in dollars. Returns cents, etc.
 
@@ -296,4 +353,4 @@ def propagate_exchange(cursor, participant, route, error, amount):
         raise NegativeBalance
 
     if hasattr(participant, 'set_attributes'):
-        participant.set_attributes(balance=new_balance)
+        participant.set_attributes(balance=new_balance, cursor=cursor)
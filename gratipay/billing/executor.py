@@ -0,0 +1,164 @@
+"""Concurrency and rate limiting for outbound calls to our payment processor.
+
+Payday talks to Braintree once per card hold, capture and cancellation. The
+:py:class:`Executor` fans those calls out over a thread pool, and every call to
+the Braintree API goes through :py:data:`throttle`, which retries calls that
+were throttled, slowing down all threads together while Braintree is pushing
+back, and speeding up again as calls start to succeed. Both keep latency
+histograms so that we can see how the processor behaved during a payday.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+import traceback
+from collections import defaultdict
+from multiprocessing.dummy import Pool as ThreadPool
+
+from aspen import log
+from braintree.exceptions import DownForMaintenanceError, UnexpectedError
+
+from gratipay.utils.histogram import Histogram
+
+
+def is_throttling_error(e):
+    """Return True if the exception means that Braintree wants us to slow down.
+
+    The Braintree library raises DownForMaintenanceError for 503 responses, and
+    an UnexpectedError mentioning the status code for 429 responses.
+
+    """
+    if isinstance(e, DownForMaintenanceError):
+        return True
+    return isinstance(e, UnexpectedError) and '429' in unicode(e)
+
+
+def is_safe_to_retry(name, e):
+    """Return True if a call that failed with throttling error ``e`` can be made again.
+
+    A 429 means that Braintree turned the call away, but after a 503 we can't
+    tell whether it went through, so only calls in :py:attr:`Throttle.IDEMPOTENT`
+    are retried: making a sale twice would authorize the card twice.
+
+    """
+    return name in Throttle.IDEMPOTENT or not isinstance(e, DownForMaintenanceError)
+
+
+class Throttle(object):
+    """Call functions, backing off adaptively when they're throttled.
+
+    The delay between calls is shared by all threads: each throttling error
+    doubles it (starting from ``backoff`` seconds, up to ``max_backoff``), and
+    each success halves it. A throttled call is retried up to ``retries``
+    times before the error is raised to the caller, if that's safe (see
+    :py:func:`is_safe_to_retry`).
+
+    """
+
+    #: The names of calls that have the same effect when they're made twice.
+    IDEMPOTENT = ('void',)
+
+    def __init__(self, retries=5, backoff=0.5, max_backoff=30.0, sleep=time.sleep):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.delay = 0.0
+        self.nthrottled = 0
+        self.histograms = defaultdict(Histogram)
+        self.lock = threading.Lock()
+
+    def __call__(self, name, func, *a, **kw):
+        for attempt in range(self.retries + 1):
+            with self.lock:
+                delay = self.delay
+            if delay:
+                self.sleep(delay)
+            start = time.time()
+            try:
+                r = func(*a, **kw)
+            except Exception as e:
+                if not is_throttling_error(e) or attempt == self.retries:
+                    raise
+                with self.lock:
+                    self.nthrottled += 1
+                    self.delay = delay = min(max(self.delay * 2, self.backoff), self.max_backoff)
+                if not is_safe_to_retry(name, e):
+                    raise
+                log("Braintree throttled a call to %s, backing off %.1fs." % (name, delay))
+                continue
+            finally:
+                ms = (time.time() - start) * 1000
+                with self.lock:
+                    self.histograms[name].add(ms)
+            with self.lock:
+                self.delay = self.delay / 2 if self.delay > self.backoff / 8 else 0.0
+            return r
+
+    def reset(self):
+        """Forget the current delay and the latencies recorded so far.
+        """
+        with self.lock:
+            self.delay = 0.0
+            self.nthrottled = 0
+            self.histograms = defaultdict(Histogram)
+
+    def log_histograms(self):
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            nthrottled = self.nthrottled
+        for name, histogram in histograms:
+            log("Braintree %s latency: %s" % (name, histogram))
+        if nthrottled:
+            log("Braintree throttled %i calls." % nthrottled)
+
+
+#: The :py:class:`Throttle` that all calls to the Braintree API go through.
+throttle = Throttle()
+
+
+class Executor(object):
+    """Run a function over many inputs on a pool of threads.
+
+    Unlike a plain ``Pool.map``, an exception doesn't abort the other calls: we
+    run everything, log every traceback, and then raise the first exception.
+
+    Our functions hit the database too, so ``threads`` should stay below
+    ``DATABASE_MAXCONN``. That holds even when ``map`` is called from several
+    threads at once: all calls share ``threads`` slots.
+
+    """
+
+    def __init__(self, threads=5):
+        self.threads = threads
+        self.slots = threading.BoundedSemaphore(threads)
+        self.histograms = defaultdict(Histogram)
+        self.lock = threading.Lock()
+
+    def map(self, name, func, iterable):
+        with self.lock:
+            histogram = self.histograms[name]
+        def g(item):
+            with self.slots:
+                start = time.time()
+                try:
+                    return True, func(item)
+                except Exception as e:
+                    return False, (e, traceback.format_exc())
+                finally:
+                    histogram.add((time.time() - start) * 1000)
+        pool = ThreadPool(self.threads)
+        try:
+            results = pool.map(g, iterable)
+        finally:
+            pool.close()
+            pool.join()
+        errors = [r for ok, r in results if not ok]
+        for e, tb in errors:
+            log(tb)
+        if errors:
+            log("%s: %i of %i calls failed." % (name, len(errors), len(results)))
+            raise errors[0][0]
+        log("%s: %s" % (name, histogram))
+        return [r for ok, r in results]
@@ -12,17 +12,19 @@ immediately affect the participant's balance.
 from __future__ import unicode_literals
 
 import itertools
-from multiprocessing.dummy import Pool as ThreadPool
 
 import braintree
 
 import aspen.utils
 from aspen import log
 from gratipay.billing.exchanges import (
-    cancel_card_hold, capture_card_hold, create_card_hold, upcharge, MINIMUM_CHARGE,
+    cancel_card_hold, capture_card_hold, create_card_hold, get_open_card_holds,
+    journal_card_hold, upcharge, MINIMUM_CHARGE,
 )
+from gratipay.billing.executor import Executor, throttle
 from gratipay.exceptions import NegativeBalance
 from gratipay.models import check_db
+from gratipay.models.participant import Participant
 from psycopg2 import IntegrityError
 
 
@@ -30,32 +32,15 @@ with open('sql/payday.sql') as f:
     PAYDAY = f.read()
 
 
-class ExceptionWrapped(Exception): pass
-
-
-def threaded_map(func, iterable, threads=5):
-    pool = ThreadPool(threads)
-    def g(*a, **kw):
-        # Without this wrapper we get a traceback from inside multiprocessing.
-        try:
-            return func(*a, **kw)
-        except Exception as e:
-            import traceback
-            raise ExceptionWrapped(e, traceback.format_exc())
-    try:
-        r = pool.map(g, iterable)
-    except ExceptionWrapped as e:
-        print(e.args[1])
-        raise e.args[0]
-    pool.close()
-    pool.join()
-    return r
-
-
 class NoPayday(Exception):
     __str__ = lambda self: "No payday found where one was expected."
 
 
+class SnapshotLost(Exception):
+    __str__ = lambda self: "The payday_* tables were lost after payment instructions were " \
+                           "processed. Payin can't be resumed safely."
+
+
 class Payday(object):
     """Represent an abstract event during which money is moved.
 
@@ -68,22 +53,58 @@ class Payday(object):
 
         run
             payin
-                prepare
-                create_card_holds
-                process_payment_instructions
-                transfer_takes
-                process_draws
-                settle_card_holds
-                update_balances
-                take_over_balances
+                prepare                         # sub-stage: prepare
+                create_card_holds               #            holds
+                process_payment_instructions    #            instructions
+                transfer_takes                  #            draws
+                process_draws                   #            draws
+                settle_card_holds               #            settle
+                update_balances                 #            balances
+                record_stats                    #            balances
+                take_over_balances              #            takeover
             update_stats
             end
 
     """
 
 
+    #: The ways we know of to fund payment instructions: ``trigger`` fires the
+    #: ``process_payment_instruction`` trigger from ``sql/payday.sql`` once per
+    #: row, ``bulk`` computes the same outcome with set-based statements.
+    ENGINES = ('trigger', 'bulk')
+
+    engine = 'trigger'
+
+    #: The sub-stages of payin, in order. Progress through them is recorded in
+    #: the ``payin_stage`` column of the paydays row.
+    PAYIN_STAGES = ( 'prepare'
+                   , 'holds'
+                   , 'instructions'
+                   , 'draws'
+                   , 'settle'
+                   , 'balances'
+                   , 'takeover'
+                    )
+
+    payin_stage = 0
+
+    #: The card holds we're working with, once we have them.
+    holds = None
+
+    #: Whether ``update_stats`` should check the stats recorded during payin
+    #: against a full scan of ``payments`` and ``events``.
+    verify_stats = False
+
+    #: The :py:class:`~gratipay.billing.executor.Executor` we use to make calls
+    #: to Braintree for card holds.
+    executor = Executor()
+
+    #: How many existing holds we reconcile at a time.
+    HOLDS_PAGE_SIZE = 50
+
+
     @classmethod
-    def start(cls):
+    def start(cls, engine='trigger'):
         """Try to start a new Payday.
 
         If there is a Payday that hasn't finished yet, then the UNIQUE
@@ -91,16 +112,21 @@ class Payday(object):
         we load the existing Payday and work on it some more. We use the start
         time of the current Payday to synchronize our work.
 
+        The ``engine`` argument selects how payment instructions are funded
+        during this run; see ``ENGINES``.
+
         """
+        if engine not in cls.ENGINES:
+            raise ValueError("unknown payday engine: {}".format(engine))
         try:
             d = cls.db.one("""
                 INSERT INTO paydays DEFAULT VALUES
-                RETURNING id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage
+                RETURNING id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage, payin_stage
             """, back_as=dict)
             log("Starting a new payday.")
         except IntegrityError:  # Collision, we have a Payday already.
             d = cls.db.one("""
-                SELECT id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage
+                SELECT id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage, payin_stage
                   FROM paydays
                  WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
             """, back_as=dict)
@@ -112,6 +138,7 @@ class Payday(object):
 
         payday = Payday()
         payday.__dict__.update(d)
+        payday.engine = engine
         return payday
 
 
@@ -147,28 +174,94 @@ class Payday(object):
     def payin(self):
         """The first stage of payday where we charge credit cards and transfer
         money internally between participants.
+
+        Payin is broken down into the sub-stages in ``PAYIN_STAGES``. Each one
+        runs in its own transaction, which also records it as done in the
+        ``payin_stage`` column of the paydays row, and the ``payday_*`` tables
+        are regular tables, so if payin crashes we pick up after the last
+        sub-stage that finished.
+
         """
-        with self.db.get_cursor() as cursor:
-            self.prepare(cursor)
-            holds = self.create_card_holds(cursor)
-            self.process_payment_instructions(cursor)
-            self.transfer_takes(cursor, self.ts_start)
-            self.process_draws(cursor)
-            payments = cursor.all("""
-                SELECT * FROM payments WHERE "timestamp" > %s
-            """, (self.ts_start,))
+        self.check_snapshot()
+        for i, stage in enumerate(self.PAYIN_STAGES, 1):
+            if self.payin_stage >= i:
+                log("Skipping %s, it's done already." % stage)
+                continue
             try:
-                self.settle_card_holds(cursor, holds)
-                self.update_balances(cursor)
-                check_db(cursor)
+                with self.db.get_cursor() as cursor:
+                    getattr(self, 'payin_' + stage)(cursor)
+                    cursor.run("""
+                        UPDATE paydays
+                           SET payin_stage = %s
+                         WHERE id = %s
+                    """, (i, self.id))
             except:
-                # Dump payments for debugging
-                import csv
-                from time import time
-                with open('%s_payments.csv' % time(), 'wb') as f:
-                    csv.writer(f).writerows(payments)
+                if stage in ('settle', 'balances'):
+                    self.dump_payments()
                 raise
-        self.take_over_balances()
+            self.payin_stage = i
+        throttle.log_histograms()
+
+    def check_snapshot(self):
+        """Make sure that the ``payday_*`` tables we'd resume from are intact.
+
+        They're unlogged tables, so Postgres empties them when it recovers from
+        a crash. Until payment instructions are processed we can just start
+        over, after that we raise :py:exc:`SnapshotLost`.
+
+        """
+        if not 0 < self.payin_stage < self.PAYIN_STAGES.index('balances') + 1:
+            return  # the snapshot isn't needed
+        intact = self.db.one("""
+            SELECT EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'payday_snapshot')
+        """) and self.db.one("""
+            SELECT count(*) FROM payday_snapshot WHERE payday = %s
+        """, (self.id,)) > 0
+        if intact:
+            return
+        if self.payin_stage > self.PAYIN_STAGES.index('holds') + 1:
+            raise SnapshotLost
+        log("The payday_* tables were lost, starting payin over.")
+        self.db.run("UPDATE paydays SET payin_stage = 0 WHERE id = %s", (self.id,))
+        self.payin_stage = 0
+
+    def payin_prepare(self, cursor):
+        self.prepare(cursor)
+
+    def payin_holds(self, cursor):
+        self.holds = self.create_card_holds(cursor)
+
+    def payin_instructions(self, cursor):
+        self.process_payment_instructions(cursor)
+
+    def payin_draws(self, cursor):
+        self.transfer_takes(cursor, self.ts_start)
+        self.process_draws(cursor)
+
+    def payin_settle(self, cursor):
+        if self.holds is None:
+            # We're picking up where a crashed payday left off.
+            self.holds = get_open_card_holds(self.db, self.id) or {}
+        self.settle_card_holds(cursor, self.holds)
+
+    def payin_balances(self, cursor):
+        self.update_balances(cursor)
+        self.record_stats(cursor)
+        check_db(cursor)
+
+    def payin_takeover(self, cursor):
+        self.take_over_balances(cursor)
+
+    def dump_payments(self):
+        """Dump this payday's payments to a CSV file, for debugging.
+        """
+        import csv
+        from time import time
+        payments = self.db.all("""
+            SELECT * FROM payments WHERE "timestamp" > %s
+        """, (self.ts_start,))
+        with open('%s_payments.csv' % time(), 'wb') as f:
+            csv.writer(f).writerows(payments)
 
 
     @staticmethod
@@ -179,24 +272,75 @@ class Payday(object):
         log('Prepared the DB.')
 
 
-    @staticmethod
-    def fetch_card_holds(participant_ids):
+    @classmethod
+    def fetch_card_holds(cls, participant_ids, journaled=None):
+        """Reconcile the holds that exist at Braintree with the ones we need.
+
+        Search results are streamed a page at a time: each page is recorded in
+        the ``braintree_holds`` table, the first hold found for each participant
+        in ``participant_ids`` is kept for reuse, and all others are canceled in
+        parallel before we move on to the next page. Return a dict of the reused
+        holds, keyed by participant id.
+
+        ``journaled`` is a dict of the holds a crashed payday noted in the
+        journal (see :py:func:`~gratipay.billing.exchanges.get_open_card_holds`).
+        For those participants we keep that hold and cancel any others.
+
+        """
         log('Fetching card holds.')
+        journaled = journaled or {}
         holds = {}
-        existing_holds = braintree.Transaction.search(
+        existing_holds = iter(braintree.Transaction.search(
             braintree.TransactionSearch.status == 'authorized'
-        )
-        for hold in existing_holds.items:
-            log_amount = hold.amount
-            p_id = int(hold.custom_fields['participant_id'])
-            if p_id in participant_ids:
-                log('Reusing a ${:.2f} hold for {}.'.format(log_amount, p_id))
-                holds[p_id] = hold
-            else:
-                cancel_card_hold(hold)
+        ).items)
+        npages = nstale = 0
+        while True:
+            page = list(itertools.islice(existing_holds, cls.HOLDS_PAGE_SIZE))
+            if not page:
+                break
+            npages += 1
+            stale = []
+            for hold in page:
+                p_id = int(hold.custom_fields['participant_id'])
+                known = journaled.get(p_id)
+                if p_id in participant_ids and p_id not in holds and \
+                   (known is None or known.id == hold.id):
+                    log('Reusing a ${:.2f} hold for {}.'.format(hold.amount, p_id))
+                    journal_card_hold(cls.db, 'reuse', p_id, hold)
+                    holds[p_id] = hold
+                else:
+                    stale.append(hold)
+            cls.record_braintree_holds(page, holds)
+            if stale:
+                cls.executor.map('cancel_stale_card_holds', cls.cancel_stale_card_hold, stale)
+                nstale += len(stale)
+        log('Reconciled %i pages of card holds: reused %i, canceled %i.'
+            % (npages, len(holds), nstale))
         return holds
 
 
+    @classmethod
+    def record_braintree_holds(cls, page, reused):
+        cls.db.run("""
+            INSERT INTO braintree_holds
+                        (payday, transaction_id, participant_id, amount, reused)
+                 SELECT current_payday_id()
+                      , unnest(%s::text[])
+                      , unnest(%s::bigint[])
+                      , unnest(%s::numeric[])
+                      , unnest(%s::boolean[])
+        """, ( [h.id for h in page]
+             , [int(h.custom_fields['participant_id']) for h in page]
+             , [h.amount for h in page]
+             , [reused.get(int(h.custom_fields['participant_id'])) is h for h in page]
+              ))
+
+
+    @classmethod
+    def cancel_stale_card_hold(cls, hold):
+        cancel_card_hold(hold, cls.db)
+
+
     def create_card_holds(self, cursor):
 
         # Get the list of participants to create card holds for
@@ -210,9 +354,16 @@ class Payday(object):
         if not participants:
             return {}
 
-        # Fetch existing holds
+        # Fetch existing holds from Braintree. If we're picking up a crashed
+        # payday, our journal says which ones it made, but it can't know about
+        # a hold that was made right before the crash. We don't create any hold
+        # before we've seen all of the existing ones, or we could authorize a
+        # card twice.
         participant_ids = set(p.id for p in participants)
-        holds = self.fetch_card_holds(participant_ids)
+        journaled = get_open_card_holds(self.db, self.id)
+        if journaled:
+            log('Picked up %i card holds from the journal.' % len(journaled))
+        holds = self.fetch_card_holds(participant_ids, journaled)
 
         # Create new holds and check amounts of existing ones
         def f(p):
@@ -225,10 +376,10 @@ class Payday(object):
                         return
                     else:
                         # The amount is too low, cancel the hold and make a new one
-                        cancel_card_hold(holds.pop(p.id))
+                        self.cancel_card_hold(holds.pop(p.id))
                 else:
                     # not up to minimum charge level. cancel the hold
-                    cancel_card_hold(holds.pop(p.id))
+                    self.cancel_card_hold(holds.pop(p.id))
                     return
             if amount >= MINIMUM_CHARGE:
                 hold, error = create_card_hold(self.db, p, amount)
@@ -236,7 +387,7 @@ class Payday(object):
                     return 1
                 else:
                     holds[p.id] = hold
-        threaded_map(f, participants)
+        self.executor.map('create_card_holds', f, participants)
 
         # Update the values of card_hold_ok in our temporary table
         if not holds:
@@ -250,15 +401,161 @@ class Payday(object):
         return holds
 
 
+    def process_payment_instructions(self, cursor):
+        """Fund payment instructions using the engine selected for this payday.
+        """
+        log("Processing payment instructions.")
+        if self.engine == 'bulk':
+            self.process_payment_instructions_in_bulk(cursor)
+        else:
+            self.process_payment_instructions_with_trigger(cursor)
+
+
     @staticmethod
-    def process_payment_instructions(cursor):
+    def process_payment_instructions_with_trigger(cursor):
         """Trigger the process_payment_instructions function for each row in
         payday_payment_instructions.
         """
-        log("Processing payment instructions.")
         cursor.run("UPDATE payday_payment_instructions SET is_funded=true;")
 
 
+    @staticmethod
+    def process_payment_instructions_in_bulk(cursor):
+        """Fund payment instructions with a handful of set-based statements.
+
+        This gives the same results as the process_payment_instruction trigger,
+        without calling pay and park once per row. Each participant's
+        instructions are funded in order (claimed_time, ctime) out of their
+        balance, skipping any that don't fit, unless they have a card hold, in
+        which case everything is funded. Window functions settle the common
+        cases (card hold, enough balance for everything, no balance at all), and
+        a recursive query walks the rest one rank at a time.
+
+        """
+        cursor.run("""
+
+            DROP TABLE IF EXISTS payday_waterfall;
+            CREATE TEMPORARY TABLE payday_waterfall AS
+                SELECT ppi.id
+                     , ppi.participant_id
+                     , ppi.team_id
+                     , (ppi.amount + ppi.due) AS amount
+                     , p.claimed_time
+                     , pi.ctime
+                     , p.new_balance AS balance
+                     , p.card_hold_ok
+                     , p.has_credit_card
+                     , row_number() OVER w AS rank
+                     , sum(ppi.amount + ppi.due) OVER (PARTITION BY ppi.participant_id) AS total
+                     , NULL::boolean AS is_paid
+                  FROM payday_payment_instructions ppi
+                  JOIN payment_instructions pi ON pi.id = ppi.id
+                  JOIN payday_participants p ON p.id = ppi.participant_id
+                 WHERE ppi.is_funded IS NOT true
+                WINDOW w AS (PARTITION BY ppi.participant_id ORDER BY pi.ctime, ppi.id);
+
+            CREATE UNIQUE INDEX ON payday_waterfall (participant_id, rank);
+
+            UPDATE payday_waterfall
+               SET is_paid = true
+             WHERE card_hold_ok OR total <= balance;
+
+            UPDATE payday_waterfall
+               SET is_paid = false
+             WHERE is_paid IS NULL
+               AND balance <= 0;
+
+            WITH RECURSIVE waterfall AS (
+                SELECT id, participant_id, rank
+                     , (amount <= balance) AS is_paid
+                     , CASE WHEN amount <= balance THEN balance - amount ELSE balance END AS balance
+                  FROM payday_waterfall
+                 WHERE is_paid IS NULL
+                   AND rank = 1
+             UNION ALL
+                SELECT w.id, w.participant_id, w.rank
+                     , (w.amount <= prev.balance)
+                     , CASE WHEN w.amount <= prev.balance
+                            THEN prev.balance - w.amount
+                            ELSE prev.balance
+                        END
+                  FROM waterfall prev
+                  JOIN payday_waterfall w ON w.participant_id = prev.participant_id
+                                         AND w.rank = prev.rank + 1
+            )
+            UPDATE payday_waterfall w
+               SET is_paid = waterfall.is_paid
+              FROM waterfall
+             WHERE w.id = waterfall.id;
+
+        """)
+        cursor.run("""
+
+            UPDATE payday_participants p
+               SET new_balance = (p.new_balance - w.amount)
+              FROM ( SELECT participant_id, sum(amount) AS amount
+                       FROM payday_waterfall
+                      WHERE is_paid
+                   GROUP BY participant_id
+                   ) w
+             WHERE p.id = w.participant_id;
+
+            UPDATE payday_teams t
+               SET balance = (t.balance + w.amount)
+              FROM ( SELECT team_id, sum(amount) AS amount
+                       FROM payday_waterfall
+                      WHERE is_paid
+                   GROUP BY team_id
+                   ) w
+             WHERE t.id = w.team_id;
+
+            -- Zero out dues for what we paid, record dues for what we parked.
+
+            UPDATE payment_instructions pi
+               SET due = CASE WHEN w.is_paid THEN 0 ELSE w.amount END
+              FROM payday_waterfall w
+              JOIN ( SELECT DISTINCT ON (participant_id, team_id) id, participant_id, team_id
+                       FROM payment_instructions
+                      WHERE participant_id IN (SELECT participant_id FROM payday_waterfall)
+                   ORDER BY participant_id, team_id, mtime DESC
+                   ) c ON c.participant_id = w.participant_id AND c.team_id = w.team_id
+             WHERE pi.id = c.id
+               AND ( (w.is_paid AND pi.due > 0) OR (NOT w.is_paid AND w.has_credit_card) );
+
+            INSERT INTO events (type, payload)
+                SELECT 'payday'
+                     , ( CASE WHEN is_paid
+                              THEN '{"action":"pay","participant_id":"' || participant_id
+                                || '", "team_id":"' || team_id || '", "amount":' || amount || '}'
+                              ELSE '{"action":"due","participant_id":"' || participant_id
+                                || '", "team_id":"' || team_id || '", "due":' || amount || '}'
+                          END
+                       )::json
+                  FROM payday_waterfall
+                 WHERE is_paid OR has_credit_card
+              ORDER BY claimed_time, ctime, id;
+
+            INSERT INTO payday_payments (participant, team, amount, direction)
+                SELECT p.username, t.slug, w.amount, 'to-team'
+                  FROM payday_waterfall w
+                  JOIN participants p ON p.id = w.participant_id
+                  JOIN teams t ON t.id = w.team_id
+                 WHERE w.is_paid
+              ORDER BY w.claimed_time, w.ctime, w.id;
+
+            -- Mark rows as funded, like the trigger does, without firing it.
+
+            ALTER TABLE payday_payment_instructions DISABLE TRIGGER process_payment_instruction;
+            UPDATE payday_payment_instructions ppi
+               SET is_funded = true
+              FROM payday_waterfall w
+             WHERE ppi.id = w.id
+               AND w.is_paid;
+            ALTER TABLE payday_payment_instructions ENABLE TRIGGER process_payment_instruction;
+
+        """)
+
+
     @staticmethod
     def transfer_takes(cursor, ts_start):
         return  # XXX Bring me back!
@@ -308,15 +605,19 @@ class Payday(object):
         def capture(p):
             amount = -p.new_balance
             capture_card_hold(self.db, p, amount, holds.pop(p.id))
-        threaded_map(capture, participants)
+        self.executor.map('capture_card_holds', capture, participants)
         log("Captured %i card holds." % len(participants))
 
         log("Canceling card holds.")
         # Cancel the remaining holds
-        threaded_map(cancel_card_hold, holds.values())
+        self.executor.map('cancel_card_holds', self.cancel_card_hold, holds.values())
         log("Canceled %i card holds." % len(holds))
 
 
+    def cancel_card_hold(self, hold):
+        cancel_card_hold(hold, self.db)
+
+
     @staticmethod
     def update_balances(cursor):
         log("Updating balances.")
@@ -350,110 +651,229 @@ class Payday(object):
         log("Updated the balances of %i participants." % len(participants))
 
 
-    def take_over_balances(self):
+    def take_over_balances(self, cursor=None):
         """If an account that receives money is taken over during payin we need
         to transfer the balance to the absorbing account.
         """
         log("Taking over balances.")
-        for i in itertools.count():
-            if i > 10:
-                raise Exception('possible infinite loop')
-            count = self.db.one("""
-
-                DROP TABLE IF EXISTS temp;
-                CREATE TEMPORARY TABLE temp AS
-                    SELECT archived_as, absorbed_by, balance AS archived_balance
-                      FROM absorptions a
-                      JOIN participants p ON a.archived_as = p.username
-                     WHERE balance > 0;
-
-                SELECT count(*) FROM temp;
-
-            """)
-            if not count:
-                break
-            self.db.run("""
+        with self.db.get_cursor(cursor) as cursor:
+            self._take_over_balances(cursor)
 
-                INSERT INTO transfers (tipper, tippee, amount, context)
-                    SELECT archived_as, absorbed_by, archived_balance, 'take-over'
-                      FROM temp;
+    @staticmethod
+    def _take_over_balances(cursor):
+        """Move the balances of archived accounts to whoever absorbed them.
 
-                UPDATE participants
-                   SET balance = (balance - archived_balance)
-                  FROM temp
-                 WHERE username = archived_as;
+        An account that absorbed another one can itself be absorbed later, so
+        absorptions form chains. We follow each chain to its end with a
+        recursive query and move every balance straight to the last absorber,
+        in a single statement. A chain that loops back on itself has no end:
+        we refuse to guess and raise an exception, which rolls everything back.
 
-                UPDATE participants
-                   SET balance = (balance + archived_balance)
-                  FROM temp
-                 WHERE username = absorbed_by;
+        """
+        moved, cycles = cursor.one("""
 
-            """)
+            WITH RECURSIVE absorbed AS (
+                    SELECT DISTINCT ON (archived_as) archived_as, absorbed_by
+                      FROM absorptions
+                  ORDER BY archived_as, id DESC
+                 )
+               , chains (archived_as, absorbed_by, path, is_cycle) AS (
+                    SELECT a.archived_as, a.absorbed_by, ARRAY[a.archived_as]
+                         , a.absorbed_by = a.archived_as
+                      FROM absorbed a
+                      JOIN participants p ON p.username = a.archived_as
+                     WHERE p.balance > 0
+                 UNION ALL
+                    SELECT c.archived_as, a.absorbed_by, c.path || a.archived_as
+                         , a.absorbed_by = ANY(c.path || a.archived_as)
+                      FROM chains c
+                      JOIN absorbed a ON a.archived_as = c.absorbed_by
+                     WHERE NOT c.is_cycle
+                 )
+               , resolved AS (
+                    SELECT c.archived_as, c.absorbed_by, p.balance AS archived_balance
+                      FROM chains c
+                      JOIN participants p ON p.username = c.archived_as
+                     WHERE NOT c.is_cycle
+                       AND NOT EXISTS ( SELECT 1
+                                          FROM absorbed a
+                                         WHERE a.archived_as = c.absorbed_by
+                                      )
+                 )
+               , take_overs AS (
+                    INSERT INTO transfers (tipper, tippee, amount, context)
+                         SELECT archived_as, absorbed_by, archived_balance, 'take-over'
+                           FROM resolved
+                 )
+               , debits AS (
+                    UPDATE participants p
+                       SET balance = (p.balance - r.archived_balance)
+                      FROM resolved r
+                     WHERE p.username = r.archived_as
+                 )
+               , credits AS (
+                    UPDATE participants p
+                       SET balance = (p.balance + r.amount)
+                      FROM ( SELECT absorbed_by, sum(archived_balance) AS amount
+                               FROM resolved
+                           GROUP BY absorbed_by
+                           ) r
+                     WHERE p.username = r.absorbed_by
+                 )
+            SELECT ( SELECT count(*) FROM resolved )
+                 , ( SELECT array_agg(DISTINCT archived_as) FROM chains WHERE is_cycle )
+
+        """)
+        if cycles:
+            raise Exception('absorption cycle involving %s' % ', '.join(sorted(cycles)))
+        if moved:
+            log("Took over %i balances." % moved)
+
+
+    def record_stats(self, cursor):
+        """Note who paid, got paid or was left with dues during payin.
+
+        This writes one row per participant and team to ``payday_stats``, from
+        the ``payday_*`` tables, so that ``update_stats`` doesn't have to scan
+        all of ``payments`` and ``events``. Dues only count if the participant
+        still has a working credit card.
+
+        """
+        n = cursor.one("""
+
+            WITH stats AS (
+                    SELECT p.id AS participant_id, t.id AS team_id, pp.amount, pp.direction
+                      FROM payday_payments pp
+                      JOIN participants p ON p.username = pp.participant
+                      JOIN teams t ON t.slug = pp.team
+                     UNION
+                    SELECT ppi.participant_id, ppi.team_id, 0, 'to-team'
+                      FROM payday_payment_instructions ppi
+                      JOIN payday_participants p ON p.id = ppi.participant_id
+                     WHERE ppi.is_funded IS NOT true
+                       AND p.has_credit_card
+                       AND EXISTS ( SELECT 1
+                                      FROM current_exchange_routes r
+                                     WHERE r.participant = p.id
+                                       AND r.network = 'braintree-cc'
+                                       AND r.error = ''
+                                  )
+                 )
+               , inserted AS (
+                    INSERT INTO payday_stats (payday, participant_id, team_id, amount, direction)
+                         SELECT %s, * FROM stats
+                      RETURNING 1
+                 )
+            SELECT count(*) FROM inserted
 
+        """, (self.id,))
+        log("Recorded stats for %i payments and dues." % n)
 
-    def update_stats(self):
+
+    def update_stats(self, cursor=None):
+        """Set ``nusers``, ``nteams`` and ``volume`` for this payday.
+
+        They're computed from what ``record_stats`` wrote during payin. For a
+        payday whose payin ran before we had ``payday_stats`` we fall back to
+        scanning ``payments`` and ``events``. Set ``verify_stats`` to run both
+        and log any difference; the scan wins in that case.
+
+        """
         log("Updating stats.")
-        self.db.run("""
+        with self.db.get_cursor(cursor) as cursor:
+            stats = self.get_recorded_stats(cursor)
+            if stats is None:
+                stats = self.scan_stats(cursor)
+            elif self.verify_stats:
+                scanned = self.scan_stats(cursor)
+                if scanned != stats:
+                    log("Payday stats don't match: recorded %r, scanned %r." % (stats, scanned))
+                    stats = scanned
+                else:
+                    log("Payday stats verified.")
+            cursor.run("""
+                UPDATE paydays
+                   SET nusers = %s
+                     , nteams = %s
+                     , volume = %s
+                 WHERE id = %s
+            """, stats + (self.id,))
+        log("Updated payday stats.")
 
-          WITH payments_and_dues AS (
 
-              -- Participants who have either received/given money
+    def get_recorded_stats(self, cursor):
+        """Return ``(nusers, nteams, volume)`` from ``payday_stats``, or None if
+        nothing was recorded for this payday.
+        """
+        stats = cursor.one("""
+            SELECT count(DISTINCT participant_id) AS nusers
+                 , count(DISTINCT team_id) AS nteams
+                 , COALESCE(sum(CASE WHEN direction = 'to-team' THEN amount END), 0) AS volume
+                 , count(*) AS n
+              FROM payday_stats
+             WHERE payday = %s
+        """, (self.id,))
+        if not stats.n:
+            return None
+        return stats.nusers, stats.nteams, stats.volume
+
+
+    def scan_stats(self, cursor):
+        """Return ``(nusers, nteams, volume)`` from ``payments`` and ``events``.
+        """
+        return tuple(cursor.one("""
 
-              SELECT p.id as participant_id
-                   , t.id as team_id
-                   , amount
-                   , direction
-                FROM payments
-                JOIN participants p ON p.username = payments.participant
-                JOIN teams t ON t.slug = payments.team
-               WHERE payday = %(payday)s
+              WITH payments_and_dues AS (
 
-              UNION
+                  -- Participants who have either received/given money
 
-              -- Participants who weren't charged due to amount + due < MINIMUM_CHARGE
+                  SELECT p.id as participant_id
+                       , t.id as team_id
+                       , amount
+                       , direction
+                    FROM payments
+                    JOIN participants p ON p.username = payments.participant
+                    JOIN teams t ON t.slug = payments.team
+                   WHERE payday = %(payday)s
 
-              SELECT (payload->>'participant_id')::bigint AS participant_id
-                   , (payload->>'team_id')::bigint AS team_id
-                   , '0' AS amount
-                   , 'to-team' AS direction
-                FROM events
-               WHERE (
-                      (SELECT ts_end FROM paydays WHERE id = %(payday)s) = '1970-01-01T00:00:00+00'::timestamptz
+                  UNION
 
-                      OR
+                  -- Participants who weren't charged due to amount + due < MINIMUM_CHARGE
 
-                      ts < (SELECT ts_end FROM paydays WHERE id = %(payday)s)
-                    )
-                 AND ts > (SELECT ts_start FROM paydays WHERE id = %(payday)s)
-                 AND type='payday'
-                 AND payload->>'action' IN ('due')
-
-                 -- Filter out participants with bad CCs
-
-                 AND (
-                   SELECT COUNT(*)
-                     FROM current_exchange_routes r
-                     JOIN participants p ON p.id = r.participant
-                    WHERE p.id = (payload->>'participant_id')::bigint
-                      AND network = 'braintree-cc'
-                      AND error = ''
-                 ) > 0
-          )
-
-          UPDATE paydays p
-             SET nusers = (
-                  SELECT COUNT(DISTINCT(participant_id)) FROM payments_and_dues
-                 )
-               , nteams = (
-                  SELECT COUNT(DISTINCT(team_id)) FROM payments_and_dues
-                 )
-               , volume = (
-                  SELECT COALESCE(sum(amount), 0) FROM payments_and_dues WHERE direction='to-team'
-                 )
-           WHERE id=%(payday)s
+                  SELECT (payload->>'participant_id')::bigint AS participant_id
+                       , (payload->>'team_id')::bigint AS team_id
+                       , '0' AS amount
+                       , 'to-team' AS direction
+                    FROM events
+                   WHERE (
+                          (SELECT ts_end FROM paydays WHERE id = %(payday)s) = '1970-01-01T00:00:00+00'::timestamptz
 
-        """, {'payday': self.id})
-        log("Updated payday stats.")
+                          OR
+
+                          ts < (SELECT ts_end FROM paydays WHERE id = %(payday)s)
+                        )
+                     AND ts > (SELECT ts_start FROM paydays WHERE id = %(payday)s)
+                     AND type='payday'
+                     AND payload->>'action' IN ('due')
+
+                     -- Filter out participants with bad CCs
+
+                     AND (
+                       SELECT COUNT(*)
+                         FROM current_exchange_routes r
+                         JOIN participants p ON p.id = r.participant
+                        WHERE p.id = (payload->>'participant_id')::bigint
+                          AND network = 'braintree-cc'
+                          AND error = ''
+                     ) > 0
+              )
+
+              SELECT COUNT(DISTINCT(participant_id)) AS nusers
+                   , COUNT(DISTINCT(team_id)) AS nteams
+                   , COALESCE(sum(CASE WHEN direction='to-team' THEN amount END), 0) AS volume
+                FROM payments_and_dues
+
+        """, {'payday': self.id}))
 
 
     def end(self):
@@ -468,60 +888,76 @@ class Payday(object):
 
 
     def notify_participants(self):
+        """Queue an email for each participant we tried to charge during payday.
+
+        ``nteams`` and ``top_team`` are computed for all charged participants
+        in one query, and the emails are queued with one INSERT.
+
+        """
         log("Notifying participants.")
-        ts_start, ts_end = self.ts_start, self.ts_end
-        exchanges = self.db.all("""
-            SELECT e.id, amount, fee, note, status, p.*::participants AS participant
-              FROM exchanges e
-              JOIN participants p ON e.participant = p.username
-             WHERE "timestamp" >= %(ts_start)s
-               AND "timestamp" < %(ts_end)s
-               AND amount > 0
-               AND p.notify_charge > 0
-        """, locals())
-        for e in exchanges:
+        charges = self.db.all("""
+            WITH charges AS (
+                     SELECT e.id, e.amount, e.fee, e.note, e.status
+                          , p.id AS participant_id, p.notify_charge
+                       FROM exchanges e
+                       JOIN participants p ON e.participant = p.username
+                      WHERE "timestamp" >= %(ts_start)s
+                        AND "timestamp" < %(ts_end)s
+                        AND amount > 0
+                        AND p.notify_charge > 0
+                 )
+               , paypal_accounts AS (
+                     SELECT participant
+                       FROM ( SELECT DISTINCT ON (participant) participant, error
+                                FROM exchange_routes
+                               WHERE network = 'paypal'
+                            ORDER BY participant, id DESC
+                            ) r
+                      WHERE error = ''
+                 )
+               , tippees AS (
+                     SELECT s.participant_id, t.slug, s.amount
+                       FROM ( SELECT DISTINCT ON (participant_id, team_id)
+                                     participant_id, team_id, amount
+                                FROM payment_instructions
+                               WHERE mtime < %(ts_start)s
+                                 AND participant_id IN (SELECT participant_id FROM charges)
+                            ORDER BY participant_id, team_id, mtime DESC
+                            ) s
+                       JOIN teams t ON s.team_id = t.id
+                       JOIN participants p ON t.owner = p.username
+                       JOIN paypal_accounts pa ON pa.participant = p.id
+                      WHERE s.amount > 0
+                        AND t.is_approved IS true
+                        AND t.is_closed IS NOT true
+                 )
+               , teams_by_participant AS (
+                     SELECT participant_id
+                          , count(*) AS nteams
+                          , (array_agg(slug ORDER BY amount DESC))[1] AS top_team
+                       FROM tippees
+                   GROUP BY participant_id
+                 )
+            SELECT c.*, COALESCE(tp.nteams, 0) AS nteams, tp.top_team
+              FROM charges c
+         LEFT JOIN teams_by_participant tp ON tp.participant_id = c.participant_id
+          ORDER BY c.id
+        """, dict(ts_start=self.ts_start, ts_end=self.ts_end))
+        messages = []
+        for e in charges:
             if e.status not in ('failed', 'succeeded'):
                 log('exchange %s has an unexpected status: %s' % (e.id, e.status))
                 continue
             i = 1 if e.status == 'failed' else 2
-            p = e.participant
-            if p.notify_charge & i == 0:
+            if e.notify_charge & i == 0:
                 continue
-            participant_id = p.id
-            nteams, top_team = self.db.one("""
-                WITH tippees AS (
-                         SELECT t.slug, amount
-                           FROM ( SELECT DISTINCT ON (team_id) team_id, amount
-                                    FROM payment_instructions
-                                   WHERE mtime < %(ts_start)s
-                                     AND participant_id = %(participant_id)s
-                                ORDER BY team_id, mtime DESC
-                                ) s
-                           JOIN teams t ON s.team_id = t.id
-                           JOIN participants p ON t.owner = p.username
-                          WHERE s.amount > 0
-                            AND t.is_approved IS true
-                            AND t.is_closed IS NOT true
-                            AND (SELECT count(*)
-                                   FROM current_exchange_routes er
-                                  WHERE er.participant = p.id
-                                    AND network = 'paypal'
-                                    AND error = ''
-                                ) > 0
-                     )
-                SELECT ( SELECT count(*) FROM tippees ) AS nteams
-                     , ( SELECT slug
-                           FROM tippees
-                       ORDER BY amount DESC
-                          LIMIT 1
-                       ) AS top_team
-            """, locals())
-            p.queue_email(
-                'charge_'+e.status,
+            messages.append((e.participant_id, 'charge_'+e.status, dict(
                 exchange=dict(id=e.id, amount=e.amount, fee=e.fee, note=e.note),
-                nteams=nteams,
-                top_team=top_team,
-            )
+                nteams=e.nteams,
+                top_team=e.top_team,
+            )))
+        n = Participant.queue_emails_bulk(messages)
+        log("Queued %i charge notifications." % n)
 
 
     def mark_stage_done(self):
@@ -0,0 +1,188 @@
+"""Rehearse payday without moving any money.
+
+A simulation runs the database side of :py:meth:`Payday.payin` plus
+:py:meth:`Payday.update_stats` inside a single transaction that is always
+rolled back. Braintree is never contacted: card holds are faked with
+:py:class:`FakeHold`, on the assumption that every hold we would ask for is
+granted. For each stage we record wall time, time spent in SQL, rows touched
+and the process's peak memory, and return the lot as a JSON-serializable
+report.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import resource
+import time
+from contextlib import contextmanager
+
+import aspen.utils
+from aspen import log
+from postgres.cursors import SimpleNamedTupleCursor
+
+from gratipay.billing.exchanges import MINIMUM_CHARGE, _prep_hit
+from gratipay.billing.payday import Payday
+
+
+class StageCursor(SimpleNamedTupleCursor):
+    """A cursor that keeps track of the time spent in and rows touched by SQL.
+
+    ``rows`` is the sum of what the driver reports as ``rowcount`` for each
+    statement; for a multi-statement string that's the count of the last one.
+
+    """
+
+    sql_time = 0.0
+    rows = 0
+
+    def execute(self, sql, parameters=None):
+        start = time.time()
+        try:
+            return super(StageCursor, self).execute(sql, parameters)
+        finally:
+            self.sql_time += time.time() - start
+            if self.rowcount > 0:
+                self.rows += self.rowcount
+
+
+class FakeHold(object):
+    """Stand in for an authorized ``braintree.Transaction``.
+    """
+
+    def __init__(self, participant_id, amount):
+        self.id = 'fake-hold-{}'.format(participant_id)
+        self.amount = amount
+        self.custom_fields = {'participant_id': participant_id}
+        self.status = 'authorized'
+
+
+def peak_memory():
+    """Return the peak resident set size of this process, in kilobytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Simulation(object):
+    """Run payday's stages against the current database, then roll back.
+
+    :param Postgres db: the database to rehearse against
+    :param unicode engine: passed through to :py:meth:`Payday.start`
+
+    """
+
+    STAGES = ( 'prepare'
+             , 'create_card_holds'
+             , 'process_payment_instructions'
+             , 'process_draws'
+             , 'settle_card_holds'
+             , 'update_balances'
+             , 'record_stats'
+             , 'update_stats'
+              )
+
+    def __init__(self, db, engine='trigger'):
+        if engine not in Payday.ENGINES:
+            raise ValueError("unknown payday engine: {}".format(engine))
+        self.db = db
+        self.engine = engine
+
+    def run(self):
+        """Run all stages and return a report (a dict).
+        """
+        log("Simulating payday.")
+        report = { 'engine': self.engine
+                 , 'started': aspen.utils.utcnow().isoformat()
+                 , 'stages': []
+                  }
+        with self.db.get_connection() as connection:  # always rolls back
+            cursor = connection.cursor(cursor_factory=StageCursor)
+            payday = self.start(cursor)
+            report['payday'] = payday.id
+            holds = {}
+            stages = { 'prepare': lambda: payday.prepare(cursor)
+                     , 'create_card_holds': lambda: holds.update(self.create_card_holds(cursor))
+                     , 'process_payment_instructions':
+                            lambda: payday.process_payment_instructions(cursor)
+                     , 'process_draws': lambda: payday.process_draws(cursor)
+                     , 'settle_card_holds': lambda: self.settle_card_holds(cursor, holds)
+                     , 'update_balances': lambda: payday.update_balances(cursor)
+                     , 'record_stats': lambda: payday.record_stats(cursor)
+                     , 'update_stats': lambda: payday.update_stats(cursor)
+                      }
+            for name in self.STAGES:
+                with self.measure(report, name, cursor):
+                    stages[name]()
+        report['total'] = { 'wall_time': sum(s['wall_time'] for s in report['stages'])
+                          , 'sql_time': sum(s['sql_time'] for s in report['stages'])
+                          , 'rows': sum(s['rows'] for s in report['stages'])
+                          , 'peak_memory': peak_memory()
+                           }
+        log("Simulated payday in %.3f seconds." % report['total']['wall_time'])
+        return report
+
+    @staticmethod
+    @contextmanager
+    def measure(report, name, cursor):
+        cursor.sql_time, cursor.rows = 0.0, 0
+        start = time.time()
+        yield
+        report['stages'].append({ 'name': name
+                                , 'wall_time': time.time() - start
+                                , 'sql_time': cursor.sql_time
+                                , 'rows': cursor.rows
+                                , 'peak_memory': peak_memory()
+                                 })
+
+    def start(self, cursor):
+        """Like :py:meth:`Payday.start`, but inside our transaction.
+        """
+        fields = "id, (ts_start AT TIME ZONE 'UTC') AS ts_start, stage, payin_stage"
+        d = cursor.one("""
+            SELECT {}
+              FROM paydays
+             WHERE ts_end='1970-01-01T00:00:00+00'::timestamptz
+        """.format(fields))
+        if d is None:
+            d = cursor.one("INSERT INTO paydays DEFAULT VALUES RETURNING " + fields)
+        d = d._asdict()
+        d['ts_start'] = d['ts_start'].replace(tzinfo=aspen.utils.utc)
+        payday = Payday()
+        payday.__dict__.update(d)
+        payday.engine = self.engine
+        return payday
+
+    @staticmethod
+    def create_card_holds(cursor):
+        """Pretend that every card hold Payday.create_card_holds asks for succeeds.
+        """
+        participants = cursor.all("""
+            UPDATE payday_participants
+               SET card_hold_ok = true
+             WHERE old_balance < giving_today
+               AND has_credit_card
+               AND is_suspicious IS false
+               AND giving_today - old_balance >= %s
+         RETURNING id, giving_today - old_balance AS amount
+        """, (MINIMUM_CHARGE,))
+        return {p.id: FakeHold(p.id, _prep_hit(p.amount)[2]) for p in participants}
+
+    @staticmethod
+    def settle_card_holds(cursor, holds):
+        """Record what capture_card_hold would, without going to Braintree.
+        """
+        participants = cursor.all("""
+            SELECT p.id, p.username, -p.new_balance AS amount, r.id AS route
+              FROM payday_participants p
+              JOIN current_exchange_routes r ON r.participant = p.id
+             WHERE p.new_balance < 0
+               AND r.network = 'braintree-cc'
+        """)
+        for p in participants:
+            if p.id not in holds:
+                continue
+            cents, amount_str, charge_amount, fee = _prep_hit(p.amount)
+            cursor.run("""
+                INSERT INTO exchanges
+                            (amount, fee, participant, status, route, note)
+                     VALUES (%s, %s, %s, 'succeeded', %s, 'simulated');
+                UPDATE participants SET balance = (balance + %s) WHERE id = %s;
+            """, (charge_amount - fee, fee, p.username, p.route, charge_amount - fee, p.id))
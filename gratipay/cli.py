@@ -1,10 +1,37 @@
-"""This is installed as `payday`.
+"""This is installed as `payday`, `email-worker` and `benchmark`.
+
+`benchmark` is a development tool: it runs code from `gratipay.testing`, so it
+needs the packages in requirements_tests.txt, and it isn't meant for production.
 """
+import argparse
+import json
+import sys
+
+import gratipay
 from gratipay import wireup
 
 
 def payday():
 
+    # Parse arguments.
+    # ================
+
+    parser = argparse.ArgumentParser(description='Run payday.')
+    parser.add_argument('--engine', choices=('trigger', 'bulk'), default='trigger',
+                        help='how to fund payment instructions (default: trigger)')
+    parser.add_argument('--simulate', action='store_true',
+                        help="rehearse payday in a transaction that's rolled back, and "
+                             "report timings per stage as JSON")
+    parser.add_argument('--report', metavar='PATH', default='payday-simulation.json',
+                        help='where to write the simulation report, - for stdout '
+                             '(default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=5,
+                        help='how many card holds to work on at once (default: %(default)s)')
+    parser.add_argument('--verify-stats', action='store_true',
+                        help='check the stats recorded during payin against a full scan')
+    args = parser.parse_args()
+
+
     # Wire things up.
     # ===============
 
@@ -18,13 +45,100 @@ def payday():
     # This dodges a problem where db in billing is None if we import it from
     # gratipay before calling wireup.billing.
 
+    from gratipay.billing.executor import Executor
     from gratipay.billing.payday import Payday
+    Payday.executor = Executor(threads=args.threads)
+    Payday.verify_stats = args.verify_stats
+
+    if args.simulate:
+        from gratipay.billing.simulation import Simulation
+        report = Simulation(Payday.db, args.engine).run()
+        out = sys.stdout if args.report == '-' else open(args.report, 'w')
+        json.dump(report, out, indent=2, sort_keys=True)
+        out.write('\n')
+        return
 
     try:
-        Payday.start().run()
+        Payday.start(engine=args.engine).run()
     except KeyboardInterrupt:
         pass
     except:
         import aspen
         import traceback
         aspen.log(traceback.format_exc())
+
+
+def email_worker():
+
+    # Parse arguments.
+    # ================
+
+    parser = argparse.ArgumentParser(description='Send queued emails.')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='how many emails to render at once (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='how many emails to send per second, at most '
+                             '(default: $EMAIL_SEND_RATE)')
+    parser.add_argument('--batch-size', type=int, default=60,
+                        help='how many emails to claim at a time (default: %(default)s)')
+    parser.add_argument('--forever', action='store_true',
+                        help='keep waiting for new emails once the queue is empty')
+    args = parser.parse_args()
+
+
+    # Wire things up.
+    # ===============
+
+    env = wireup.env()
+    tell_sentry = wireup.make_sentry_teller(env)
+    db = wireup.db(env)
+    wireup.mail(env)
+    wireup.load_i18n('.', tell_sentry)
+    gratipay.base_url = env.base_url
+
+    from gratipay.utils.email_worker import EmailWorker
+    worker = EmailWorker(db, batch_size=args.batch_size, threads=args.threads, rate=args.rate)
+    try:
+        worker.run(forever=args.forever)
+    except KeyboardInterrupt:
+        worker.report()
+
+
+def benchmark():
+
+    # Parse arguments.
+    # ================
+
+    parser = argparse.ArgumentParser(description='Benchmark our caches (development only).')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    email = subparsers.add_parser('email', help='time rendering emails')
+    email.add_argument('--participants', type=int, default=1000)
+    email.add_argument('--repeat', type=int, default=3)
+    i18n = subparsers.add_parser('i18n', help='time i18n per request')
+    i18n.add_argument('--requests', type=int, default=1000)
+    i18n.add_argument('--repeat', type=int, default=3)
+    i18n.add_argument('--path', default='/about/stats')
+    args = parser.parse_args()
+
+
+    # Run the benchmark.
+    # ==================
+    # Importing gratipay.testing wires up the website.
+
+    if args.benchmark == 'email':
+        from decimal import Decimal
+        from gratipay.models.participant import Participant
+        from gratipay.testing.email_benchmark import FakeExchange, bench_render, make_participants
+        context = { 'exchange': FakeExchange(1, Decimal('10.00'), Decimal('0.59'))
+                  , 'nteams': 2
+                  , 'top_team': 'Gratipay'
+                   }
+        report = bench_render(Participant._email_renderer, 'charge_succeeded',
+                              make_participants(args.participants), context, args.repeat)
+    else:
+        from gratipay.main import website
+        from gratipay.testing.i18n_benchmark import bench_i18n
+        report = bench_i18n(website, args.path, args.requests, args.repeat)
+
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
@@ -1,5 +1,6 @@
 from __future__ import division
 
+import atexit
 import base64
 
 import gratipay
@@ -8,7 +9,8 @@ from gratipay import utils, security
 from gratipay.cron import Cron
 from gratipay.models.participant import Participant
 from gratipay.security import authentication, csrf
-from gratipay.utils import erase_cookie, http_caching, i18n, set_cookie, timer
+from gratipay.utils import erase_cookie, http_caching, i18n, profiler, query_log, set_cookie, timer
+from gratipay.utils.warm_up import warm_up
 from gratipay.version import get_version
 from gratipay.renderers import csv_dump, jinja2_htmlescaped, eval_, scss
 
@@ -68,17 +70,24 @@ website.mailer = gratipay.wireup.mail(env, website.project_root)
 gratipay.wireup.crypto(env)
 gratipay.wireup.base_url(website, env)
 gratipay.wireup.secure_cookies(env)
+session_cache = gratipay.wireup.session_cache(env)
 gratipay.wireup.billing(env)
 gratipay.wireup.team_review(env)
 gratipay.wireup.username_restrictions(website)
+gratipay.wireup.jinja2_bytecode_cache(website, env)
 gratipay.wireup.load_i18n(website.project_root, tell_sentry)
 gratipay.wireup.other_stuff(website, env)
+gratipay.wireup.cache_invalidation(website, env)
 gratipay.wireup.accounts_elsewhere(website, env)
 gratipay.wireup.cryptocoin_networks(website)
 
 if exc:
     tell_sentry(exc, {})
 
+if env.warm_up_simplates:
+    for path, e in warm_up(website)[1]:
+        tell_sentry(e, {})
+
 
 # Periodic jobs
 # =============
@@ -86,7 +95,11 @@ if exc:
 cron = Cron(website)
 cron(env.update_cta_every, lambda: utils.update_cta(website))
 cron(env.check_db_every, website.db.self_check, True)
+cron(env.audit_db_every, website.db.audit, True)
 cron(env.dequeue_emails_every, Participant.dequeue_emails, True)
+if session_cache is not None:
+    cron(env.flush_sessions_every, lambda: session_cache.flush(website.db))
+    atexit.register(lambda: session_cache.flush(website.db))  # don't lose expiries at restart
 
 
 # Website Algorithm
@@ -96,6 +109,7 @@ noop = lambda: None
 algorithm = website.algorithm
 algorithm.functions = [
     timer.start,
+    query_log.start,
     algorithm['parse_environ_into_request'],
     algorithm['parse_body_into_request'],
 
@@ -133,10 +147,15 @@ algorithm.functions = [
     algorithm['log_traceback_for_exception'],
     algorithm['log_result_of_request'],
 
+    query_log.end,
     timer.end,
     tell_sentry,
 ]
 
+if env.profile_requests:
+    profiler.instrument(website)
+    cron(env.profile_log_every, lambda: website.profiler.log(reset=True))
+
 
 # Monkey patch aspen.Response
 # ===========================
@@ -11,6 +11,8 @@ from contextlib import contextmanager
 from postgres import Postgres
 import psycopg2.extras
 
+from gratipay.utils import query_log
+
 
 @contextmanager
 def just_yield(obj):
@@ -19,22 +21,44 @@ def just_yield(obj):
 
 class GratipayDB(Postgres):
     """Model the Gratipay database.
+
+    Our cursors report the statements they run to :py:mod:`gratipay.utils.query_log`.
+
     """
 
+    def __init__(self, *a, **kw):
+        kw.setdefault('cursor_factory', query_log.QueryLoggingNamedTupleCursor)
+        super(GratipayDB, self).__init__(*a, **kw)
+
     def get_cursor(self, cursor=None, **kw):
         if cursor:
             if kw:
                 raise ValueError('cannot change options when reusing a cursor')
             return just_yield(cursor)
+        if 'back_as' in kw and 'cursor_factory' not in kw:
+            back_as = kw.pop('back_as')
+            if back_as in query_log.CURSORS:
+                kw['cursor_factory'] = query_log.CURSORS[back_as]
+            else:
+                kw['back_as'] = back_as
         return super(GratipayDB, self).get_cursor(**kw)
 
     def self_check(self):
         with self.get_cursor() as cursor:
             check_db(cursor)
 
+    def audit(self):
+        with self.get_cursor() as cursor:
+            audit_db(cursor)
+
 
 def check_db(cursor):
     """Runs all available self checks on the given cursor.
+
+    Balances are checked against the running totals in the ``participant_ledger``
+    and ``team_ledger`` tables, and only where something changed since the last
+    check. See :py:func:`audit_db` for a check of the whole history.
+
     """
     _check_balances(cursor)
     _check_no_team_balances(cursor)
@@ -43,6 +67,14 @@ def check_db(cursor):
     _check_orphans_no_tips(cursor)
 
 
+def audit_db(cursor):
+    """Recomputes all balances from the full history of exchanges, transfers and
+    payments, and checks the ledgers too. This is slow, run it once in a while.
+    """
+    _audit_balances(cursor)
+    _audit_team_balances(cursor)
+
+
 def _check_tips(cursor):
     """
     Checks that there are no rows in tips with duplicate (tipper, tippee, mtime).
@@ -65,12 +97,60 @@ def _check_tips(cursor):
 
 def _check_balances(cursor):
     """
-    Recalculates balances for all participants from transfers and exchanges.
+    Checks the balances that changed since the last check against the ledger.
+
+    The triggers that keep ``participant_ledger`` up to date mark a row as dirty
+    whenever the expected or actual balance changes. We read the dirty rows,
+    and only once they've all passed do we clear their flags, and only where
+    nothing changed in the meantime. Participants with no ledger row at all are
+    left to :py:func:`_audit_balances`, finding them takes a full scan.
+    """
+    rows = cursor.all("""
+        SELECT p.username, l.expected, p.balance AS actual
+          FROM participant_ledger l
+          JOIN participants p ON p.username = l.participant
+         WHERE l.dirty
+    """)
+    b = [r for r in rows if r.expected != r.actual]
+    assert len(b) == 0, "conflicting balances: {}".format(b)
+    if rows:
+        cursor.run("""
+            UPDATE participant_ledger l
+               SET dirty = false
+              FROM participants p
+                 , ( SELECT unnest(%s::text[]) AS participant
+                          , unnest(%s::numeric[]) AS balance
+                   ) c
+             WHERE l.participant = c.participant
+               AND p.username = c.participant
+               AND l.dirty
+               AND l.expected = c.balance
+               AND p.balance = c.balance
+        """, ([r.username for r in rows], [r.actual for r in rows]))
+
+
+def _check_no_team_balances(cursor):
+    if cursor.one("select exists (select * from paydays where ts_end < ts_start) as running"):
+        # payday is running
+        return
+    teams = cursor.all("""
+        SELECT team AS slug, balance
+          FROM team_ledger
+         WHERE balance <> 0
+    """)
+    assert len(teams) == 0, "teams with non-zero balance: {}".format(teams)
+
+
+def _audit_balances(cursor):
+    """
+    Recalculates balances for all participants from transfers and exchanges,
+    and checks them against both the actual balances and the ledger. Also
+    checks that nobody has a balance without a ledger row.
 
     https://github.com/gratipay/gratipay.com/issues/1118
     """
     b = cursor.all("""
-        select p.username, expected, balance as actual
+        select p.username, expected, balance as actual, l.expected as ledger
           from (
             select username, sum(a) as expected
               from (
@@ -117,16 +197,24 @@ def _check_balances(cursor):
             group by username
           ) as foo2
         join participants p on p.username = foo2.username
+   left join participant_ledger l on l.participant = foo2.username
         where expected <> p.balance
+           or expected is distinct from l.expected
     """)
     assert len(b) == 0, "conflicting balances: {}".format(b)
+    b = cursor.all("""
+        SELECT p.username, p.balance
+          FROM participants p
+     LEFT JOIN participant_ledger l ON l.participant = p.username
+         WHERE p.balance <> 0
+           AND l.participant IS NULL
+    """)
+    assert len(b) == 0, "balances without a ledger: {}".format(b)
 
-def _check_no_team_balances(cursor):
-    if cursor.one("select exists (select * from paydays where ts_end < ts_start) as running"):
-        # payday is running
-        return
+
+def _audit_team_balances(cursor):
     teams = cursor.all("""
-        SELECT t.slug, balance
+        SELECT t.slug, foo2.balance, l.balance AS ledger
           FROM (
                 SELECT team, sum(delta) as balance
                   FROM (
@@ -145,9 +233,11 @@ def _check_no_team_balances(cursor):
               GROUP BY team
                ) AS foo2
           JOIN teams t ON t.slug = foo2.team
-         WHERE balance <> 0
+     LEFT JOIN team_ledger l ON l.team = foo2.team
+         WHERE foo2.balance IS DISTINCT FROM l.balance
     """)
-    assert len(teams) == 0, "teams with non-zero balance: {}".format(teams)
+    assert len(teams) == 0, "team ledger doesn't match payments: {}".format(teams)
+    _check_no_team_balances(cursor)
 
 
 def _check_orphans(cursor):
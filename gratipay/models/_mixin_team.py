@@ -180,7 +180,7 @@ class MixinTeam(object):
                  RETURNING taking, receiving
                 """, dict(username=username, diff=diff))
                 if member and username == member.username:
-                    member.set_attributes(**r._asdict())
+                    member.set_attributes(cursor=cursor, **r._asdict())
 
     def get_current_takes(self, cursor=None):
         """Return a list of member takes for a team.
@@ -4,17 +4,15 @@ from __future__ import print_function, unicode_literals
 
 from datetime import timedelta
 from decimal import Decimal
-import pickle
-from time import sleep
 import uuid
+from cStringIO import StringIO
 
 from aspen.utils import utcnow
 import balanced
 import braintree
 from dependency_injection import resolve_dependencies
-from markupsafe import escape as htmlescape
 from postgres.orm import Model
-from psycopg2 import IntegrityError
+from psycopg2 import Binary, IntegrityError
 
 import gratipay
 from gratipay import NotSane
@@ -40,6 +38,7 @@ from gratipay.models.team import Team
 from gratipay.models.participant import mixins
 from gratipay.security.crypto import constant_time_compare
 from gratipay.utils import (
+    cache_invalidation,
     i18n,
     is_card_expiring,
     emails,
@@ -106,8 +105,21 @@ class Participant(Model, mixins.Identity):
     @classmethod
     def from_session_token(cls, token):
         """Return an existing participant based on session token.
+
+        If we have a :py:attr:`session_cache`, we look there first.
+
         """
-        participant = cls._from_thing("session_token", token)
+        cache = cls.session_cache
+        if cache is None or not token:
+            participant = cls._from_thing("session_token", token)
+        else:
+            row = cache.get(token)
+            if row is None:
+                row = cls.db.one("SELECT * FROM participants WHERE session_token=%s", (token,),
+                                 back_as=dict)
+                if row:
+                    cache.put(row)
+            participant = cls(row) if row else None
         if participant and participant.session_expires < utcnow():
             participant = None
 
@@ -128,6 +140,38 @@ class Participant(Model, mixins.Identity):
     # Session Management
     # ==================
 
+    #: A :py:class:`~gratipay.security.session_cache.SessionCache`, or None.
+    #: Set by :py:func:`gratipay.wireup.session_cache`.
+    session_cache = None
+
+    #: Whether to tell our other processes when a participant changes. Set by
+    #: :py:func:`gratipay.wireup.cache_invalidation`.
+    publish_changes = False
+
+    def set_attributes(self, cursor=None, **kw):
+        """Extend :py:meth:`Model.set_attributes` to invalidate cached copies of us.
+
+        Pass the ``cursor`` of the transaction that made the change, if any, so
+        that other processes hear about it when it commits.
+
+        """
+        constructed = 'id' in self.__dict__
+        super(Participant, self).set_attributes(**kw)
+        if constructed:
+            self.invalidate_caches(cursor=cursor)
+
+    def invalidate_caches(self, id=None, cursor=None):
+        """Drop what our processes have cached about a participant, us by default.
+
+        :database: One SELECT if :py:attr:`publish_changes`, else none
+
+        """
+        id = id or self.id
+        if self.session_cache is not None:
+            self.session_cache.invalidate(id)
+        if self.publish_changes:
+            cache_invalidation.publish(cursor or self.db, 'participant', id)
+
     def update_session(self, new_token, expires):
         """Set ``session_token`` and ``session_expires``.
 
@@ -155,6 +199,20 @@ class Participant(Model, mixins.Identity):
                     )
         self.set_attributes(session_expires=expires)
 
+    def extend_session(self, expires):
+        """Like :py:meth:`set_session_expires`, but batched when we have a session cache.
+
+        The cache writes the new expiry later, together with others, when it's
+        flushed.
+
+        :database: One UPDATE, one row, or none
+
+        """
+        if self.session_cache is None:
+            return self.set_session_expires(expires)
+        self.session_cache.extend(self.id, expires)
+        super(Participant, self).set_attributes(session_expires=expires)
+
 
     # Suspiciousness
     # ==============
@@ -287,7 +345,7 @@ class Participant(Model, mixins.Identity):
              RETURNING claimed_time
 
             """, (self.username,))
-            self.set_attributes(claimed_time=claimed_time)
+            self.set_attributes(claimed_time=claimed_time, cursor=c)
 
 
     # Closing
@@ -301,6 +359,7 @@ class Participant(Model, mixins.Identity):
             self.clear_personal_information(cursor)
             self.final_check(cursor)
             self.update_is_closed(True, cursor)
+        self.invalidate_caches()
 
     def update_is_closed(self, is_closed, cursor=None):
         with self.db.get_cursor(cursor) as cursor:
@@ -312,7 +371,7 @@ class Participant(Model, mixins.Identity):
                      , 'participant'
                      , dict(id=self.id, action='set', values=dict(is_closed=is_closed))
                       )
-            self.set_attributes(is_closed=is_closed)
+            self.set_attributes(is_closed=is_closed, cursor=cursor)
 
 
     def clear_payment_instructions(self, cursor):
@@ -370,7 +429,7 @@ class Participant(Model, mixins.Identity):
          RETURNING *;
 
         """, dict(username=self.username, participant_id=self.id))
-        self.set_attributes(**r._asdict())
+        self.set_attributes(cursor=cursor, **r._asdict())
 
 
     # Emails
@@ -517,74 +576,67 @@ class Participant(Model, mixins.Identity):
                   (self.id, address))
 
     def send_email(self, spt_name, **context):
-        context['participant'] = self
-        context['username'] = self.username
-        context['button_style'] = (
-            "color: #fff; text-decoration:none; display:inline-block; "
-            "padding: 0 15px; background: #396; white-space: nowrap; "
-            "font: normal 14px/40px Arial, sans-serif; border-radius: 3px"
-        )
-        context.setdefault('include_unsubscribe', True)
-        email = context.setdefault('email', self.email_address)
-        if not email:
+        message = self.render_email(spt_name, **context)
+        if message is None:
             return 0 # Not Sent
-        langs = i18n.parse_accept_lang(self.email_lang or 'en')
-        locale = i18n.match_lang(langs)
-        i18n.add_helpers_to_context(self._tell_sentry, context, locale)
-        context['escape'] = lambda s: s
-        context_html = dict(context)
-        i18n.add_helpers_to_context(self._tell_sentry, context_html, locale)
-        context_html['escape'] = htmlescape
-        spt = self._emails[spt_name]
-        base_spt = self._emails['base']
-        def render(t, context):
-            b = base_spt[t].render(context).strip()
-            return b.replace('$body', spt[t].render(context).strip())
-
-        message = {}
-        message['Source'] = 'Gratipay Support <support@gratipay.com>'
-        message['Destination'] = {}
-        message['Destination']['ToAddresses'] = ["%s <%s>" % (self.username, email)] # "Name <email@domain.com>"
-        message['Message'] = {}
-        message['Message']['Subject'] = {}
-        message['Message']['Subject']['Data'] = spt['subject'].render(context).strip()
-        message['Message']['Body'] = {
-            'Text': {
-                'Data': render('text/plain', context)
-            },
-            'Html': {
-                'Data': render('text/html', context_html)
-            }
-        }
-
         self._mailer.send_email(**message)
         return 1 # Sent
 
+    def render_email(self, spt_name, **context):
+        """Render an email for us, and return it as a dict for our mailer.
+
+        The return value is None if we don't have an email address.
+
+        """
+        return self._email_renderer.render(self, spt_name, context)
+
     def queue_email(self, spt_name, **context):
-        self.db.run("""
-            INSERT INTO email_queue
-                        (participant, spt_name, context)
-                 VALUES (%s, %s, %s)
-        """, (self.id, spt_name, pickle.dumps(context)))
+        self.queue_emails_bulk([(self.id, spt_name, context)])
+
+    #: Above this many emails, :py:meth:`queue_emails_bulk` uses COPY.
+    QUEUE_COPY_THRESHOLD = 1000
+
+    @classmethod
+    def queue_emails_bulk(cls, messages, cursor=None):
+        """Queue many emails with a single INSERT, or a COPY for large batches.
+
+        :param messages: an iterable of ``(participant_id, spt_name, context)``
+        :param cursor: a cursor to queue through, to make it part of a transaction
+        :returns: the number of emails queued
+
+        Contexts are encoded with :py:func:`~gratipay.utils.emails.encode_context`.
+
+        """
+        rows = [(participant_id, spt_name, emails.encode_context(context))
+                for participant_id, spt_name, context in messages]
+        if not rows:
+            return 0
+        with cls.db.get_cursor(cursor) as cursor:
+            if len(rows) > cls.QUEUE_COPY_THRESHOLD:
+                buf = StringIO()
+                for participant_id, spt_name, context in rows:
+                    buf.write(b'%i\t%s\t\\\\x%s\n' % ( participant_id
+                                                      , spt_name.encode('utf8')
+                                                      , context.encode('hex')
+                                                       ))
+                buf.seek(0)
+                cursor.copy_expert("COPY email_queue (participant, spt_name, context) "
+                                   "FROM STDIN", buf)
+            else:
+                participant_ids, spt_names, contexts = zip(*rows)
+                cursor.run("""
+                    INSERT INTO email_queue
+                                (participant, spt_name, context)
+                         SELECT unnest(%s::bigint[]), unnest(%s::text[]), unnest(%s::bytea[])
+                """, (list(participant_ids), list(spt_names), map(Binary, contexts)))
+        return len(rows)
 
     @classmethod
     def dequeue_emails(cls):
-        fetch_messages = lambda: cls.db.all("""
-            SELECT *
-              FROM email_queue
-          ORDER BY id ASC
-             LIMIT 60
-        """)
-        while True:
-            messages = fetch_messages()
-            if not messages:
-                break
-            for msg in messages:
-                p = cls.from_id(msg.participant)
-                r = p.send_email(msg.spt_name, **pickle.loads(msg.context))
-                cls.db.run("DELETE FROM email_queue WHERE id = %s", (msg.id,))
-                if r == 1:
-                    sleep(1)
+        """Send all queued emails. See :py:class:`~gratipay.utils.email_worker.EmailWorker`.
+        """
+        from gratipay.utils.email_worker import EmailWorker
+        EmailWorker(cls.db).run()
 
     def set_email_lang(self, accept_lang):
         if not accept_lang:
@@ -644,7 +696,7 @@ class Participant(Model, mixins.Identity):
     def render_notifications(self, state):
         r = []
         escape = state['escape']
-        state['escape'] = lambda a: a
+        state['escape'] = i18n.no_escape
         for name in self.notifications:
             try:
                 f = getattr(notifications, name)
@@ -994,7 +1046,7 @@ class Participant(Model, mixins.Identity):
              WHERE p.id=%(participant_id)s
          RETURNING giving, ngiving_to
         """, dict(participant_id=self.id))
-        self.set_attributes(giving=r.giving, ngiving_to=r.ngiving_to)
+        self.set_attributes(giving=r.giving, ngiving_to=r.ngiving_to, cursor=cursor)
 
         return updated
 
@@ -1056,7 +1108,7 @@ class Participant(Model, mixins.Identity):
                      , 'participant'
                      , dict(id=self.id, action='set', values=dict(is_free_rider=is_free_rider))
                       )
-            self.set_attributes(is_free_rider=is_free_rider)
+            self.set_attributes(is_free_rider=is_free_rider, cursor=cursor)
 
 
     # Random Junk
@@ -1531,7 +1583,7 @@ class Participant(Model, mixins.Identity):
                 other_balance = other.balance
                 args = dict(live=x, dead=y, balance=other_balance)
                 archive_balance = cursor.one(TRANSFER_BALANCE_1, args)
-                other.set_attributes(balance=archive_balance)
+                other.set_attributes(balance=archive_balance, cursor=cursor)
                 new_balance = cursor.one(TRANSFER_BALANCE_2, args)
 
                 # Take over email addresses.
@@ -1565,6 +1617,8 @@ class Participant(Model, mixins.Identity):
                              )
                            )
 
+        self.invalidate_caches(other.id)
+
         if new_balance is not None:
             self.set_attributes(balance=new_balance)
 
@@ -1614,6 +1668,35 @@ class Participant(Model, mixins.Identity):
         return output
 
 
+    def get_details_version(self):
+        """Return a string that changes whenever ``to_dict(details=True)`` does.
+
+        That's cheaper than calling :py:meth:`to_dict`: the fields that come
+        from our row are hashed as is, and the ones that come from other tables
+        are hashed in the database, in one query.
+
+        """
+        fields = ( self.id, self.username, self.avatar_url, self.taking, self.ntaking_from
+                 , self.anonymous_giving, self.giving, self.ngiving_to
+                  )
+        return self.db.one("""
+            SELECT md5(concat_ws('|'
+                 , %s
+                 , ( SELECT string_agg(concat_ws(':', id, platform, user_id, user_name), ','
+                                       ORDER BY platform)
+                       FROM elsewhere
+                      WHERE participant=%s
+                   )
+                 , ( SELECT string_agg(address, ',')
+                       FROM current_exchange_routes
+                      WHERE participant = %s
+                        AND network = 'bitcoin'
+                        AND error <> 'invalidated'
+                   )
+                   ))
+        """, (repr(fields), self.username, self.id))
+
+
 class NeedConfirmation(Exception):
     """Represent the case where we need user confirmation during a merge.
 
@@ -268,7 +268,7 @@ class IdentityMixin(object):
          RETURNING has_verified_identity
 
         """, dict(participant_id=self.id))
-        self.set_attributes(has_verified_identity=has_verified_identity)
+        self.set_attributes(has_verified_identity=has_verified_identity, cursor=cursor)
 
 
 # Rekeying
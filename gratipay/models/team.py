@@ -9,6 +9,7 @@ import requests
 from aspen import json, log
 from gratipay.exceptions import InvalidTeamName
 from gratipay.models import add_event
+from gratipay.utils import cache_invalidation
 from postgres.orm import Model
 
 from gratipay.billing.exchanges import MINIMUM_CHARGE
@@ -48,6 +49,22 @@ class Team(Model):
             return True
         return self.id != other.id
 
+    #: Whether to tell our other processes when a team changes. Set by
+    #: :py:func:`gratipay.wireup.cache_invalidation`.
+    publish_changes = False
+
+    def set_attributes(self, cursor=None, **kw):
+        """Extend :py:meth:`Model.set_attributes` to invalidate cached copies of us.
+
+        Pass the ``cursor`` of the transaction that made the change, if any, so
+        that other processes hear about it when it commits.
+
+        """
+        constructed = 'id' in self.__dict__
+        super(Team, self).set_attributes(**kw)
+        if constructed and self.publish_changes:
+            cache_invalidation.publish(cursor or self.db, 'team', self.id)
+
 
     # Constructors
     # ============
@@ -172,7 +189,7 @@ class Team(Model):
                                  , id=self.id
                                  , **old_value
                                   ))
-        self.set_attributes(**kw)
+        self.set_attributes(cursor=c, **kw)
 
 
     def get_dues(self):
@@ -281,6 +298,7 @@ class Team(Model):
                            , nreceiving_from=r.nreceiving_from
                            , distributing=r.distributing
                            , ndistributing_to=r.ndistributing_to
+                           , cursor=cursor
                             )
 
     @property
@@ -377,6 +395,7 @@ class Team(Model):
                                      , **oids
                                       ))
             self.set_attributes( image_type=image_type
+                               , cursor=c
                                , **{'image_oid_'+size: oids[size] for size in oids}
                                 )
             return oids
@@ -0,0 +1,48 @@
+"""Share compiled Jinja2 templates between processes, through the filesystem.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+from hashlib import sha1
+from tempfile import mkstemp
+
+from jinja2 import FileSystemBytecodeCache
+from jinja2.bccache import Bucket
+
+
+class BytecodeCache(FileSystemBytecodeCache):
+    """A :py:class:`FileSystemBytecodeCache` that's safe for concurrent workers.
+
+    Files are written to a temporary name and renamed into place, so that
+    nobody ever reads a half-written one, and unreadable files are treated as
+    missing.
+
+    Jinja2 keys its cache on template names, but the pages of a simplate all
+    share the simplate's name, so we key on the source too. Jinja2 doesn't key
+    on the settings of the environment that compiled a template either, so each
+    environment needs its own ``pattern``.
+
+    """
+
+    def get_bucket(self, environment, name, filename, source):
+        checksum = self.get_source_checksum(source)
+        key = sha1(self.get_cache_key(name, filename) + b'|' + checksum).hexdigest()
+        bucket = Bucket(environment, key, checksum)
+        self.load_bytecode(bucket)
+        return bucket
+
+    def load_bytecode(self, bucket):
+        try:
+            FileSystemBytecodeCache.load_bytecode(self, bucket)
+        except Exception:
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        tmpfd, tmppath = mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(tmpfd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.rename(tmppath, self._get_cache_filename(bucket))
+        except:
+            os.unlink(tmppath)
+            raise
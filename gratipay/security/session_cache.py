@@ -0,0 +1,120 @@
+"""Keep recently authenticated participants in memory.
+
+Every signed-in request looks its participant up by session token, and most of
+them then push the session's expiry forward. A :py:class:`SessionCache` saves
+both round trips: it keeps the participant row for each recent token for
+``ttl`` seconds, and it collects expiry extensions so that :py:meth:`flush` can
+write them all with one UPDATE.
+
+The cache belongs to a process. Changes that go through
+:py:class:`~gratipay.models.participant.Participant` methods in this process
+invalidate it right away, and changes made by other processes (signing out on
+another worker, an admin flagging an account) reach it through
+:py:mod:`gratipay.utils.cache_invalidation`. Changes made behind our back, in
+``psql`` say, can take up to ``ttl`` seconds to be seen. Keep ``ttl`` short.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionCache(object):
+    """A bounded, thread-safe map of session tokens to participant rows.
+
+    :param int ttl: how many seconds a row is good for
+    :param int maxsize: how many rows to keep, the least recently used go first
+
+    """
+
+    def __init__(self, ttl, maxsize=10000, clock=time.time):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.rows = OrderedDict()       # token -> (row, cached_at)
+        self.tokens = {}                # participant id -> token
+        self.pending = {}               # participant id -> new session_expires
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, token):
+        """Return a copy of the row cached for ``token``, or None.
+        """
+        with self.lock:
+            row, cached_at = self.rows.pop(token, (None, None))
+            if row is None or self.clock() - cached_at > self.ttl:
+                if row is not None:
+                    self.tokens.pop(row['id'], None)
+                self.misses += 1
+                return None
+            self.rows[token] = (row, cached_at)
+            self.hits += 1
+            return dict(row)
+
+    def put(self, row):
+        """Cache a participant row under its session token.
+        """
+        token = row['session_token']
+        if token is None:
+            return
+        with self.lock:
+            self._remove(row['id'])
+            self.rows[token] = (dict(row), self.clock())
+            self.tokens[row['id']] = token
+            while len(self.rows) > self.maxsize:
+                token, (old, cached_at) = self.rows.popitem(last=False)
+                self.tokens.pop(old['id'], None)
+
+    def invalidate(self, participant_id):
+        """Forget what we know about a participant.
+        """
+        with self.lock:
+            self._remove(participant_id)
+
+    def clear(self):
+        """Forget every row, but not the pending expiries.
+        """
+        with self.lock:
+            self.rows.clear()
+            self.tokens.clear()
+
+    def _remove(self, participant_id):
+        token = self.tokens.pop(participant_id, None)
+        if token is not None:
+            self.rows.pop(token, None)
+
+    def extend(self, participant_id, expires):
+        """Record a new expiry for a participant's session, for :py:meth:`flush` to write.
+        """
+        with self.lock:
+            self.pending[participant_id] = expires
+            token = self.tokens.get(participant_id)
+            if token is not None:
+                self.rows[token][0]['session_expires'] = expires
+
+    def flush(self, db):
+        """Write the pending session expiries, with a single UPDATE.
+
+        An expiry is only ever pushed forward, and not at all if the participant
+        has signed out since.
+
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        ids, expires = zip(*pending.items())
+        db.run("""
+            UPDATE participants p
+               SET session_expires = x.expires
+              FROM ( SELECT unnest(%s::bigint[]) AS id
+                          , unnest(%s::timestamptz[]) AS expires
+                   ) x
+             WHERE p.id = x.id
+               AND p.session_token IS NOT NULL
+               AND p.session_expires < x.expires
+               AND p.is_suspicious IS NOT true
+        """, (list(ids), list(expires)))
+        return len(pending)
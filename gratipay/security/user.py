@@ -65,7 +65,7 @@ class User(object):
         """
         new_expires = utcnow() + SESSION_TIMEOUT
         if new_expires - self.participant.session_expires > SESSION_REFRESH:
-            self.participant.set_session_expires(new_expires)
+            self.participant.extend_session(new_expires)
             token = self.participant.session_token
             set_cookie(cookies, SESSION, token, expires=new_expires)
 
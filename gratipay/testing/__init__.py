@@ -5,6 +5,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import itertools
 import unittest
 from collections import defaultdict
+from contextlib import contextmanager
 from os.path import dirname, join, realpath
 from decimal import Decimal
 
@@ -13,6 +14,7 @@ from aspen import resources
 from aspen.utils import utcnow
 from aspen.testing.client import Client
 from gratipay.billing.exchanges import record_exchange, record_exchange_result
+from gratipay.billing.executor import throttle
 from gratipay.elsewhere import UserInfo
 from gratipay.exceptions import NoSelfTipping, NoTippee, BadAmount
 from gratipay.main import website
@@ -21,6 +23,8 @@ from gratipay.models.exchange_route import ExchangeRoute
 from gratipay.models.participant import Participant
 from gratipay.security.user import User
 from gratipay.testing.vcr import use_cassette
+from gratipay.utils import query_log
+from gratipay.utils.http_caching import PUBLIC_BODIES
 from psycopg2 import IntegrityError, InternalError
 
 
@@ -102,6 +106,9 @@ class Harness(unittest.TestCase):
 
     def tearDown(self):
         resources.__cache__ = {}  # Clear the simplate cache.
+        self.client.website.query_cache.clear()
+        PUBLIC_BODIES.clear()
+        throttle.reset()
         self.clear_tables()
 
 
@@ -117,6 +124,21 @@ class Harness(unittest.TestCase):
         self.db.run("ALTER SEQUENCE participants_id_seq RESTART WITH 1")
 
 
+    @contextmanager
+    def query_budget(self, n, allow_repeated=False):
+        """Fail if the block runs more than ``n`` SQL statements, or repeats one.
+
+        Repeated statements are usually queries in a loop, see
+        :py:meth:`gratipay.utils.query_log.QueryLog.repeated`.
+
+        """
+        with query_log.recording() as log:
+            yield log
+        assert log.count <= n, "over budget of %i queries: %s" % (n, log)
+        if not allow_repeated:
+            assert not log.repeated(), "repeated queries: %s" % log
+
+
     def make_elsewhere(self, platform, user_id, user_name, **kw):
         info = UserInfo( platform=platform
                        , user_id=unicode(user_id)
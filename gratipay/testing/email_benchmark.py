@@ -0,0 +1,92 @@
+"""Measure the cost of rendering an email, with and without our caches.
+
+    $ benchmark email --participants 1000
+
+This renders the same email for many in-memory participants, first the way
+``Participant.render_email`` used to do it, rebuilding the i18n helpers and the
+layout for every email, and then with
+:py:meth:`~gratipay.utils.emails.EmailRenderer.render_many`. The database isn't
+touched. The report is JSON, with per-message costs in milliseconds.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+from collections import namedtuple
+
+from markupsafe import escape as htmlescape
+
+from gratipay.models.participant import Participant
+from gratipay.utils import i18n
+from gratipay.utils.emails import BUTTON_STYLE
+
+
+FakeExchange = namedtuple('FakeExchange', 'id amount fee')
+
+LANGS = ('en', 'fr', 'de', 'es', 'pt-br')
+
+
+def render_uncached(participant, spt_name, context):
+    """Render an email the way we did before :py:class:`EmailRenderer`.
+    """
+    context['participant'] = participant
+    context['username'] = participant.username
+    context['button_style'] = BUTTON_STYLE
+    context.setdefault('include_unsubscribe', True)
+    email = context.setdefault('email', participant.email_address)
+    if not email:
+        return None
+    langs = i18n.parse_accept_lang(participant.email_lang or 'en')
+    locale = i18n.match_lang(langs)
+    i18n.add_helpers_to_context(participant._tell_sentry, context, locale)
+    context['escape'] = lambda s: s
+    context_html = dict(context)
+    i18n.add_helpers_to_context(participant._tell_sentry, context_html, locale)
+    context_html['escape'] = htmlescape
+    spt = participant._emails[spt_name]
+    base_spt = participant._emails['base']
+    def render(t, context):
+        b = base_spt[t].render(context).strip()
+        return b.replace('$body', spt[t].render(context).strip())
+    return { 'Subject': spt['subject'].render(context).strip()
+           , 'Text': render('text/plain', context)
+           , 'Html': render('text/html', context_html)
+            }
+
+
+def make_participants(n):
+    """Return ``n`` participants that only exist in memory.
+    """
+    return [Participant({ 'id': i
+                        , 'username': 'bench-{}'.format(i)
+                        , 'email_address': 'bench-{}@example.com'.format(i)
+                        , 'email_lang': LANGS[i % len(LANGS)]
+                         }) for i in range(1, n + 1)]
+
+
+def bench_render(renderer, spt_name, participants, context, repeat=3):
+    """Time rendering ``spt_name`` for each participant, uncached and cached.
+
+    Return a JSON-serializable report with the best per-message time of each.
+
+    """
+    runs = {'uncached': [], 'cached': []}
+    for i in range(repeat):
+        start = time.time()
+        for p in participants:
+            render_uncached(p, spt_name, dict(context))
+        runs['uncached'].append(time.time() - start)
+        renderer.helpers.clear()
+        renderer.layouts.clear()
+        start = time.time()
+        renderer.render_many(spt_name, participants, **context)
+        runs['cached'].append(time.time() - start)
+    n = len(participants)
+    best = {k: min(v) / n * 1000 for k, v in runs.items()}
+    return { 'spt_name': spt_name
+           , 'participants': n
+           , 'repeat': repeat
+           , 'runs': runs
+           , 'ms_per_message': best
+           , 'speedup': best['uncached'] / best['cached']
+            }
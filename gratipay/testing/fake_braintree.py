@@ -0,0 +1,187 @@
+"""A local stand-in for the parts of the Braintree API that payday uses.
+
+This is a real HTTP server speaking Braintree's XML, so that the Braintree
+client library, our throttling and our thread pools are all exercised as they
+are in production. It can inject latency and errors:
+
+    >>> with FakeBraintree(latency=(0.01, 0.05), error_rate=0.1) as bt:
+    ...     Payday.start().run()
+    ...     bt.calls  # doctest: +SKIP
+
+Only card holds are modeled: sales (never submitted for settlement right away),
+settlement, voids, finding a transaction, and searching by status.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import random
+import threading
+import time
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import Counter
+from SocketServer import ThreadingMixIn
+
+import braintree
+from braintree.configuration import Configuration
+from braintree.util.xml_util import XmlUtil
+
+
+PAGE_SIZE = 50
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeBraintree(object):
+    """Serve a fake Braintree gateway on localhost, in a background thread.
+
+    :param tuple latency: a ``(min, max)`` range of seconds to sleep before each response
+    :param float error_rate: the probability that a request fails with one of ``errors``
+    :param tuple errors: HTTP status codes to fail with; 429 and 503 are how
+        Braintree tells us to slow down
+    :param int seed: seeds the random number generator, for repeatable runs
+
+    """
+
+    def __init__(self, latency=(0, 0), error_rate=0, errors=(429, 503), seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.errors = errors
+        self.random = random.Random(seed)
+        self.transactions = {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Start serving and point the Braintree library at us.
+        """
+        fake = self
+        class Handler(_Handler):
+            braintree = fake
+        self.server = _Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        port = self.server.server_address[1]
+        self._saved_configuration = [ getattr(Configuration, k, None) for k in
+                                      ('environment', 'merchant_id', 'public_key', 'private_key')
+                                     ]
+        environment = braintree.Environment('127.0.0.1', str(port), '', False, None)
+        Configuration.configure(environment, 'fake-merchant', 'fake-public', 'fake-private')
+
+    def stop(self):
+        """Stop serving and restore the previous Braintree configuration.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        Configuration.configure(*self._saved_configuration)
+
+    def add_hold(self, participant_id, amount, token='fake-token'):
+        """Create an authorized transaction directly, as if from an earlier payday.
+        """
+        return self._sale({ 'amount': unicode(amount)
+                          , 'payment_method_token': token
+                          , 'custom_fields': {'participant_id': unicode(participant_id)}
+                           })
+
+    def _sale(self, params):
+        transaction = { 'id': uuid.uuid4().hex[:8]
+                      , 'type': 'sale'
+                      , 'status': 'authorized'
+                      , 'amount': params['amount']
+                      , 'tax_amount': None
+                      , 'custom_fields': params.get('custom_fields') or {}
+                      , 'credit_card': {'token': params.get('payment_method_token')}
+                       }
+        with self.lock:
+            self.transactions[transaction['id']] = transaction
+        return transaction
+
+    def handle(self, method, path, params):
+        """Return an HTTP status code and a dict to serialize as XML.
+        """
+        parts = path.split('/')[3:]  # /merchants/<merchant_id>/transactions/...
+        endpoint = parts[-1] if len(parts) != 2 or parts[1].startswith('advanced') else 'find'
+        with self.lock:
+            self.calls[method + ' ' + endpoint] += 1
+            delay = self.random.uniform(*self.latency)
+            fail = self.random.random() < self.error_rate
+            status = self.random.choice(self.errors)
+        time.sleep(delay)
+        if fail:
+            return status, None
+
+        if parts[:1] != ['transactions']:
+            return 404, None
+        if method == 'POST' and parts == ['transactions']:
+            return 201, {'transaction': self._sale(params['transaction'])}
+        if method == 'POST' and parts == ['transactions', 'advanced_search_ids']:
+            return 200, {'search_results': { 'page_size': PAGE_SIZE
+                                           , 'ids': self._search(params['search'])
+                                            }}
+        if method == 'POST' and parts == ['transactions', 'advanced_search']:
+            ids = params['search']['ids']
+            found = [self.transactions[i] for i in ids if i in self.transactions]
+            return 200, {'credit_card_transactions': {'transaction': found}}
+        transaction = self.transactions.get(parts[1]) if len(parts) > 1 else None
+        if transaction is None:
+            return 404, None
+        if method == 'GET' and len(parts) == 2:
+            return 200, {'transaction': transaction}
+        if method == 'PUT' and parts[2:] == ['submit_for_settlement']:
+            return self._transition(transaction, 'authorized', 'submitted_for_settlement',
+                                    params['transaction'].get('amount'))
+        if method == 'PUT' and parts[2:] == ['void']:
+            return self._transition(transaction, 'authorized', 'voided')
+        return 404, None
+
+    def _search(self, criteria):
+        statuses = criteria.get('status') or []
+        if not isinstance(statuses, list):
+            statuses = [statuses]
+        with self.lock:
+            return sorted(i for i, t in self.transactions.items()
+                          if not statuses or t['status'] in statuses)
+
+    def _transition(self, transaction, from_status, to_status, amount=None):
+        with self.lock:
+            if transaction['status'] != from_status:
+                message = "Cannot transition transaction from %s." % transaction['status']
+                errors = {'errors': []}
+                return 422, {'api_error_response': {'message': message, 'errors': errors}}
+            transaction['status'] = to_status
+            if amount:
+                transaction['amount'] = amount
+        return 200, {'transaction': transaction}
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    braintree = None  # set by FakeBraintree.start
+
+    def _respond(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        params = XmlUtil.dict_from_xml(body) if body.strip() else {}
+        status, data = self.braintree.handle(self.command, self.path, params)
+        out = XmlUtil.xml_from_dict(data).encode('utf8') if data else b''
+        self.send_response(status)
+        self.send_header(b'Content-Type', b'application/xml')
+        self.send_header(b'Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+    def log_message(self, *a):
+        pass
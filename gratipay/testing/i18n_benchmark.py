@@ -0,0 +1,143 @@
+"""Measure the per-request cost of i18n, with and without our caches.
+
+    $ benchmark i18n --requests 1000
+
+This serves ``/about/stats`` once, recording the messages it translates, and
+then compares, per request:
+
+- setting up i18n the way ``set_up_i18n`` used to, parsing the Accept-Language
+  header and building every helper each time, with the way it does now, with
+  :py:func:`~gratipay.utils.i18n.negotiate` and the per-locale helpers;
+- translating the recorded messages the way ``get_text`` used to, looking each
+  one up and escaping it each time, with the cached templates.
+
+It also times serving the whole page, for scale. The report is JSON, in
+milliseconds per request.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+from aspen.testing.client import Client
+from babel.numbers import (
+    format_decimal, format_number, format_percent, get_decimal_symbol, parse_decimal
+)
+
+from gratipay.utils import i18n
+
+
+ACCEPT_LANGUAGES = ( 'en-US,en;q=0.8'
+                   , 'fr-FR,fr;q=0.8,en-US;q=0.6,en;q=0.4'
+                   , 'de-DE,de;q=0.8,en-US;q=0.6,en;q=0.4'
+                   , 'es-ES,es;q=0.8'
+                   , 'pt-BR,pt;q=0.8,en-US;q=0.6'
+                   , ''
+                    )
+
+
+def set_up_i18n_uncached(tell_sentry, accept_lang, state):
+    """Set up i18n the way we did before :py:func:`i18n.negotiate`.
+    """
+    langs = list(i18n.parse_accept_lang(accept_lang))
+    loc = i18n.match_lang(langs)
+    state['escape'] = lambda s: s
+    state['locale'] = loc
+    state['decimal_symbol'] = get_decimal_symbol(locale=loc)
+    state['_'] = lambda s, *a, **kw: get_text_uncached(state, loc, s, *a, **kw)
+    state['ngettext'] = lambda *a, **kw: i18n.n_get_text(tell_sentry, state, loc, *a, **kw)
+    state['format_number'] = lambda *a: format_number(*a, locale=loc)
+    state['format_decimal'] = lambda *a: format_decimal(*a, locale=loc)
+    state['format_currency'] = lambda *a, **kw: \
+        i18n.format_currency_with_options(*a, locale=loc, **kw)
+    state['format_percent'] = lambda *a: format_percent(*a, locale=loc)
+    state['parse_decimal'] = lambda *a: parse_decimal(*a, locale=loc)
+    def _to_age(delta, **kw):
+        try:
+            return i18n.to_age(delta, loc, **kw)
+        except:
+            return i18n.to_age(delta, 'en', **kw)
+    state['to_age'] = _to_age
+
+
+def get_text_uncached(context, loc, s, *a, **kw):
+    """Translate a message the way we did before :py:func:`i18n.get_template`.
+    """
+    escape = context['escape']
+    msg = loc.catalog.get(s)
+    if msg:
+        s = msg.string or s
+        if isinstance(s, tuple):
+            s = s[0]
+    if a or kw:
+        if isinstance(s, bytes):
+            s = s.decode('ascii')
+        return escape(s).format(*a, **kw)
+    return escape(s)
+
+
+def record_messages(client, path):
+    """Serve ``path`` and return the ``(escape, message, args, kwargs)`` it translated.
+    """
+    calls = []
+    get_text = i18n.get_text
+    def recording_get_text(context, loc, s, *a, **kw):
+        calls.append((context['escape'], s, a, kw))
+        return get_text(context, loc, s, *a, **kw)
+    i18n.get_text = recording_get_text
+    try:
+        client.GET(path)
+    finally:
+        i18n.get_text = get_text
+    return calls
+
+
+def best_of(repeat, n, func):
+    """Return the best time per call of ``func``, in milliseconds.
+    """
+    runs = []
+    for i in range(repeat):
+        start = time.time()
+        for j in range(n):
+            func(j)
+        runs.append(time.time() - start)
+    return min(runs) / n * 1000
+
+
+def bench_i18n(website, path, n, repeat=3):
+    client = Client(website.www_root, website.project_root)
+    client._website = website
+    calls = record_messages(client, path)
+    tell_sentry = website.tell_sentry
+    headers = ACCEPT_LANGUAGES
+
+    def setup_uncached(j):
+        set_up_i18n_uncached(tell_sentry, headers[j % len(headers)], {})
+    def setup_cached(j):
+        langs, loc = i18n.negotiate(headers[j % len(headers)])
+        i18n.add_helpers_to_context(tell_sentry, {}, loc)
+
+    locales = [i18n.negotiate(h)[1] for h in headers]
+    def messages_uncached(j):
+        loc = locales[j % len(locales)]
+        for escape, s, a, kw in calls:
+            get_text_uncached({'escape': escape}, loc, s, *a, **kw)
+    def messages_cached(j):
+        loc = locales[j % len(locales)]
+        for escape, s, a, kw in calls:
+            i18n.get_text({'escape': escape}, loc, s, *a, **kw)
+
+    report = { 'path': path
+             , 'requests': n
+             , 'messages_per_request': len(calls)
+             , 'ms_per_request': { 'setup_uncached': best_of(repeat, n, setup_uncached)
+                                 , 'setup_cached': best_of(repeat, n, setup_cached)
+                                 , 'messages_uncached': best_of(repeat, n, messages_uncached)
+                                 , 'messages_cached': best_of(repeat, n, messages_cached)
+                                 , 'page': best_of(repeat, min(n, 100),
+                                                   lambda j: client.GET(path))
+                                  }
+              }
+    ms = report['ms_per_request']
+    report['i18n_share_of_page'] = (ms['setup_cached'] + ms['messages_cached']) / ms['page']
+    return report
@@ -0,0 +1,106 @@
+"""Tell every process when cached data goes stale, over Postgres LISTEN/NOTIFY.
+
+Each process has its own caches (see
+:py:class:`~gratipay.security.session_cache.SessionCache` and
+:py:class:`~gratipay.utils.query_cache.LRUQueryCache`). When a model changes,
+it calls :py:func:`publish` in the transaction that changes it, and Postgres
+delivers the notification to every listening process once that transaction
+commits. Each process runs a :py:class:`Listener`, which passes the
+notifications on to the handlers its caches subscribed.
+
+Notifications are ``kind:id`` strings, such as ``participant:42`` or
+``team:7``.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import select
+import threading
+import traceback
+from collections import defaultdict
+from time import sleep
+
+from aspen import log
+
+
+CHANNEL = 'cache_invalidation'
+
+
+def publish(db, kind, id):
+    """Ask every process to drop what it has cached about an object.
+
+    :param db: a database or a cursor, pass the cursor of the transaction that
+        changes the object, so that nobody hears about a change that's rolled
+        back
+    :param unicode kind: the kind of object, ``participant`` or ``team``
+    :param int id: the id of the object
+
+    """
+    db.run("SELECT pg_notify(%s, %s)", (CHANNEL, '%s:%s' % (kind, id)))
+
+
+class Listener(object):
+    """Listen for notifications from :py:func:`publish` and dispatch them.
+    """
+
+    def __init__(self, db, tell_sentry=None):
+        self.db = db
+        self.tell_sentry = tell_sentry
+        self.handlers = defaultdict(list)
+
+    def subscribe(self, kind, handler):
+        """Call ``handler(id)`` for each notification about an object of this ``kind``.
+        """
+        self.handlers[kind].append(handler)
+
+    def dispatch(self, payload):
+        kind, _, id = payload.partition(':')
+        for handler in self.handlers.get(kind, ()):
+            handler(int(id))
+
+    def listen(self, timeout=60, reconnecting=False):
+        """Block, dispatching notifications as they arrive, until the connection breaks.
+
+        When ``reconnecting``, handlers subscribed to ``*`` are called with None
+        once we're listening, so that nothing is missed between the two.
+
+        """
+        with self.db.get_connection() as conn:
+            conn.autocommit = True
+            conn.cursor().execute("LISTEN " + CHANNEL)
+            if reconnecting:
+                for handler in self.handlers.get('*', ()):
+                    handler(None)
+            while True:
+                if select.select([conn], [], [], timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        self.dispatch(notify.payload)
+                    except Exception as e:
+                        if self.tell_sentry:
+                            self.tell_sentry(e, {})
+                        log(traceback.format_exc())
+
+    def start(self, retry_after=10):
+        """Listen in a daemon thread, reconnecting when the connection breaks.
+
+        Caches can't know what they missed while we were disconnected, so
+        handlers subscribed to ``*`` are called with None when we reconnect.
+
+        """
+        def f():
+            reconnecting = False
+            while True:
+                try:
+                    self.listen(reconnecting=reconnecting)
+                except Exception:
+                    log(traceback.format_exc())
+                sleep(retry_after)
+                reconnecting = True
+        t = threading.Thread(target=f)
+        t.daemon = True
+        t.start()
+        return t
@@ -0,0 +1,242 @@
+"""Drain the email queue, quickly.
+
+Emails are queued in the ``email_queue`` table (see
+:py:meth:`~gratipay.models.participant.Participant.queue_email`). An
+:py:class:`EmailWorker` claims them in batches, renders them on a pool of
+threads, and sends them as fast as a :py:class:`TokenBucket` allows.
+
+Several workers can run at once, in as many processes as you like: claiming a
+batch leases its rows to the worker for a while, and a worker that dies has its
+rows picked up by the others once the lease runs out. We're on Postgres 9.3, so
+we can't use ``FOR UPDATE SKIP LOCKED``, and a plain ``FOR UPDATE`` would make a
+concurrent claim wait for the rows another worker is claiming, and then drop
+them, leaving it with fewer rows than are free, or none. Instead, claims are
+serialized with an advisory lock: each one is a short transaction that takes
+:py:data:`CLAIM_LOCK`, stamps the first free rows, and commits, so the next
+claim sees those rows as taken and gets the next free ones.
+
+Contexts are stored as versioned JSON (see
+:py:func:`~gratipay.utils.emails.encode_context`). Rows queued as pickles by
+older code are still read, and :py:func:`reencode_queue` converts them.
+
+Run a standalone worker with::
+
+    $ email-worker --threads 8 --rate 14 --forever
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+import traceback
+from multiprocessing.dummy import Pool as ThreadPool
+from time import sleep
+
+from aspen import log
+from psycopg2 import Binary
+
+from gratipay.models.participant import Participant
+from gratipay.utils.emails import CONTEXT_VERSION, decode_context, encode_context
+
+
+#: The advisory lock that serializes claims, see :py:meth:`EmailWorker.claim`.
+CLAIM_LOCK = 0x656d61696c  # 'email'
+
+
+class TokenBucket(object):
+    """Limit the rate at which something happens, across threads.
+
+    :param float rate: how many tokens are added per second
+    :param float burst: how many tokens the bucket holds, defaults to ``rate``
+
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token, sleeping until there is one.
+
+        Callers reserve their token before sleeping, so concurrent callers queue
+        up behind each other instead of racing for the next token.
+
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            sleep(wait)
+
+
+class EmailWorker(object):
+    """Claim, render and send queued emails.
+
+    :param Postgres db: the database the queue is in
+    :param int batch_size: how many emails to claim at a time
+    :param int threads: how many emails to render at once
+    :param float rate: how many emails to send per second, at most
+    :param int lease: how many seconds a claimed batch is ours for
+
+    """
+
+    #: The default sending rate, in emails per second. Set from the
+    #: ``EMAIL_SEND_RATE`` environment variable by :py:func:`gratipay.wireup.mail`.
+    rate = 1.0
+
+    def __init__(self, db, batch_size=60, threads=4, rate=None, lease=600):
+        self.db = db
+        self.batch_size = batch_size
+        self.threads = threads
+        self.bucket = TokenBucket(rate or self.rate)
+        self.lease = lease
+        self.sent = self.skipped = self.failed = 0
+        self.started = time.time()
+
+    def claim(self, cursor=None):
+        """Lease the next batch of free emails to ourselves and return them.
+
+        Claims wait for each other, see :py:data:`CLAIM_LOCK`. Pass a ``cursor``
+        to claim within a transaction of your own; the lock is held until it
+        ends.
+
+        """
+        with self.db.get_cursor(cursor) as cursor:
+            cursor.run("SELECT pg_advisory_xact_lock(%s)", (CLAIM_LOCK,))
+            messages = cursor.all("""
+                UPDATE email_queue q
+                   SET claimed_until = now() + %s * interval '1 second'
+                  FROM ( SELECT id
+                           FROM email_queue
+                          WHERE claimed_until IS NULL
+                             OR claimed_until < now()
+                       ORDER BY id
+                          LIMIT %s
+                            FOR UPDATE
+                       ) c
+                 WHERE q.id = c.id
+             RETURNING q.id, q.participant, q.spt_name, q.context
+            """, (self.lease, self.batch_size))
+        return sorted(messages, key=lambda m: m.id)
+
+    def render(self, msg):
+        """Return ``(msg, email, error)``; ``email`` is None if there's no address.
+        """
+        try:
+            p = Participant.from_id(msg.participant)
+            return msg, p.render_email(msg.spt_name, **decode_context(msg.context)), None
+        except Exception:
+            return msg, None, traceback.format_exc()
+
+    def send(self, msg, email):
+        self.bucket.take()
+        Participant._mailer.send_email(**email)
+
+    def process(self, messages):
+        """Render a batch of emails on our thread pool and send them as they're ready.
+
+        An email that fails to render or send stays in the queue, and is tried
+        again when its lease runs out.
+
+        """
+        pool = ThreadPool(self.threads)
+        try:
+            for msg, email, error in pool.imap(self.render, messages):
+                if error is None and email is not None:
+                    try:
+                        self.send(msg, email)
+                    except Exception:
+                        error = traceback.format_exc()
+                if error is not None:
+                    log("Failed to send email #%i:\n%s" % (msg.id, error))
+                    self.failed += 1
+                    continue
+                self.db.run("DELETE FROM email_queue WHERE id = %s", (msg.id,))
+                if email is None:
+                    self.skipped += 1
+                else:
+                    self.sent += 1
+        finally:
+            pool.close()
+            pool.join()
+
+    def report(self):
+        """Log our throughput so far and the depth of the queue.
+        """
+        elapsed = time.time() - self.started
+        depth = self.db.one("SELECT count(*) FROM email_queue")
+        log("Email worker: sent %i, skipped %i, failed %i in %.0fs (%.1f/s), %i left in the queue."
+            % (self.sent, self.skipped, self.failed, elapsed, self.sent / (elapsed or 1), depth))
+        return depth
+
+    def run(self, forever=False, poll=10):
+        """Process batches until the queue is empty, or forever.
+
+        :param bool forever: keep polling for new emails when the queue is empty
+        :param int poll: how many seconds to wait between polls
+
+        """
+        while True:
+            messages = self.claim()
+            if messages:
+                self.process(messages)
+                self.report()
+            elif forever:
+                sleep(poll)
+            else:
+                break
+
+
+def reencode_queue(db, batch_size=1000):
+    """Convert the pickled contexts left in the queue to :py:func:`encode_context`.
+
+    Rows are converted in batches of ``batch_size``, each in a transaction of
+    its own, so this can run while workers are draining the queue. A context
+    that can't be encoded is logged and left as it is; the worker still reads
+    pickles.
+
+    Return a ``(converted, failed)`` tuple.
+
+    """
+    converted = failed = 0
+    last_id = 0
+    while True:
+        with db.get_cursor() as cursor:
+            rows = cursor.all("""
+                SELECT id, context
+                  FROM email_queue
+                 WHERE id > %s
+                   AND substring(context from 1 for 1) <> %s
+              ORDER BY id
+                 LIMIT %s
+                   FOR UPDATE
+            """, (last_id, Binary(CONTEXT_VERSION), batch_size))
+            if not rows:
+                break
+            ids, contexts = [], []
+            for row in rows:
+                try:
+                    contexts.append(Binary(encode_context(decode_context(row.context))))
+                except Exception:
+                    log("Can't convert the context of email #%i:\n%s"
+                        % (row.id, traceback.format_exc()))
+                    failed += 1
+                    continue
+                ids.append(row.id)
+            cursor.run("""
+                UPDATE email_queue q
+                   SET context = c.context
+                  FROM ( SELECT unnest(%s::int[]) AS id, unnest(%s::bytea[]) AS context ) c
+                 WHERE q.id = c.id
+            """, (ids, contexts))
+            converted += len(ids)
+            last_id = rows[-1].id
+        log("Converted %i queued emails so far, %i failed." % (converted, failed))
+    return converted, failed
@@ -1,10 +1,16 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import json
+import pickle
 import sys
+from decimal import Decimal
 
 from aspen.simplates.pagination import parse_specline, split_and_escape
 from aspen_jinja2_renderer import SimplateLoader
-from jinja2 import Environment
+from jinja2 import Environment, meta
+from markupsafe import escape as htmlescape
+
+from gratipay.utils import i18n
 
 
 ( VERIFICATION_MISSING
@@ -29,9 +35,168 @@ def compile_email_spt(fpath):
         key = 'subject' if i == 1 else content_type
         env = jinja_env_html if content_type == 'text/html' else jinja_env
         r[key] = SimplateLoader(fpath, tmpl).load(env, fpath)
+        r[key].variables = frozenset(meta.find_undeclared_variables(env.parse(tmpl)))
     return r
 
 
+#: The version byte that starts the contexts encoded by :py:func:`encode_context`.
+#: Pickles never start with it, so legacy rows are easy to tell apart.
+CONTEXT_VERSION = b'\x01'
+
+
+def _encode_value(o):
+    if isinstance(o, Decimal):
+        return {'$decimal': unicode(o)}
+    raise TypeError("can't queue an email with a %s in its context" % type(o).__name__)
+
+
+def _decode_object(d):
+    if len(d) == 1 and '$decimal' in d:
+        return Decimal(d['$decimal'])
+    return d
+
+
+def encode_context(context):
+    """Encode an email context for the ``email_queue`` table.
+
+    The encoding is compact JSON behind a version byte. Decimals survive the
+    round trip, tuples come back as lists, and other types are refused with a
+    :py:exc:`TypeError`, so that what we queue is what the worker gets.
+
+    """
+    return CONTEXT_VERSION + json.dumps(context, default=_encode_value, ensure_ascii=False,
+                                        separators=(',', ':'), sort_keys=True).encode('utf8')
+
+
+def decode_context(blob):
+    """Decode an email context from the ``email_queue`` table.
+
+    Contexts that were queued before :py:func:`encode_context` existed are
+    pickles, and we still load those.
+
+    """
+    blob = bytes(blob)
+    if blob[:1] == CONTEXT_VERSION:
+        return json.loads(blob[1:].decode('utf8'), object_hook=_decode_object)
+    return pickle.loads(blob)
+
+
+BUTTON_STYLE = (
+    "color: #fff; text-decoration:none; display:inline-block; "
+    "padding: 0 15px; background: #396; white-space: nowrap; "
+    "font: normal 14px/40px Arial, sans-serif; border-radius: 3px"
+)
+
+
+class EmailRenderer(object):
+    """Render the emails compiled by :py:func:`compile_email_spt`.
+
+    Rendering the same email for many participants repeats a lot of work, so
+    we keep two caches, filled as we go:
+
+    - the i18n helpers for each locale, for text and for HTML, which
+      ``i18n.add_helpers_to_context`` would otherwise rebuild for every email;
+    - the ``base`` layout rendered for each locale, keyed on the values of the
+      variables it uses besides the helpers (``include_unsubscribe`` today).
+
+    :param dict emails: compiled email simplates, by name
+    :param tell_sentry: passed through to the i18n helpers
+
+    """
+
+    #: The types of values we're willing to key the layout cache on.
+    CACHEABLE = (type(None), bool, int, long, unicode, bytes)
+
+    def __init__(self, emails, tell_sentry):
+        self.emails = emails
+        self.tell_sentry = tell_sentry
+        self.helpers = {}
+        self.layouts = {}
+        self.locales = {}
+
+    def get_locale(self, email_lang):
+        loc = self.locales.get(email_lang)
+        if loc is None:
+            langs = i18n.parse_accept_lang(email_lang or 'en')
+            loc = self.locales[email_lang] = i18n.match_lang(langs)
+        return loc
+
+    def get_helpers(self, loc, html):
+        key = (unicode(loc), html)
+        helpers = self.helpers.get(key)
+        if helpers is None:
+            helpers = {}
+            i18n.add_helpers_to_context(self.tell_sentry, helpers, loc)
+            helpers['escape'] = htmlescape if html else i18n.no_escape
+            self.helpers[key] = helpers
+        return helpers
+
+    def render_layout(self, loc, content_type, context):
+        """Render the ``base`` layout, from the cache if we can.
+        """
+        template = self.emails['base'][content_type]
+        helpers = self.get_helpers(loc, content_type == 'text/html')
+        values = tuple((k, context.get(k)) for k in sorted(template.variables) if k not in helpers)
+        if not all(isinstance(v, self.CACHEABLE) for k, v in values):
+            return template.render(context).strip()
+        key = (unicode(loc), content_type) + values
+        layout = self.layouts.get(key)
+        if layout is None:
+            layout = self.layouts[key] = template.render(context).strip()
+        return layout
+
+    def render(self, participant, spt_name, context):
+        """Render an email for a participant.
+
+        Return a dict for our mailer, or None if we don't have an email address.
+
+        """
+        context['participant'] = participant
+        context['username'] = participant.username
+        context['button_style'] = BUTTON_STYLE
+        context.setdefault('include_unsubscribe', True)
+        email = context.setdefault('email', participant.email_address)
+        if not email:
+            return None
+        loc = self.get_locale(participant.email_lang)
+        context_text, context_html = dict(context), dict(context)
+        context_text.update(self.get_helpers(loc, False))
+        context_html.update(self.get_helpers(loc, True))
+        spt = self.emails[spt_name]
+        def render(t, context):
+            b = self.render_layout(loc, t, context)
+            return b.replace('$body', spt[t].render(context).strip())
+
+        return {
+            'Source': 'Gratipay Support <support@gratipay.com>',
+            'Destination': {
+                'ToAddresses': ["%s <%s>" % (participant.username, email)]  # "Name <email@domain.com>"
+            },
+            'Message': {
+                'Subject': {
+                    'Data': spt['subject'].render(context_text).strip()
+                },
+                'Body': {
+                    'Text': {
+                        'Data': render('text/plain', context_text)
+                    },
+                    'Html': {
+                        'Data': render('text/html', context_html)
+                    }
+                }
+            }
+        }
+
+    def render_many(self, spt_name, participants, **context):
+        """Render the same email for many participants.
+
+        Return a list of dicts for our mailer, with None for participants who
+        don't have an email address.
+
+        """
+        return [self.render(p, spt_name, dict(context)) for p in participants]
+
+
 class ConsoleMailer(object):
     """Dumps mail to stdout.
     """
@@ -0,0 +1,59 @@
+"""A latency histogram that's safe to update from many threads.
+
+Payday's :py:mod:`~gratipay.billing.executor` and the request
+:py:mod:`~gratipay.utils.profiler` both use it.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+
+
+class Histogram(object):
+    """A fixed-bucket histogram of latencies, in milliseconds.
+    """
+
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BOUNDS)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, ms):
+        with self.lock:
+            for i, bound in enumerate(self.BOUNDS):
+                if ms <= bound:
+                    self.counts[i] += 1
+                    break
+            self.n += 1
+            self.total += ms
+            self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        """Return the upper bound of the bucket holding the q-th percentile.
+        """
+        if not self.n:
+            return 0
+        rank = q / 100 * self.n
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return { 'n': self.n
+               , 'mean': self.total / self.n if self.n else 0
+               , 'p50': self.percentile(50)
+               , 'p90': self.percentile(90)
+               , 'p99': self.percentile(99)
+               , 'max': self.max
+                }
+
+    def __str__(self):
+        return "n={n} mean={mean:.0f}ms p50={p50}ms p90={p90}ms p99={p99}ms max={max:.0f}ms" \
+               .format(**self.to_dict())
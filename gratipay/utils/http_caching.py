@@ -1,30 +1,256 @@
 """
 Handles HTTP caching.
+
+When we cache static files, :py:func:`build_manifest` fingerprints every file
+under ``www/assets`` at boot, and writes gzip and (if the ``brotli`` module is
+installed) brotli variants of the ones that compress well, next to them. Requests
+for assets then look their etag up in :py:data:`MANIFEST` instead of hashing the
+file, and :py:func:`add_caching_to_response` serves a precompressed variant to
+clients that accept it. Variants are shared by all the workers of a deploy, so
+they're written atomically and never deleted while workers may still serve them.
+
+Dynamic resources aren't cached, unless they say otherwise. The public JSON
+endpoints that widgets poll do, with :py:func:`serve_public_json`.
 """
+import gzip
+import mimetypes
+import os
+import re
+import threading
 from base64 import b64encode
+from collections import OrderedDict
 from hashlib import md5
+from io import BytesIO
+
+from aspen import json, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+#: Maps filesystem paths to :py:class:`Asset` objects.
+MANIFEST = {}
+
+#: Content-Encodings we can precompress to, in order of preference.
+ENCODINGS = ('br', 'gzip') if brotli else ('gzip',)
+EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+COMPRESSIBLE_TYPES = re.compile(r'^(text/|application/(javascript|json|x-javascript)|'
+                                r'image/svg\+xml|application/(x-font-ttf|vnd\.ms-fontobject))')
+
+#: Files smaller than this aren't worth compressing.
+MIN_SIZE = 256
+
+#: JSONP callbacks must match this.
+JSONP_CALLBACK = re.compile(r'^[_A-Za-z0-9.]+$')
+
+
+class Asset(object):
+    """A static file, its etag, and the paths of its precompressed variants.
+    """
+
+    def __init__(self, etag, variants=None):
+        self.etag = etag
+        self.variants = variants or {}  # encoding -> fspath
+        self.bodies = {}
 
-from aspen import Response
+    def get_body(self, encoding):
+        """Return the bytes of the variant for ``encoding``, reading it the first time.
 
+        Return None if the variant's file is gone, and stop offering it.
 
-ETAGS = {}
+        """
+        if encoding not in self.bodies:
+            try:
+                with open(self.variants[encoding], 'rb') as f:
+                    self.bodies[encoding] = f.read()
+            except (IOError, KeyError):
+                self.variants.pop(encoding, None)
+                return None
+        return self.bodies[encoding]
+
+
+def compute_etag(content):
+    return b64encode(md5(content).digest(), '-_').replace('=', '~')
+
+
+def compress(content, encoding):
+    if encoding == 'br':
+        return brotli.compress(content)
+    buf = BytesIO()
+    # mtime=0 so that the output only depends on the input
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, compresslevel=9, mtime=0) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+def is_compressible(path, size):
+    media_type = mimetypes.guess_type(path, strict=False)[0] or ''
+    return size >= MIN_SIZE and COMPRESSIBLE_TYPES.match(media_type) is not None
+
+
+def is_variant(path):
+    return path.endswith(tuple(EXTENSIONS.values()))
+
+
+def build_manifest(assets_root):
+    """Fingerprint the files under ``assets_root`` and write their compressed variants.
+
+    Variants that are already newer than their source are reused, and variants
+    that don't save at least a tenth of the size are left out of the manifest.
+    Other workers may be doing the same thing at the same time.
+
+    """
+    from gratipay.wireup import write_atomically  # wireup imports us
+    MANIFEST.clear()
+    for dirpath, dirnames, filenames in os.walk(assets_root):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if path.endswith('.spt') or is_variant(path):
+                continue
+            try:
+                with open(path, 'rb') as f:
+                    content = f.read()
+            except IOError:
+                continue  # a temporary file that another worker just renamed
+            variants = {}
+            if is_compressible(path, len(content)):
+                mtime = os.path.getmtime(path)
+                for encoding in ENCODINGS:
+                    variant = path + EXTENSIONS[encoding]
+                    if not os.path.exists(variant) or os.path.getmtime(variant) < mtime:
+                        write_atomically(variant, compress(content, encoding), dirpath)
+                    if os.path.getsize(variant) < len(content) * 0.9:
+                        variants[encoding] = variant
+            MANIFEST[path] = Asset(compute_etag(content), variants)
+    return MANIFEST
 
 
 def asset_etag(path):
     if path.endswith('.spt'):
         return ''
-    if path in ETAGS:
-        h = ETAGS[path]
+    if path not in MANIFEST:
+        # Files outside www/assets aren't in the manifest, hash them once.
+        with open(path, 'rb') as f:
+            MANIFEST[path] = Asset(compute_etag(f.read()))
+    return MANIFEST[path].etag
+
+
+def choose_encoding(accept_encoding, available):
+    """Return the preferred encoding in ``available`` that ``accept_encoding`` allows, or None.
+    """
+    if not accept_encoding or not available:
+        return None
+    accepted = set()
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    for encoding in ENCODINGS:
+        if encoding in available and (encoding in accepted or '*' in accepted):
+            return encoding
+    return None
+
+
+class BodyCache(object):
+    """A bounded, thread-safe map of etags to response bodies.
+
+    Bodies are keyed on etags that change whenever they do, so entries never go
+    stale, they only make room for new ones, least recently used first.
+
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.bodies = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, etag):
+        with self.lock:
+            body = self.bodies.pop(etag, None)
+            if body is not None:
+                self.bodies[etag] = body
+            return body
+
+    def put(self, etag, body):
+        with self.lock:
+            self.bodies.pop(etag, None)
+            self.bodies[etag] = body
+            while len(self.bodies) > self.maxsize:
+                self.bodies.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.bodies.clear()
+
+
+#: The bodies served by :py:func:`serve_public_json`.
+PUBLIC_BODIES = BodyCache()
+
+
+def serve_public_json(state, version, compute, max_age=60):
+    """Serve a public JSON resource, or its JSONP variant, and cache it.
+
+    :param dict state: the request state
+    :param tuple version: something cheap to get that changes whenever the
+        output of ``compute`` does, such as the id of the latest payday
+    :param compute: a callable that returns the object to serialize, only
+        called when we don't have its body already
+    :param int max_age: how long clients and shared caches can keep the
+        response, in seconds
+
+    The etag is a hash of ``version``, so we can answer ``If-None-Match`` with
+    a 304 without calling ``compute``. Always raises the response.
+
+    """
+    website, request, response = state['website'], state['request'], state['response']
+
+    # JSONP - see https://github.com/gratipay/aspen-python/issues/138
+    callback = request.qs.get('callback')
+    if callback is not None and JSONP_CALLBACK.match(callback) is None:
+        raise Response(400, "bad callback")
+
+    key = (website.version, request.path.raw, callback, version)
+    etag = compute_etag(repr(key))
+
+    # CORS - see https://github.com/gratipay/aspen-python/issues/138
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Cache-Control'] = 'public, max-age=%i' % max_age
+    response.headers['Etag'] = etag
+
+    if request.headers.get('If-None-Match') == etag:
+        response.code = 304
+        response.body = b''
+        raise response
+
+    body = PUBLIC_BODIES.get(etag)
+    if body is None:
+        body = json.dumps(compute())
+        if callback is not None:
+            body = "%s(%s)" % (callback, body)
+        PUBLIC_BODIES.put(etag, body)
+    response.body = body
+    if callback is not None:
+        response.headers['Content-Type'] = 'application/javascript'
     else:
-        with open(path) as f:
-            h = ETAGS[path] = b64encode(md5(f.read()).digest(), '-_').replace('=', '~')
-    return h
+        response.headers['Content-Type'] = website.media_type_json
+    raise response
 
 
 # algorithm functions
 
 def get_etag_for_file(dispatch_result):
-    return {'etag': asset_etag(dispatch_result.match)}
+    path = dispatch_result.match
+    etag = asset_etag(path)
+    return {'etag': etag, 'asset': MANIFEST.get(path) if etag else None}
 
 
 def try_to_serve_304(dispatch_result, request, etag):
@@ -55,13 +281,16 @@ def try_to_serve_304(dispatch_result, request, etag):
     raise Response(304)
 
 
-def add_caching_to_response(response, request=None, etag=None):
-    """Set caching headers.
+def add_caching_to_response(response, request=None, etag=None, asset=None):
+    """Set caching headers, and serve a precompressed variant if we have one.
     """
     if not etag:
         # This is a dynamic resource, disable caching by default
         if 'Cache-Control' not in response.headers:
             response.headers['Cache-Control'] = 'no-cache'
+        elif response.headers['Cache-Control'].startswith('public'):
+            # Shared caches mustn't hand anybody's cookies out to others.
+            response.headers.cookie.clear()
         return
 
     assert request is not None  # sanity check
@@ -82,3 +311,12 @@ def add_caching_to_response(response, request=None, etag=None):
     else:
         # Otherwise we cache for 5 seconds
         response.headers['Cache-Control'] = 'public, max-age=5'
+
+    if asset is not None and asset.variants:
+        response.headers['Vary'] = 'Accept-Encoding'
+        if response.code == 200:
+            encoding = choose_encoding(request.headers.get('Accept-Encoding'), asset.variants)
+            body = asset.get_body(encoding) if encoding else None
+            if body is not None:
+                response.body = body
+                response.headers['Content-Encoding'] = encoding
@@ -2,7 +2,11 @@
 from __future__ import print_function, unicode_literals
 
 from io import BytesIO
+import marshal
+import os
 import re
+import threading
+from tempfile import mkstemp
 from unicodedata import combining, normalize
 
 from aspen.simplates.pagination import parse_specline, split_and_escape
@@ -10,13 +14,14 @@ from aspen.utils import utcnow
 from babel.core import LOCALE_ALIASES, Locale
 from babel.dates import format_timedelta
 from babel.messages.extract import extract_python
-from babel.messages.pofile import Catalog
+from babel.messages.pofile import Catalog, read_po
 from babel.numbers import (
     format_currency, format_decimal, format_number, format_percent,
-    get_decimal_symbol, parse_decimal
+    get_decimal_symbol, parse_decimal, parse_pattern
 )
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 import jinja2.ext
+from markupsafe import escape as htmlescape
 
 
 ALIASES = {k: v.lower() for k, v in LOCALE_ALIASES.items()}
@@ -57,7 +62,180 @@ LANGUAGE_CODES_2 = """
 
 LANGUAGES_2 = make_sorted_dict(LANGUAGE_CODES_2, Locale('en').languages)
 
-LOCALES = {}
+class Locales(dict):
+    """A dict of :py:class:`Locale` objects that loads each one on first use.
+
+    Most processes only ever serve a handful of languages, so instead of
+    loading every catalog at boot, :py:func:`gratipay.wireup.load_i18n`
+    registers a :py:class:`LocaleLoader` per language with :py:meth:`add_loader`.
+    A language that fails to load maps to None.
+
+    """
+
+    def __init__(self, *a, **kw):
+        super(Locales, self).__init__(*a, **kw)
+        self.loaders = {}
+        self.lock = threading.Lock()
+
+    def add_loader(self, code, loader):
+        self.loaders[code] = loader
+
+    def alias(self, code, alias):
+        """Make ``alias`` point to the same locale as ``code``, unless it's taken.
+        """
+        if alias in self:
+            return
+        if dict.__contains__(self, code):
+            self[alias] = dict.__getitem__(self, code)
+        else:
+            self.loaders[alias] = self.loaders[code]
+
+    def codes(self):
+        return set(self.keys()) | set(self.loaders)
+
+    def __missing__(self, code):
+        loader = self.loaders.get(code)
+        if loader is None:
+            raise KeyError(code)
+        with self.lock:
+            if not dict.__contains__(self, code):
+                self[code] = loader()
+        return dict.__getitem__(self, code)
+
+    def __contains__(self, code):
+        return dict.__contains__(self, code) or code in self.loaders
+
+    def get(self, code, default=None):
+        try:
+            return self[code]
+        except KeyError:
+            return default
+
+
+class LocaleLoader(object):
+    """Load a locale from its catalog, once.
+    """
+
+    def __init__(self, lang, po_path, tell_sentry):
+        self.lang = lang
+        self.po_path = po_path
+        self.tell_sentry = tell_sentry
+        self.loaded = False
+        self.locale = None
+
+    def __call__(self):
+        if not self.loaded:
+            try:
+                self.locale = load_locale(self.lang, self.po_path)
+            except Exception as e:
+                self.tell_sentry(e, {})
+            self.loaded = True
+        return self.locale
+
+
+CompiledMessage = namedtuple('CompiledMessage', 'string')
+
+
+class CompiledCatalog(object):
+    """The parts of a babel :py:class:`Catalog` that we use, in a form that loads fast.
+
+    We only ever look translations up by message id, so the compiled form is a
+    dict of message ids (the singular one, for plurals) to translations, plus
+    the plural rule, serialized with :py:mod:`marshal`.
+
+    """
+
+    #: Bump this when the format changes, to ignore the files in the old one.
+    VERSION = 1
+
+    def __init__(self, plural_expr, strings):
+        self.plural_expr = plural_expr
+        self.messages = {k: CompiledMessage(v) for k, v in strings.items()}
+
+    def get(self, id):
+        return self.messages.get(id[0] if isinstance(id, tuple) else id)
+
+    @classmethod
+    def from_catalog(cls, catalog):
+        strings = {}
+        for message in catalog:
+            if not message.id or message.context:
+                continue
+            key = message.id[0] if message.pluralizable else message.id
+            strings[key] = message.string
+        return cls(catalog.plural_expr, strings)
+
+    @classmethod
+    def load(cls, f):
+        version, plural_expr, strings = marshal.load(f)
+        if version != cls.VERSION:
+            raise ValueError("catalog is in format %r, not %r" % (version, cls.VERSION))
+        return cls(plural_expr, strings)
+
+    def dump(self, f):
+        strings = {k: m.string for k, m in self.messages.items()}
+        marshal.dump((self.VERSION, self.plural_expr, strings), f)
+
+
+def compiled_path_for(po_path):
+    return po_path[:-3] + '.catalog'
+
+
+def read_catalog(po_path):
+    """Return the catalog for a ``.po`` file, from its compiled version if it's up to date.
+    """
+    compiled_path = compiled_path_for(po_path)
+    try:
+        if os.path.getmtime(compiled_path) >= os.path.getmtime(po_path):
+            with open(compiled_path, 'rb') as f:
+                return CompiledCatalog.load(f)
+    except (EnvironmentError, EOFError, TypeError, ValueError):
+        pass  # missing, stale, or unreadable, start over
+    return compile_catalog(po_path)
+
+
+def compile_catalog(po_path):
+    """Parse a ``.po`` file, write its compiled version next to it, and return it.
+
+    Failing to write the compiled file isn't an error, we'll parse the ``.po``
+    file again next time.
+
+    """
+    with open(po_path) as f:
+        catalog = CompiledCatalog.from_catalog(read_po(f))
+    try:
+        tmpfd, tmppath = mkstemp(dir=os.path.dirname(po_path) or '.')
+    except EnvironmentError:
+        return catalog
+    try:
+        with os.fdopen(tmpfd, 'wb') as f:
+            catalog.dump(f)
+        os.rename(tmppath, compiled_path_for(po_path))
+    except EnvironmentError:
+        os.unlink(tmppath)
+    return catalog
+
+
+def load_locale(lang, po_path):
+    l = Locale(lang)
+    c = l.catalog = read_catalog(po_path)
+    c.plural_func = get_function_from_rule(c.plural_expr)
+    try:
+        l.countries = make_sorted_dict(COUNTRIES, l.territories)
+    except KeyError:
+        l.countries = COUNTRIES
+    try:
+        l.languages_2 = make_sorted_dict(LANGUAGES_2, l.languages)
+    except KeyError:
+        l.languages_2 = LANGUAGES_2
+    if lang == 'fr':
+        # Patch the locale to look less formal
+        l.currency_formats[None] = parse_pattern('#,##0.00\u202f\xa4')
+        l.currency_symbols['USD'] = '$'
+    return l
+
+
+LOCALES = Locales()
 LOCALE_EN = LOCALES['en'] = Locale('en')
 LOCALE_EN.catalog = Catalog('en')
 LOCALE_EN.catalog.plural_func = lambda n: n != 1
@@ -113,18 +291,56 @@ def get_function_from_rule(rule):
     return eval('lambda n: ' + rule, {'__builtins__': {}})
 
 
-def get_text(context, loc, s, *a, **kw):
-    escape = context['escape']
+def no_escape(s):
+    return s
+
+
+#: How many templates :py:func:`get_template` keeps per locale.
+MAX_TEMPLATES = 10000
+
+
+def translate(loc, s):
+    """Return the translation of message ``s`` in ``loc``, or ``s`` if there's none.
+    """
     msg = loc.catalog.get(s)
     if msg:
         s = msg.string or s
         if isinstance(s, tuple):
             s = s[0]
+    if isinstance(s, bytes):
+        s = s.decode('ascii')
+    return s
+
+
+def get_template(loc, s, escape, translated=True):
+    """Return ``escape(s)``, or ``escape(translate(loc, s))`` if ``translated``.
+
+    The result is cached on the locale if ``escape`` is one of ours, so that
+    we only look each message up and escape it once. Other escape functions
+    aren't cached.
+
+    """
+    if escape is htmlescape:
+        html = True
+    elif escape is no_escape:
+        html = False
+    else:
+        return escape(translate(loc, s) if translated else s)
+    templates = loc.__dict__.setdefault('templates', {})
+    key = (s, html, translated)
+    template = templates.get(key)
+    if template is None:
+        template = escape(translate(loc, s) if translated else s)
+        if len(templates) < MAX_TEMPLATES:
+            templates[key] = template
+    return template
+
+
+def get_text(context, loc, s, *a, **kw):
+    template = get_template(loc, s, context['escape'])
     if a or kw:
-        if isinstance(s, bytes):
-            s = s.decode('ascii')
-        return escape(s).format(*a, **kw)
-    return escape(s)
+        return template.format(*a, **kw)
+    return template
 
 
 def n_get_text(tell_sentry, state, loc, s, p, n, *a, **kw):
@@ -137,13 +353,14 @@ def n_get_text(tell_sentry, state, loc, s, p, n, *a, **kw):
             s2 = msg.string[loc.catalog.plural_func(n)]
         except Exception as e:
             tell_sentry(e, state)
+    number_locale = loc
     if not s2:
-        loc = 'en'
+        number_locale = 'en'
         s2 = s if n == 1 else p
-    kw['n'] = format_number(n, locale=loc) or n
+    kw['n'] = format_number(n, locale=number_locale) or n
     if isinstance(s2, bytes):
         s2 = s2.decode('ascii')
-    return escape(s2).format(*a, **kw)
+    return get_template(loc, s2, escape, translated=False).format(*a, **kw)
 
 
 def to_age(dt, loc, **kw):
@@ -202,30 +419,70 @@ def format_currency_with_options(number, currency, format=None, locale='en', tra
     return s
 
 
+#: How many Accept-Language headers :py:func:`negotiate` remembers.
+NEGOTIATED_MAX = 1000
+
+_negotiated = OrderedDict()
+_negotiated_lock = threading.Lock()
+
+
+def negotiate(accept_lang):
+    """Return the languages in an Accept-Language header, and the locale to use.
+
+    There aren't that many different headers, so we keep the results for the
+    most recently used ones.
+
+    """
+    with _negotiated_lock:
+        r = _negotiated.pop(accept_lang, None)
+        if r is not None:
+            _negotiated[accept_lang] = r
+            return r
+    langs = tuple(parse_accept_lang(accept_lang))
+    r = (langs, match_lang(langs))
+    if len(accept_lang) <= 256:  # don't let huge headers fill up memory
+        with _negotiated_lock:
+            _negotiated[accept_lang] = r
+            while len(_negotiated) > NEGOTIATED_MAX:
+                _negotiated.popitem(last=False)
+    return r
+
+
 def set_up_i18n(website, request, state):
-    accept_lang = request.headers.get("Accept-Language", "")
-    langs = request.accept_langs = list(parse_accept_lang(accept_lang))
-    loc = match_lang(langs)
+    langs, loc = negotiate(request.headers.get("Accept-Language", ""))
+    request.accept_langs = list(langs)
     add_helpers_to_context(website.tell_sentry, state, loc)
 
 
-def add_helpers_to_context(tell_sentry, context, loc):
-    context['escape'] = lambda s: s  # to be overriden by renderers
-    context['locale'] = loc
-    context['decimal_symbol'] = get_decimal_symbol(locale=loc)
-    context['_'] = lambda s, *a, **kw: get_text(context, loc, s, *a, **kw)
-    context['ngettext'] = lambda *a, **kw: n_get_text(tell_sentry, context, loc, *a, **kw)
-    context['format_number'] = lambda *a: format_number(*a, locale=loc)
-    context['format_decimal'] = lambda *a: format_decimal(*a, locale=loc)
-    context['format_currency'] = lambda *a, **kw: format_currency_with_options(*a, locale=loc, **kw)
-    context['format_percent'] = lambda *a: format_percent(*a, locale=loc)
-    context['parse_decimal'] = lambda *a: parse_decimal(*a, locale=loc)
+def get_locale_helpers(loc):
+    """Return the helpers that only depend on the locale, creating them the first time.
+    """
+    helpers = loc.__dict__.get('helpers')
+    if helpers is not None:
+        return helpers
     def _to_age(delta, **kw):
         try:
             return to_age(delta, loc, **kw)
         except:
             return to_age(delta, 'en', **kw)
-    context['to_age'] = _to_age
+    helpers = loc.helpers = {
+        'locale': loc,
+        'decimal_symbol': get_decimal_symbol(locale=loc),
+        'format_number': lambda *a: format_number(*a, locale=loc),
+        'format_decimal': lambda *a: format_decimal(*a, locale=loc),
+        'format_currency': lambda *a, **kw: format_currency_with_options(*a, locale=loc, **kw),
+        'format_percent': lambda *a: format_percent(*a, locale=loc),
+        'parse_decimal': lambda *a: parse_decimal(*a, locale=loc),
+        'to_age': _to_age,
+    }
+    return helpers
+
+
+def add_helpers_to_context(tell_sentry, context, loc):
+    context.update(get_locale_helpers(loc))
+    context['escape'] = no_escape  # to be overriden by renderers
+    context['_'] = lambda s, *a, **kw: get_text(context, loc, s, *a, **kw)
+    context['ngettext'] = lambda *a, **kw: n_get_text(tell_sentry, context, loc, *a, **kw)
 
 
 def extract_spt(fileobj, *args, **kw):
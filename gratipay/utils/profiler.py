@@ -0,0 +1,130 @@
+"""Time each step of the website algorithm, per route.
+
+When ``PROFILE_REQUESTS`` is set, :py:func:`instrument` wraps every function in
+``website.algorithm.functions``, and each request records how long each step
+took. Timings are aggregated in memory, in a histogram per route and step. A
+route is the simplate a request was dispatched to, so there are only as many
+routes as there are files in ``www/``.
+
+Admins can see the percentiles at ``/dashboard/profile.json``, and they're
+logged every ``PROFILE_LOG_EVERY`` seconds.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+from collections import defaultdict
+
+from gratipay.utils.histogram import Histogram
+
+
+_local = threading.local()
+
+
+class StepHistogram(Histogram):
+    """Most steps take well under a millisecond, so we need finer buckets.
+    """
+
+    BOUNDS = (0.05, 0.1, 0.2, 0.5) + Histogram.BOUNDS
+
+
+class Step(object):
+    """Wrap an algorithm function so that its wall time is recorded.
+
+    The algorithm passes each function the state it asks for in its
+    signature, so we expose the wrapped function's signature as our own.
+
+    """
+
+    def __init__(self, func, name):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__code__ = func.__code__
+        self.__defaults__ = func.__defaults__
+        self.name = name
+
+    def __call__(self, **kw):
+        start = time.time()
+        try:
+            return self.func(**kw)
+        finally:
+            steps = getattr(_local, 'steps', None)
+            if steps is not None:
+                steps.append((self.name, (time.time() - start) * 1000))
+
+
+class Profiler(object):
+    """Aggregate step timings per route.
+    """
+
+    def __init__(self):
+        self.routes = defaultdict(lambda: defaultdict(StepHistogram))
+        self.lock = threading.Lock()
+        self.since = time.time()
+
+    def record(self, route, steps, total):
+        with self.lock:
+            histograms = self.routes[route]
+            samples = [(histograms[name], ms) for name, ms in steps]
+            samples.append((histograms['total'], total))
+        for histogram, ms in samples:
+            histogram.add(ms)
+
+    def to_dict(self):
+        with self.lock:
+            routes = {route: dict(steps) for route, steps in self.routes.items()}
+        return { 'since': self.since
+               , 'routes': { route: {name: h.to_dict() for name, h in steps.items()}
+                             for route, steps in routes.items()
+                            }
+                }
+
+    def log(self, reset=False):
+        """Print a line per route and step, in the same format as :py:mod:`gratipay.utils.timer`.
+        """
+        report = self.to_dict()
+        if reset:
+            with self.lock:
+                self.routes.clear()
+                self.since = time.time()
+        for route, steps in sorted(report['routes'].items()):
+            for name, h in sorted(steps.items()):
+                print("sample#profile route={} step={} n={} p50={:.2f}ms p90={:.2f}ms p99={:.2f}ms "
+                      "max={:.2f}ms".format(route, name, h['n'], h['p50'], h['p90'], h['p99'],
+                                            h['max']))
+
+
+def instrument(website):
+    """Wrap the website algorithm's functions in :py:class:`Step` and start profiling.
+    """
+    website.profiler = Profiler()
+    seen = defaultdict(int)
+    functions = []
+    for func in website.algorithm.functions:
+        seen[func.__name__] += 1
+        n = seen[func.__name__]
+        functions.append(Step(func, func.__name__ + ('#%i' % n if n > 1 else '')))
+    website.algorithm.functions = [start] + functions + [end]
+
+
+def start():
+    _local.steps = []
+    _local.start_time = time.time()
+
+
+def end(website, state):
+    steps = getattr(_local, 'steps', None)
+    if steps is None:
+        return
+    total = (time.time() - _local.start_time) * 1000
+    _local.steps = None
+    website.profiler.record(get_route(website, state.get('dispatch_result')), steps, total)
+
+
+def get_route(website, dispatch_result):
+    """Return the path of the simplate a request was dispatched to, relative to ``www/``.
+    """
+    if dispatch_result is None or dispatch_result.match is None:
+        return '(not dispatched)'
+    return dispatch_result.match[len(website.www_root):] or '/'
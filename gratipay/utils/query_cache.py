@@ -2,6 +2,9 @@ import sys
 import threading
 import time
 import traceback
+from collections import OrderedDict
+
+from aspen import log
 
 
 # Define a query cache.
@@ -240,3 +243,236 @@ class QueryCache(object):
                 self.locks.checkout.release()
 
             last = time.time()
+
+
+# Define a bounded query cache.
+# =============================
+
+def sizeof(obj, _seen=None):
+    """Estimate how many bytes ``obj`` takes, including what it contains.
+    """
+    _seen = _seen or set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(k, _seen) + sizeof(v, _seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(sizeof(x, _seen) for x in obj)
+    elif hasattr(obj, '__dict__'):
+        size += sizeof(obj.__dict__, _seen)
+    return size
+
+
+def freeze(obj):
+    """Turn query parameters into something we can hash.
+    """
+    if isinstance(obj, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in obj.items()))
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(x) for x in obj)
+    return obj
+
+
+class LRUEntry(object):
+    """An entry in an LRUQueryCache.
+    """
+
+    def __init__(self, result, size, timestamp, tags=()):
+        self.result = result
+        self.size = size
+        self.timestamp = timestamp
+        self.tags = frozenset(tags)
+        self.refreshing = False
+
+
+class Load(object):
+    """A query that an LRUQueryCache is running, to fill or refresh an entry.
+
+    ``stale`` is set when something the result depends on is invalidated
+    before the load is done.
+
+    """
+
+    def __init__(self, tags=()):
+        self.tags = frozenset(tags)
+        self.stale = False
+
+
+class LRUQueryCache(object):
+    """A bounded query cache that serves stale results while it refreshes them.
+
+    Like :py:class:`QueryCache`, instances run a query, pass the result through
+    an optional ``process`` callback, and cache what that returns for
+    ``max_age`` seconds. Unlike it:
+
+    - The cache is keyed on the callback as well as on the query and its
+      parameters, so different callbacks on the same query don't collide.
+      Callbacks are compared by identity, so pass module-level functions, not
+      lambdas made afresh on each call.
+
+    - It holds at most ``max_entries`` results, and at most about ``max_bytes``
+      of them, as estimated by :py:func:`sizeof`. The least recently used go
+      first.
+
+    - When an entry is too old, the first caller to notice starts refreshing
+      it in the background, and everybody gets the old result until the new
+      one is in. Only a query that isn't cached at all makes callers wait,
+      and then only one of them runs it.
+
+    - Exceptions aren't cached. A failed refresh is logged, and the next caller
+      tries again.
+
+    - Entries can be tagged with the objects they depend on, like
+      ``('team', 7)``, and dropped with :py:meth:`invalidate` when those change
+      (see :py:mod:`gratipay.utils.cache_invalidation`).
+
+    The ``hits``, ``misses``, ``stale_hits``, ``refreshes`` and ``evictions``
+    counters are available through :py:meth:`stats`.
+
+    """
+
+    def __init__(self, db, max_age=5, max_entries=1000, max_bytes=16*2**20):
+        self.db = db
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.loading = {}
+        self.loads = set()  # the Load objects in flight, see invalidate
+        self.hits = self.misses = self.stale_hits = self.refreshes = self.evictions = 0
+
+    def one(self, query, params=None, process=None, tags=(), **kw):
+        return self._get('one', query, params, process, tags, kw)
+
+    def all(self, query, params=None, process=None, tags=(), **kw):
+        return self._get('all', query, params, process, tags, kw)
+
+    def _get(self, method, query, params, process, tags, kw):
+        key = (method, query, freeze(params), process, freeze(kw))
+        fetch = lambda: self._fetch(method, query, params, process, kw)
+        load = None
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry  # now the most recently used
+                if time.time() - entry.timestamp < self.max_age:
+                    self.hits += 1
+                else:
+                    self.stale_hits += 1
+                    if not entry.refreshing:
+                        entry.refreshing = True
+                        load = self._begin_load(tags)
+            else:
+                self.misses += 1
+                loading = self.loading.setdefault(key, threading.Lock())
+        if entry is not None:
+            if load is not None:
+                self.spawn(lambda: self._refresh(key, fetch, tags, load))
+            return entry.result
+
+        with loading:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is None:
+                    load = self._begin_load(tags)
+            if entry is not None:  # somebody else loaded it while we waited
+                return entry.result
+            try:
+                result = fetch()
+                self._store(key, result, tags, load)
+                return result
+            finally:
+                with self.lock:
+                    self.loads.discard(load)
+                    self.loading.pop(key, None)
+
+    def _fetch(self, method, query, params, process, kw):
+        result = getattr(self.db, method)(query, params, **kw)
+        return process(result) if process is not None else result
+
+    def _begin_load(self, tags):
+        """Register a load, call with ``self.lock`` held.
+        """
+        load = Load(tags)
+        self.loads.add(load)
+        return load
+
+    def _refresh(self, key, fetch, tags=(), load=None):
+        try:
+            result = fetch()
+        except Exception:
+            log("Failed to refresh a cached query:\n" + traceback.format_exc())
+            with self.lock:
+                self.loads.discard(load)
+                entry = self.entries.get(key)
+                if entry is not None:
+                    entry.refreshing = False
+            return
+        with self.lock:
+            self.refreshes += 1
+        self._store(key, result, tags, load)
+
+    def _store(self, key, result, tags=(), load=None):
+        size = sizeof(result)
+        with self.lock:
+            self.loads.discard(load)
+            if load is not None and load.stale:
+                # Something we depend on was invalidated while we were
+                # fetching, our result may predate the change.
+                old = self.entries.get(key)
+                if old is not None:
+                    old.refreshing = False
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.size
+            if size > self.max_bytes:
+                return
+            self.entries[key] = LRUEntry(result, size, time.time(), tags)
+            self.nbytes += size
+            while len(self.entries) > self.max_entries or self.nbytes > self.max_bytes:
+                evicted = self.entries.popitem(last=False)[1]
+                self.nbytes -= evicted.size
+                self.evictions += 1
+
+    def spawn(self, func):
+        """Run ``func`` in a background thread.
+        """
+        t = threading.Thread(target=func)
+        t.daemon = True
+        t.start()
+
+    def clear(self):
+        with self.lock:
+            for load in self.loads:
+                load.stale = True
+            self.entries.clear()
+            self.nbytes = 0
+
+    def invalidate(self, tag):
+        """Drop the entries tagged with ``tag``, and discard the loads of such entries
+        that are in flight.
+        """
+        with self.lock:
+            for load in self.loads:
+                if tag in load.tags:
+                    load.stale = True
+            for key, entry in list(self.entries.items()):
+                if tag in entry.tags:
+                    del self.entries[key]
+                    self.nbytes -= entry.size
+
+    def stats(self):
+        with self.lock:
+            return { 'entries': len(self.entries)
+                   , 'bytes': self.nbytes
+                   , 'hits': self.hits
+                   , 'misses': self.misses
+                   , 'stale_hits': self.stale_hits
+                   , 'refreshes': self.refreshes
+                   , 'evictions': self.evictions
+                    }
@@ -0,0 +1,173 @@
+"""Count and time the SQL statements run on behalf of each request.
+
+:py:class:`~gratipay.models.GratipayDB` hands out the cursors defined here,
+which report every statement they execute to the :py:class:`QueryLog` objects
+that are active on the current thread. There's one for the request being
+served (see :py:func:`start` and :py:func:`end`), and tests can add their own
+with :py:func:`recording`. Since logs are per thread, concurrent requests don't
+see each other's queries, unlike with :py:func:`gratipay.utils.log_cursor`.
+
+A statement that runs many times with different parameters in the same
+request is usually a query in a loop, an N+1 pattern. :py:meth:`QueryLog.repeated`
+finds those.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+
+from postgres.cursors import SimpleDictCursor, SimpleNamedTupleCursor, SimpleTupleCursor
+
+from gratipay.utils.profiler import get_route
+
+
+_local = threading.local()
+
+
+class QueryLog(object):
+    """The statements run while we were active, with their timings in milliseconds.
+    """
+
+    #: A statement that runs this many times is reported by :py:meth:`repeated`.
+    REPEATED_THRESHOLD = 5
+
+    def __init__(self):
+        self.queries = []
+
+    def add(self, sql, ms):
+        self.queries.append((sql, ms))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def time(self):
+        return sum(ms for sql, ms in self.queries)
+
+    def slowest(self, n=3):
+        return sorted(self.queries, key=lambda q: -q[1])[:n]
+
+    def repeated(self, threshold=None):
+        """Return ``(count, sql)`` for the statements run at least ``threshold`` times.
+        """
+        threshold = threshold or self.REPEATED_THRESHOLD
+        counts = Counter(sql for sql, ms in self.queries)
+        return sorted(((n, sql) for sql, n in counts.items() if n >= threshold), reverse=True)
+
+    def __str__(self):
+        lines = ["%i queries in %.1fms:" % (self.count, self.time)]
+        lines.extend("  %.1fms %s" % (ms, excerpt(sql)) for sql, ms in self.queries)
+        return '\n'.join(lines)
+
+
+def excerpt(sql, length=80):
+    """Return ``sql`` on one line, cut at ``length`` characters.
+    """
+    sql = ' '.join(sql.split())
+    return sql if len(sql) <= length else sql[:length-3] + '...'
+
+
+def header_value(value):
+    """Return ``value`` as a str that's safe to send in an HTTP header.
+
+    Statements can contain non-ASCII literals, and aspen refuses to send those.
+
+    """
+    return value.encode('ascii', 'replace')
+
+
+def _active_logs():
+    logs = list(getattr(_local, 'recorders', ()))
+    request = getattr(_local, 'request', None)
+    if request is not None:
+        logs.append(request)
+    return logs
+
+
+class QueryLoggingCursorMixin(object):
+    """Report each statement we execute to the active :py:class:`QueryLog` objects.
+    """
+
+    def execute(self, sql, *a, **kw):
+        logs = _active_logs()
+        if not logs:
+            return super(QueryLoggingCursorMixin, self).execute(sql, *a, **kw)
+        start = time.time()
+        try:
+            return super(QueryLoggingCursorMixin, self).execute(sql, *a, **kw)
+        finally:
+            ms = (time.time() - start) * 1000
+            if isinstance(sql, bytes):
+                sql = sql.decode('utf8', 'replace')
+            sql = sql.strip() if isinstance(sql, unicode) else unicode(sql)
+            for log in logs:
+                log.add(sql, ms)
+
+
+class QueryLoggingTupleCursor(QueryLoggingCursorMixin, SimpleTupleCursor):
+    pass
+
+class QueryLoggingNamedTupleCursor(QueryLoggingCursorMixin, SimpleNamedTupleCursor):
+    pass
+
+class QueryLoggingDictCursor(QueryLoggingCursorMixin, SimpleDictCursor):
+    pass
+
+
+#: The cursor to use for each value of ``back_as``, see :py:meth:`GratipayDB.get_cursor`.
+CURSORS = { tuple: QueryLoggingTupleCursor
+          , 'tuple': QueryLoggingTupleCursor
+          , None: QueryLoggingNamedTupleCursor
+          , namedtuple: QueryLoggingNamedTupleCursor
+          , 'namedtuple': QueryLoggingNamedTupleCursor
+          , dict: QueryLoggingDictCursor
+          , 'dict': QueryLoggingDictCursor
+           }
+
+
+@contextmanager
+def recording():
+    """Collect the statements run on this thread inside a ``with`` block.
+    """
+    log = QueryLog()
+    recorders = _local.__dict__.setdefault('recorders', [])
+    recorders.append(log)
+    try:
+        yield log
+    finally:
+        recorders.remove(log)
+
+
+# Algorithm functions
+# ===================
+
+def start():
+    _local.request = QueryLog()
+
+
+def end(website, state, response=None):
+    log, _local.request = getattr(_local, 'request', None), None
+    if log is None or response is None:
+        return
+    repeated = log.repeated()
+    if website.sql_headers:
+        response.headers['X-SQL-Queries'] = str(log.count)
+        response.headers['X-SQL-Time'] = '%.1fms' % log.time
+        if log.queries:
+            sql, ms = log.slowest(1)[0]
+            response.headers['X-SQL-Slowest'] = header_value('%.1fms %s' % (ms, excerpt(sql)))
+        if repeated:
+            n, sql = repeated[0]
+            response.headers['X-SQL-Repeated'] = header_value('%ix %s' % (n, excerpt(sql)))
+    if website.log_metrics:
+        print("measure#sql.queries={}".format(log.count))
+        print("measure#sql.time={:.1f}ms".format(log.time))
+        if repeated:
+            route = get_route(website, state.get('dispatch_result'))
+            print("count#sql.repeated={}".format(len(repeated)))
+            for n, sql in repeated:
+                print("Repeated query on {}: {}x {}".format(route, n, excerpt(sql)))
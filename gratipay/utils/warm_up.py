@@ -0,0 +1,68 @@
+"""Compile every simplate and template before we serve our first request.
+
+    $ python -m gratipay.utils.warm_up
+
+Aspen compiles a simplate the first time it's requested, and Jinja2 compiles
+a template the first time it's loaded, so the first requests a worker serves
+are slow. :py:func:`warm_up` does that work up front: it loads the simplates
+under ``www/`` into Aspen's resource cache, and the templates under
+``templates/``, which also fills the bytecode cache (see
+:py:func:`gratipay.wireup.jinja2_bytecode_cache`) for the other workers.
+
+Run it as a script before starting the workers (in a release step, say) to
+fill the bytecode cache ahead of them, and to find the simplates that don't
+compile.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import sys
+import time
+
+from aspen import resources
+
+from gratipay.wireup import find_files
+
+
+def warm_up(website):
+    """Load all our simplates and templates.
+
+    :return: the number of simplates and templates loaded, and a list of
+        ``(path, exception)`` for the ones that failed
+
+    """
+    errors = []
+    n = 0
+    for path in sorted(find_files(website.www_root, '*.spt')):
+        try:
+            resources.get(website, path)
+        except Exception as e:
+            errors.append((path, e))
+        else:
+            n += 1
+    environment = website.renderer_factories['jinja2_htmlescaped'].meta
+    templates_root = os.path.join(website.project_root, 'templates')
+    for path in sorted(find_files(templates_root, '*.html')):
+        name = os.path.relpath(path, website.project_root)
+        try:
+            environment.get_template(name)
+        except Exception as e:
+            errors.append((path, e))
+        else:
+            n += 1
+    return n, errors
+
+
+def main():
+    from gratipay.main import website
+    start = time.time()
+    n, errors = warm_up(website)
+    print("Loaded %i simplates and templates in %.1fs." % (n, time.time() - start))
+    for path, e in errors:
+        print("Failed to load %s: %r" % (path, e))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
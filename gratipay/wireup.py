@@ -3,16 +3,16 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import atexit
+import errno
 import fnmatch
+import hashlib
 import os
 import urlparse
+from multiprocessing.dummy import Pool as ThreadPool
 from tempfile import mkstemp
 
 import aspen
 from aspen.testing.client import Client
-from babel.core import Locale
-from babel.messages.pofile import read_po
-from babel.numbers import parse_pattern
 import balanced
 import boto3
 import braintree
@@ -37,13 +37,15 @@ from gratipay.models.participant import Participant
 from gratipay.models.participant.mixins import Identity
 from gratipay.models.team import Team
 from gratipay.models import GratipayDB
+from gratipay.renderers.bytecode_cache import BytecodeCache
 from gratipay.security.crypto import EncryptingPacker
-from gratipay.utils.emails import compile_email_spt, ConsoleMailer
-from gratipay.utils.http_caching import asset_etag
-from gratipay.utils.i18n import (
-    ALIASES, ALIASES_R, COUNTRIES, LANGUAGES_2, LOCALES,
-    get_function_from_rule, make_sorted_dict
-)
+from gratipay.security.session_cache import SessionCache
+from gratipay.utils.cache_invalidation import Listener
+from gratipay.utils.emails import compile_email_spt, ConsoleMailer, EmailRenderer
+from gratipay.utils.email_worker import EmailWorker
+from gratipay.utils.http_caching import asset_etag, build_manifest, is_variant
+from gratipay.utils.query_cache import LRUQueryCache
+from gratipay.utils.i18n import ALIASES, ALIASES_R, LOCALES, LocaleLoader, compile_catalog
 
 def base_url(website, env):
     gratipay.base_url = website.base_url = env.base_url
@@ -62,6 +64,62 @@ def db(env):
 
     return db
 
+def session_cache(env):
+    if env.session_cache_ttl > 0:
+        Participant.session_cache = SessionCache(env.session_cache_ttl, env.session_cache_size)
+    else:
+        Participant.session_cache = None
+    return Participant.session_cache
+
+def cache_invalidation(website, env):
+    """Keep the caches of all our processes in sync, see :py:mod:`gratipay.utils.cache_invalidation`.
+    """
+    Participant.publish_changes = Team.publish_changes = env.cache_invalidation
+    if not env.cache_invalidation:
+        return None
+    listener = Listener(website.db, website.tell_sentry)
+    session_cache = Participant.session_cache
+    if session_cache is not None:
+        listener.subscribe('participant', session_cache.invalidate)
+    query_cache = website.query_cache
+    listener.subscribe('participant', lambda id: query_cache.invalidate(('participant', id)))
+    listener.subscribe('team', lambda id: query_cache.invalidate(('team', id)))
+    def clear_all(_):
+        if session_cache is not None:
+            session_cache.clear()
+        query_cache.clear()
+    listener.subscribe('*', clear_all)
+    listener.start()
+    return listener
+
+def jinja2_bytecode_cache(website, env):
+    """Keep compiled templates on disk, where restarts and other workers find them.
+
+    The environments of both Jinja2 renderers get the cache, each under its own
+    pattern since one autoescapes and the other doesn't.
+
+    """
+    cache_dir = env.template_cache_dir
+    if not cache_dir:
+        return None
+    cache_dir = os.path.join(website.project_root, cache_dir)
+    try:
+        os.makedirs(cache_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    for name in ('jinja2', 'jinja2_htmlescaped'):
+        factory = website.renderer_factories[name]
+        cache = BytecodeCache(cache_dir, '%s.' + name)
+        factory.meta.bytecode_cache = cache
+        # With changes_reload Aspen makes a new environment for each render.
+        def compile_meta(configuration, compile_meta=factory.compile_meta, cache=cache):
+            meta = compile_meta(configuration)
+            meta.bytecode_cache = cache
+            return meta
+        factory.compile_meta = compile_meta
+    return cache_dir
+
 def crypto(env):
     keys = [k.encode('ASCII') for k in env.crypto_keys.split()]
     out = Identity.encrypting_packer = EncryptingPacker(*keys)
@@ -78,6 +136,7 @@ def mail(env, project_root='.'):
     else:
         aspen.log_dammit("AWS SES is not configured! Mail will be dumped to the console here.")
         Participant._mailer = ConsoleMailer()
+    EmailWorker.rate = env.email_send_rate
     emails = {}
     emails_dir = project_root+'/emails/'
     i = len(emails_dir)
@@ -85,6 +144,8 @@ def mail(env, project_root='.'):
         base_name = spt[i:-4]
         emails[base_name] = compile_email_spt(spt)
     Participant._emails = emails
+    tell_sentry = lambda *a, **kw: Participant._tell_sentry(*a, **kw)
+    Participant._email_renderer = EmailRenderer(emails, tell_sentry)
 
 def billing(env):
     balanced.configure(env.balanced_api_secret)
@@ -282,28 +343,105 @@ def find_files(directory, pattern):
             yield os.path.join(root, filename)
 
 
-def compile_assets(website):
-    client = Client(website.www_root, website.project_root)
-    client._website = website
+#: Where the files that ``www/assets/*.spt`` can include live, relative to the project root.
+ASSET_SOURCES = ('scss', 'js', 'www/assets')
+
+
+def write_atomically(path, content, tmpdir='.'):
+    tmpfd, tmpfpath = mkstemp(dir=tmpdir)
+    os.write(tmpfd, content)
+    os.close(tmpfd)
+    os.rename(tmpfpath, path)
+
+
+def asset_sources_digest(website, asset_url):
+    """Hash everything that compiled assets can depend on, except their own source.
+
+    That's the files under :py:data:`ASSET_SOURCES` (the stylesheets and
+    scripts they include, and the files whose etags end up in their URLs), and
+    the settings that change their output.
+
+    """
+    h = hashlib.sha1()
+    for setting in (website.base_url, asset_url, website.compress_assets):
+        h.update(repr(setting).encode('utf8') + b'\0')
+    for directory in ASSET_SOURCES:
+        for path in sorted(find_files(os.path.join(website.project_root, directory), '*')):
+            if path.endswith('.spt') or os.path.exists(path+'.spt') or is_variant(path):
+                continue  # the sources of compiled assets are hashed separately
+            with open(path, 'rb') as f:
+                h.update(path.encode('utf8') + b'\0' + f.read() + b'\0')
+    return h.hexdigest()
+
+
+def compile_assets(website, cache_dir=None, asset_url=''):
+    """Render ``www/assets/*.spt`` to static files.
+
+    When we have a ``cache_dir``, compiled assets are stored there under a hash
+    of their source and of :py:func:`asset_sources_digest`, so restarts and
+    other workers reuse them. The ones that aren't there are compiled in
+    parallel.
+
+    """
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    digest = asset_sources_digest(website, asset_url) if cache_dir else None
+    headers = {}
+    if website.base_url:
+        url = urlparse.urlparse(website.base_url)
+        headers[b'HTTP_X_FORWARDED_PROTO'] = str(url.scheme)
+        headers[b'HTTP_HOST'] = str(url.netloc)
+
+    todo = []
     for spt in find_files(website.www_root+'/assets/', '*.spt'):
         filepath = spt[:-4]                         # /path/to/www/assets/foo.css
-        urlpath = spt[spt.rfind('/assets/'):-4]     # /assets/foo.css
+        cached = None
+        if cache_dir:
+            with open(spt, 'rb') as f:
+                key = hashlib.sha1(digest + f.read()).hexdigest()
+            name = filepath[len(website.www_root)+1:].replace('/', '_')  # assets_foo.css
+            cached = os.path.join(cache_dir, key + '-' + name)
+            if os.path.exists(cached):
+                with open(cached, 'rb') as f:
+                    write_atomically(filepath, f.read())
+                continue
         try:
             # Remove any existing compiled asset, so we can access the dynamic
             # one instead (Aspen prefers foo.css over foo.css.spt).
             os.unlink(filepath)
         except:
             pass
-        headers = {}
-        if website.base_url:
-            url = urlparse.urlparse(website.base_url)
-            headers[b'HTTP_X_FORWARDED_PROTO'] = str(url.scheme)
-            headers[b'HTTP_HOST'] = str(url.netloc)
+        todo.append((spt, cached))
+
+    def compile(args):
+        spt, cached = args
+        client = Client(website.www_root, website.project_root)
+        client._website = website
+        urlpath = spt[spt.rfind('/assets/'):-4]     # /assets/foo.css
         content = client.GET(urlpath, **headers).body
-        tmpfd, tmpfpath = mkstemp(dir='.')
-        os.write(tmpfd, content)
-        os.close(tmpfd)
-        os.rename(tmpfpath, filepath)
+        if cached:
+            write_atomically(cached, content, cache_dir)
+            name = os.path.basename(cached).split('-', 1)[1]  # assets_foo.css
+            for old in find_files(cache_dir, '*-' + name):
+                if old != cached and os.path.basename(old).split('-', 1)[1] == name:
+                    try:
+                        os.unlink(old)  # compiled from sources we no longer have
+                    except OSError:
+                        pass
+        return spt[:-4], content
+
+    if len(todo) > 1:
+        pool = ThreadPool(len(todo))
+        try:
+            compiled = pool.map(compile, todo)
+        finally:
+            pool.close()
+    else:
+        compiled = map(compile, todo)
+    for filepath, content in compiled:
+        write_atomically(filepath, content)
+
+    build_manifest(website.www_root+'/assets/')
     atexit.register(lambda: clean_assets(website.www_root))
 
 
@@ -316,40 +454,31 @@ def clean_assets(www_root):
 
 
 def load_i18n(project_root, tell_sentry):
-    # Load the locales
+    # Register the locales, they're loaded on first use
     localeDir = os.path.join(project_root, 'i18n', 'core')
     locales = LOCALES
     for file in os.listdir(localeDir):
-        try:
-            parts = file.split(".")
-            if not (len(parts) == 2 and parts[1] == "po"):
-                continue
-            lang = parts[0]
-            with open(os.path.join(localeDir, file)) as f:
-                l = locales[lang.lower()] = Locale(lang)
-                c = l.catalog = read_po(f)
-                c.plural_func = get_function_from_rule(c.plural_expr)
-                try:
-                    l.countries = make_sorted_dict(COUNTRIES, l.territories)
-                except KeyError:
-                    l.countries = COUNTRIES
-                try:
-                    l.languages_2 = make_sorted_dict(LANGUAGES_2, l.languages)
-                except KeyError:
-                    l.languages_2 = LANGUAGES_2
-        except Exception as e:
-            tell_sentry(e, {})
+        parts = file.split(".")
+        if not (len(parts) == 2 and parts[1] == "po"):
+            continue
+        lang = parts[0]
+        path = os.path.join(localeDir, file)
+        locales.add_loader(lang.lower(), LocaleLoader(lang, path, tell_sentry))
 
     # Add aliases
-    for k, v in list(locales.items()):
-        locales.setdefault(ALIASES.get(k, k), v)
-        locales.setdefault(ALIASES_R.get(k, k), v)
-    for k, v in list(locales.items()):
-        locales.setdefault(k.split('_', 1)[0], v)
+    for k in list(locales.codes()):
+        locales.alias(k, ALIASES.get(k, k))
+        locales.alias(k, ALIASES_R.get(k, k))
+    for k in list(locales.codes()):
+        locales.alias(k, k.split('_', 1)[0])
 
-    # Patch the locales to look less formal
-    locales['fr'].currency_formats[None] = parse_pattern('#,##0.00\u202f\xa4')
-    locales['fr'].currency_symbols['USD'] = '$'
+
+def compile_i18n(project_root):
+    """Compile our ``.po`` files, so that workers don't have to parse them.
+    """
+    localeDir = os.path.join(project_root, 'i18n', 'core')
+    for po_path in find_files(localeDir, '*.po'):
+        compile_catalog(po_path)
 
 
 def other_stuff(website, env):
@@ -366,7 +495,7 @@ def other_stuff(website, env):
                 website.tell_sentry(e, {})
             return env.gratipay_asset_url+path+(etag and '?etag='+etag)
         website.asset = asset
-        compile_assets(website)
+        compile_assets(website, env.asset_cache_dir, env.gratipay_asset_url)
     else:
         website.asset = lambda path: env.gratipay_asset_url+path
         clean_assets(website.www_root)
@@ -374,7 +503,11 @@ def other_stuff(website, env):
     website.optimizely_id = env.optimizely_id
     website.include_piwik = env.include_piwik
 
+    website.query_cache = LRUQueryCache(website.db, max_age=env.query_cache_max_age)
+
     website.log_metrics = env.log_metrics
+    website.sql_headers = env.sql_headers
+    website.profiler = None
 
 
 def env():
@@ -389,6 +522,9 @@ def env():
         GRATIPAY_ASSET_URL              = unicode,
         GRATIPAY_CACHE_STATIC           = is_yesish,
         GRATIPAY_COMPRESS_ASSETS        = is_yesish,
+        ASSET_CACHE_DIR                 = unicode,
+        TEMPLATE_CACHE_DIR              = unicode,
+        WARM_UP_SIMPLATES               = is_yesish,
         BALANCED_API_SECRET             = unicode,
         BRAINTREE_SANDBOX_MODE          = is_yesish,
         BRAINTREE_MERCHANT_ID           = unicode,
@@ -423,10 +559,20 @@ def env():
         OPENSTREETMAP_AUTH_URL          = unicode,
         UPDATE_CTA_EVERY                = int,
         CHECK_DB_EVERY                  = int,
+        AUDIT_DB_EVERY                  = int,
         DEQUEUE_EMAILS_EVERY            = int,
+        EMAIL_SEND_RATE                 = float,
         OPTIMIZELY_ID                   = unicode,
         SENTRY_DSN                      = unicode,
         LOG_METRICS                     = is_yesish,
+        PROFILE_REQUESTS                = is_yesish,
+        SQL_HEADERS                     = is_yesish,
+        SESSION_CACHE_TTL               = int,
+        QUERY_CACHE_MAX_AGE             = int,
+        SESSION_CACHE_SIZE              = int,
+        CACHE_INVALIDATION              = is_yesish,
+        FLUSH_SESSIONS_EVERY            = int,
+        PROFILE_LOG_EVERY               = int,
         INCLUDE_PIWIK                   = is_yesish,
         TEAM_REVIEW_REPO                = unicode,
         TEAM_REVIEW_USERNAME            = unicode,
@@ -9,6 +9,8 @@ setup( name='gratipay'
      , entry_points = { 'console_scripts'
                       : [ 'payday=gratipay.cli:payday'
                         , 'fake_data=gratipay.utils.fake_data:main'
+                        , 'email-worker=gratipay.cli:email_worker'
+                        , 'benchmark=gratipay.cli:benchmark'
                          ]
                        }
       )
@@ -0,0 +1,232 @@
+-- card_hold_journal - Braintree holds made, reused, captured and canceled during payday
+CREATE TYPE card_hold_action AS ENUM ('hold', 'reuse', 'capture', 'cancel');
+
+CREATE TABLE card_hold_journal
+( id                bigserial                   PRIMARY KEY
+, ts                timestamp with time zone    NOT NULL DEFAULT CURRENT_TIMESTAMP
+, payday            int                         DEFAULT NULL REFERENCES paydays
+                                                    ON UPDATE RESTRICT ON DELETE RESTRICT
+, participant_id    bigint                      NOT NULL REFERENCES participants(id)
+                                                    ON UPDATE RESTRICT ON DELETE RESTRICT
+, action            card_hold_action            NOT NULL
+, transaction_id    text                        NOT NULL
+, amount            numeric(35,2)               NOT NULL
+, token             text                        NOT NULL
+ );
+
+CREATE INDEX card_hold_journal_payday_idx ON card_hold_journal (payday, transaction_id);
+
+-- braintree_holds - authorized holds found at Braintree when payday reconciles them
+CREATE TABLE braintree_holds
+( payday            int                         DEFAULT NULL REFERENCES paydays
+                                                    ON UPDATE RESTRICT ON DELETE RESTRICT
+, transaction_id    text                        NOT NULL
+, participant_id    bigint                      NOT NULL
+, amount            numeric(35,2)               NOT NULL
+, reused            boolean                     NOT NULL
+ );
+
+CREATE INDEX braintree_holds_participant_idx ON braintree_holds (payday, participant_id);
+
+-- paydays.payin_stage - how many of Payday.PAYIN_STAGES are done
+ALTER TABLE paydays ADD COLUMN payin_stage integer NOT NULL DEFAULT 0;
+
+-- payday_stats - who paid, got paid or was left with dues, recorded during payin
+CREATE TABLE payday_stats
+( payday            int                         NOT NULL REFERENCES paydays
+                                                    ON UPDATE RESTRICT ON DELETE RESTRICT
+, participant_id    bigint                      NOT NULL
+, team_id           bigint                      NOT NULL
+, amount            numeric(35,2)               NOT NULL
+, direction         payment_direction           NOT NULL
+ );
+
+CREATE INDEX payday_stats_payday_idx ON payday_stats (payday);
+
+-- participant_ledger - running totals of what each participant's balance should be,
+-- kept up to date by triggers on exchanges, transfers and payments
+CREATE TABLE participant_ledger
+( participant       text                        PRIMARY KEY REFERENCES participants
+                                                    ON UPDATE CASCADE ON DELETE CASCADE
+, expected          numeric(35,2)               NOT NULL DEFAULT 0
+, dirty             boolean                     NOT NULL DEFAULT true
+ );
+
+CREATE INDEX participant_ledger_dirty_idx ON participant_ledger (participant) WHERE dirty;
+
+-- team_ledger - running totals of what's been paid to and drawn from each team
+CREATE TABLE team_ledger
+( team              text                        PRIMARY KEY REFERENCES teams
+                                                    ON UPDATE CASCADE ON DELETE CASCADE
+, balance           numeric(35,2)               NOT NULL DEFAULT 0
+ );
+
+CREATE INDEX team_ledger_nonzero_idx ON team_ledger (team) WHERE balance <> 0;
+
+INSERT INTO participant_ledger (participant, expected)
+    SELECT username, sum(a)
+      FROM ( SELECT participant AS username, amount AS a
+               FROM exchanges
+              WHERE amount > 0
+                AND (status IS NULL OR status = 'succeeded')
+          UNION ALL
+             SELECT participant, amount - fee
+               FROM exchanges
+              WHERE amount < 0
+                AND (status IS NULL OR status <> 'failed')
+          UNION ALL
+             SELECT participant, 0
+               FROM exchanges
+          UNION ALL
+             SELECT tipper, -amount FROM transfers
+          UNION ALL
+             SELECT tippee, amount FROM transfers
+          UNION ALL
+             SELECT participant, CASE WHEN direction = 'to-team' THEN -amount ELSE amount END
+               FROM payments
+           ) foo
+  GROUP BY username;
+
+INSERT INTO team_ledger (team, balance)
+    SELECT team, sum(CASE WHEN direction = 'to-team' THEN amount ELSE -amount END)
+      FROM payments
+  GROUP BY team;
+
+CREATE FUNCTION ledger_add(text, numeric) RETURNS void AS $$
+    BEGIN
+        LOOP
+            UPDATE participant_ledger
+               SET expected = (expected + $2)
+                 , dirty = true
+             WHERE participant = $1;
+            IF found THEN RETURN; END IF;
+            BEGIN
+                INSERT INTO participant_ledger (participant, expected) VALUES ($1, $2);
+                RETURN;
+            EXCEPTION WHEN unique_violation THEN
+                -- Someone else inserted it first, go round again.
+            END;
+        END LOOP;
+    END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION team_ledger_add(text, numeric) RETURNS void AS $$
+    BEGIN
+        LOOP
+            UPDATE team_ledger SET balance = (balance + $2) WHERE team = $1;
+            IF found THEN RETURN; END IF;
+            BEGIN
+                INSERT INTO team_ledger (team, balance) VALUES ($1, $2);
+                RETURN;
+            EXCEPTION WHEN unique_violation THEN
+                -- Someone else inserted it first, go round again.
+            END;
+        END LOOP;
+    END;
+$$ LANGUAGE plpgsql;
+
+-- What an exchange adds to the participant's balance
+CREATE FUNCTION exchange_delta(exchanges) RETURNS numeric AS $$
+    SELECT CASE
+               WHEN $1.amount > 0 AND ($1.status IS NULL OR $1.status = 'succeeded')
+               THEN $1.amount
+               WHEN $1.amount < 0 AND ($1.status IS NULL OR $1.status <> 'failed')
+               THEN $1.amount - $1.fee
+               ELSE 0
+           END;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- What a payment adds to the participant's balance (the team gets the opposite)
+CREATE FUNCTION payment_delta(payments) RETURNS numeric AS $$
+    SELECT CASE WHEN $1.direction = 'to-team' THEN -$1.amount ELSE $1.amount END;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Renaming a participant or a team cascades to the ledgers by themselves, so
+-- updates that don't change any amount are skipped.
+
+CREATE FUNCTION update_ledger_for_exchange() RETURNS trigger AS $$
+    DECLARE delta numeric;
+    BEGIN
+        IF (TG_OP = 'INSERT') THEN
+            PERFORM ledger_add(NEW.participant, exchange_delta(NEW));
+        ELSIF (TG_OP = 'UPDATE') THEN
+            delta := exchange_delta(NEW) - exchange_delta(OLD);
+            IF (delta <> 0) THEN
+                PERFORM ledger_add(NEW.participant, delta);
+            END IF;
+        ELSE
+            PERFORM ledger_add(OLD.participant, -exchange_delta(OLD));
+        END IF;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_ledger AFTER INSERT OR UPDATE OR DELETE ON exchanges
+    FOR EACH ROW EXECUTE PROCEDURE update_ledger_for_exchange();
+
+CREATE FUNCTION update_ledger_for_transfer() RETURNS trigger AS $$
+    DECLARE
+        delta numeric;
+        t transfers;
+    BEGIN
+        IF (TG_OP = 'INSERT') THEN
+            t := NEW;
+            delta := NEW.amount;
+        ELSIF (TG_OP = 'UPDATE') THEN
+            t := NEW;
+            delta := NEW.amount - OLD.amount;
+            IF (delta = 0) THEN RETURN NULL; END IF;
+        ELSE
+            t := OLD;
+            delta := -OLD.amount;
+        END IF;
+        PERFORM ledger_add(t.tipper, -delta);
+        PERFORM ledger_add(t.tippee, delta);
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_ledger AFTER INSERT OR UPDATE OR DELETE ON transfers
+    FOR EACH ROW EXECUTE PROCEDURE update_ledger_for_transfer();
+
+CREATE FUNCTION update_ledger_for_payment() RETURNS trigger AS $$
+    DECLARE
+        delta numeric;
+        p payments;
+    BEGIN
+        IF (TG_OP = 'INSERT') THEN
+            p := NEW;
+            delta := payment_delta(NEW);
+        ELSIF (TG_OP = 'UPDATE') THEN
+            p := NEW;
+            delta := payment_delta(NEW) - payment_delta(OLD);
+            IF (delta = 0) THEN RETURN NULL; END IF;
+        ELSE
+            p := OLD;
+            delta := -payment_delta(OLD);
+        END IF;
+        PERFORM ledger_add(p.participant, delta);
+        PERFORM team_ledger_add(p.team, -delta);
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER update_ledger AFTER INSERT OR UPDATE OR DELETE ON payments
+    FOR EACH ROW EXECUTE PROCEDURE update_ledger_for_payment();
+
+-- A balance that changes is checked again by the next check_db
+CREATE FUNCTION mark_ledger_dirty() RETURNS trigger AS $$
+    BEGIN
+        UPDATE participant_ledger
+           SET dirty = true
+         WHERE participant = NEW.username
+           AND NOT dirty;
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER mark_ledger_dirty AFTER UPDATE OF balance ON participants
+    FOR EACH ROW WHEN (OLD.balance <> NEW.balance) EXECUTE PROCEDURE mark_ledger_dirty();
+
+-- email_queue.claimed_until - emails are leased to the worker that claimed them
+ALTER TABLE email_queue ADD COLUMN claimed_until timestamptz DEFAULT NULL;
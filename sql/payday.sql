@@ -1,61 +1,89 @@
 -- Recreate the necessary tables and indexes
+--
+-- These are unlogged tables: they're cheap to write, and they survive payday
+-- crashing, but Postgres empties them if *it* crashes. That's why we finish by
+-- writing a row to payday_snapshot; see Payday.check_snapshot.
+--
+-- Each table is built in one pass with joins against pre-aggregated CTEs, and
+-- indexed and analyzed before anything else reads from it.
+
+DROP TABLE IF EXISTS payday_snapshot;
+CREATE UNLOGGED TABLE payday_snapshot
+( payday int NOT NULL
+ );
 
 DROP TABLE IF EXISTS payday_participants;
-CREATE TABLE payday_participants AS
-    SELECT id
-         , username
-         , claimed_time
-         , balance AS old_balance
-         , balance AS new_balance
-         , is_suspicious
+CREATE UNLOGGED TABLE payday_participants AS
+    WITH credit_cards AS (
+             SELECT participant
+               FROM ( SELECT DISTINCT ON (participant) participant, error
+                        FROM exchange_routes
+                       WHERE network = 'braintree-cc'
+                    ORDER BY participant, id DESC
+                    ) r
+              WHERE error = ''
+         )
+    SELECT p.id
+         , p.username
+         , p.claimed_time
+         , p.balance AS old_balance
+         , p.balance AS new_balance
+         , p.is_suspicious
          , false AS card_hold_ok
-         , ( SELECT count(*)
-               FROM current_exchange_routes r
-              WHERE r.participant = p.id
-                AND network = 'braintree-cc'
-                AND error = ''
-           ) > 0 AS has_credit_card
-          , braintree_customer_id
+         , cc.participant IS NOT NULL AS has_credit_card
+         , p.braintree_customer_id
+         , 0::numeric(35,2) AS giving_today
       FROM participants p
-     WHERE is_suspicious IS NOT true
-       AND claimed_time < (SELECT ts_start FROM current_payday())
-  ORDER BY claimed_time;
+ LEFT JOIN credit_cards cc ON cc.participant = p.id
+     WHERE p.is_suspicious IS NOT true
+       AND p.claimed_time < (SELECT ts_start FROM current_payday())
+  ORDER BY p.claimed_time;
 
 CREATE UNIQUE INDEX ON payday_participants (id);
 CREATE UNIQUE INDEX ON payday_participants (username);
+ANALYZE payday_participants;
 
 DROP TABLE IF EXISTS payday_teams;
-CREATE TABLE payday_teams AS
+CREATE UNLOGGED TABLE payday_teams AS
+    WITH paypal_accounts AS (
+             SELECT participant
+               FROM ( SELECT DISTINCT ON (participant) participant, error
+                        FROM exchange_routes
+                       WHERE network = 'paypal'
+                    ORDER BY participant, id DESC
+                    ) r
+              WHERE error = ''
+         )
     SELECT t.id
-         , slug
-         , owner
+         , t.slug
+         , t.owner
          , 0::numeric(35, 2) AS balance
          , false AS is_drained
       FROM teams t
-      JOIN participants p
-        ON t.owner = p.username
+      JOIN participants p ON t.owner = p.username
+      JOIN paypal_accounts pa ON pa.participant = p.id
      WHERE t.is_approved IS true
        AND t.is_closed IS NOT true
        AND p.claimed_time IS NOT null
        AND p.is_closed IS NOT true
        AND p.is_suspicious IS NOT true
-       AND (SELECT count(*)
-              FROM current_exchange_routes er
-             WHERE er.participant = p.id
-               AND network = 'paypal'
-               AND error = ''
-            ) > 0
     ;
 
+CREATE UNIQUE INDEX ON payday_teams (id);
+ANALYZE payday_teams;
+
 DROP TABLE IF EXISTS payday_payments_done;
-CREATE TABLE payday_payments_done AS
+CREATE UNLOGGED TABLE payday_payments_done AS
     SELECT *
       FROM payments p
      WHERE p.timestamp > (SELECT ts_start FROM current_payday());
 
+CREATE INDEX ON payday_payments_done (participant, team) WHERE direction = 'to-team';
+ANALYZE payday_payments_done;
+
 DROP TABLE IF EXISTS payday_payment_instructions;
-CREATE TABLE payday_payment_instructions AS
-    SELECT s.id, participant_id, team_id, amount, due
+CREATE UNLOGGED TABLE payday_payment_instructions AS
+    SELECT s.id, s.participant_id, s.team_id, s.amount, s.due, NULL::boolean AS is_funded
       FROM ( SELECT DISTINCT ON (participant_id, team_id) *
                FROM payment_instructions
               WHERE mtime < (SELECT ts_start FROM current_payday())
@@ -63,36 +91,34 @@ CREATE TABLE payday_payment_instructions AS
            ) s
       JOIN payday_participants p ON p.id = s.participant_id
       JOIN payday_teams t ON t.id = s.team_id
+ LEFT JOIN payday_payments_done done ON done.participant = p.username
+                                    AND done.team = t.slug
+                                    AND done.direction = 'to-team'
      WHERE s.amount > 0
-       AND ( SELECT id
-               FROM payday_payments_done done
-              WHERE p.username = done.participant
-                AND t.slug = done.team
-                AND direction = 'to-team'
-           ) IS NULL
+       AND done.id IS NULL
   ORDER BY p.claimed_time ASC, s.ctime ASC;
 
 CREATE INDEX ON payday_payment_instructions (participant_id);
 CREATE INDEX ON payday_payment_instructions (team_id);
-ALTER TABLE payday_payment_instructions ADD COLUMN is_funded boolean;
+ANALYZE payday_payment_instructions;
 
-ALTER TABLE payday_participants ADD COLUMN giving_today numeric(35,2);
 UPDATE payday_participants pp
-   SET giving_today = COALESCE((
-           SELECT sum(amount + due)
-             FROM payday_payment_instructions
-            WHERE participant_id = pp.id
-       ), 0);
+   SET giving_today = g.giving_today
+  FROM ( SELECT participant_id, sum(amount + due) AS giving_today
+           FROM payday_payment_instructions
+       GROUP BY participant_id
+       ) g
+ WHERE pp.id = g.participant_id;
 
 DROP TABLE IF EXISTS payday_takes;
-CREATE TABLE payday_takes
+CREATE UNLOGGED TABLE payday_takes
 ( team text
 , member text
 , amount numeric(35,2)
  );
 
 DROP TABLE IF EXISTS payday_payments;
-CREATE TABLE payday_payments
+CREATE UNLOGGED TABLE payday_payments
 ( timestamp timestamptz         DEFAULT now()
 , participant text              NOT NULL
 , team text                     NOT NULL
@@ -247,3 +273,8 @@ CREATE TRIGGER process_draw BEFORE UPDATE OF is_drained ON payday_teams
     FOR EACH ROW
     WHEN (NEW.is_drained IS true AND OLD.is_drained IS NOT true)
     EXECUTE PROCEDURE process_draw();
+
+
+-- Mark the snapshot as complete
+
+INSERT INTO payday_snapshot (payday) SELECT id FROM current_payday();
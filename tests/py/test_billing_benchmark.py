@@ -0,0 +1,65 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+
+import pytest
+
+from gratipay.billing.benchmark import (
+    bench_payday, bench_prepare, fingerprint, populate, start_payday
+)
+from gratipay.billing.payday import PAYDAY, Payday
+from gratipay.models import check_db
+from gratipay.testing import Harness
+
+
+class TestBenchmark(Harness):
+
+    def test_populate_loads_synthetic_data(self):
+        with self.db.get_connection() as connection:
+            cursor = connection.cursor()
+            counts = populate(cursor, 200)
+            assert counts['participants'] == 200
+            assert counts['teams'] == 2
+            assert cursor.one("SELECT count(*) FROM payment_instructions") \
+                == counts['payment_instructions'] > 0
+
+    def test_populate_passes_check_db(self):
+        with self.db.get_connection() as connection:
+            cursor = connection.cursor()
+            counts = populate(cursor, 200)
+            assert counts['elsewhere'] == 200
+            assert counts['exchanges'] > 0
+            check_db(cursor)
+
+    def test_populate_is_repeatable(self):
+        digests = []
+        for i in range(2):
+            with self.db.get_connection() as connection:
+                cursor = connection.cursor()
+                populate(cursor, 50, seed=42)
+                start_payday(cursor)
+                cursor.run(PAYDAY)
+                digests.append(fingerprint(cursor))
+        assert digests[0] == digests[1]
+
+    def test_bench_prepare_builds_the_same_snapshot_as_the_legacy_script(self):
+        report = bench_prepare(self.db, 300, repeat=1)
+        assert report['same_snapshot']
+        assert len(report['runs']['current']) == len(report['runs']['legacy']) == 1
+        assert self.db.one("SELECT count(*) FROM participants") == 0
+        assert self.db.one("SELECT count(*) FROM paydays") == 0
+
+    def test_bench_payday_times_each_stage(self):
+        report = bench_payday(self.db, 40, threads=2)
+        names = [s['name'] for s in report['stages']]
+        assert names[:len(Payday.PAYIN_STAGES)] == ['payin_' + s for s in Payday.PAYIN_STAGES]
+        assert names[-3:] == ['update_stats', 'end', 'notify_participants']
+        assert report['braintree_calls']['POST transactions'] > 0
+        assert report['payday']['nusers'] > 0
+        assert self.db.one("SELECT count(*) FROM paydays WHERE ts_end > ts_start") == 1
+        json.dumps(report)
+
+    def test_bench_payday_wants_an_empty_database(self):
+        self.make_participant('alice')
+        with pytest.raises(Exception):
+            bench_payday(self.db, 10)
@@ -0,0 +1,224 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from decimal import Decimal as D
+from multiprocessing.dummy import Pool as ThreadPool
+
+import braintree
+import mock
+import pytest
+from braintree.exceptions import DownForMaintenanceError, UnexpectedError
+
+from gratipay.billing.exchanges import (
+    cancel_card_hold, create_card_hold, get_open_card_holds, journal_card_hold
+)
+from gratipay.billing.executor import Executor, Throttle, is_throttling_error
+from gratipay.billing.payday import Payday
+from gratipay.models.participant import Participant
+from gratipay.testing import Foobar, Harness
+from gratipay.testing.fake_braintree import FakeBraintree
+from gratipay.utils.histogram import Histogram
+
+
+def rate_limited():
+    return UnexpectedError("Unexpected HTTP_RESPONSE 429")
+
+
+class Flaky(object):
+    """A callable that fails ``n`` times before it succeeds.
+    """
+
+    def __init__(self, n, error=rate_limited):
+        self.n = n
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.n:
+            raise self.error()
+        return 'done'
+
+
+class TestThrottle(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.sleeps = []
+        self.throttle = Throttle(retries=3, backoff=1, max_backoff=4, sleep=self.sleeps.append)
+
+    def test_is_throttling_error_recognizes_429_and_503(self):
+        assert is_throttling_error(DownForMaintenanceError())
+        assert is_throttling_error(UnexpectedError("Unexpected HTTP_RESPONSE 429"))
+        assert not is_throttling_error(UnexpectedError("Unexpected HTTP_RESPONSE 418"))
+        assert not is_throttling_error(Foobar())
+
+    def test_throttle_retries_throttled_calls(self):
+        func = Flaky(2)
+        assert self.throttle('test', func) == 'done'
+        assert func.calls == 3
+        assert self.sleeps == [1, 2]
+        assert self.throttle.nthrottled == 2
+
+    def test_throttle_backs_off_up_to_a_maximum(self):
+        func = Flaky(3)
+        self.throttle.delay = 2
+        self.throttle('test', func)
+        assert self.sleeps == [2, 4, 4, 4]
+
+    def test_throttle_speeds_up_again_after_successes(self):
+        self.throttle.delay = 4
+        self.throttle('test', lambda: None)
+        self.throttle('test', lambda: None)
+        assert self.throttle.delay == 1
+
+    def test_throttle_gives_up_eventually(self):
+        func = Flaky(4)
+        with pytest.raises(UnexpectedError):
+            self.throttle('test', func)
+        assert func.calls == 4
+
+    def test_throttle_only_retries_idempotent_calls_after_a_503(self):
+        sale = Flaky(1, DownForMaintenanceError)
+        void = Flaky(1, DownForMaintenanceError)
+        with pytest.raises(DownForMaintenanceError):
+            self.throttle('sale', sale)
+        assert self.throttle('void', void) == 'done'
+        assert (sale.calls, void.calls) == (1, 2)
+        assert self.throttle.nthrottled == 2
+
+    def test_throttle_does_not_retry_other_errors(self):
+        func = Flaky(1, Foobar)
+        with pytest.raises(Foobar):
+            self.throttle('test', func)
+        assert func.calls == 1
+        assert self.sleeps == []
+
+    def test_throttle_records_latencies(self):
+        self.throttle('test', lambda: None)
+        assert self.throttle.histograms['test'].n == 1
+
+    def test_throttle_records_latencies_from_many_threads(self):
+        pool = ThreadPool(8)
+        try:
+            pool.map(lambda i: self.throttle('test-%i' % (i % 3), lambda: None), range(300))
+        finally:
+            pool.close()
+        assert sorted(self.throttle.histograms) == ['test-0', 'test-1', 'test-2']
+        assert sum(h.n for h in self.throttle.histograms.values()) == 300
+
+
+class TestExecutor(Harness):
+
+    def test_executor_maps_in_order(self):
+        assert Executor(threads=3).map('test', lambda x: x * 2, range(10)) == list(range(0, 20, 2))
+
+    def test_executor_runs_everything_before_raising(self):
+        seen = []
+        def f(x):
+            seen.append(x)
+            if x % 2:
+                raise Foobar
+        with pytest.raises(Foobar):
+            Executor(threads=2).map('test', f, range(6))
+        assert sorted(seen) == list(range(6))
+
+    def test_histogram_percentiles(self):
+        h = Histogram()
+        for ms in [1] * 90 + [150] * 9 + [4000]:
+            h.add(ms)
+        assert h.percentile(50) == 1
+        assert h.percentile(90) == 1
+        assert h.percentile(99) == 200
+        assert h.percentile(100) == 4000
+        assert h.to_dict()['n'] == 100
+
+
+class TestFakeBraintree(Harness):
+
+    def make_payer(self, username='alice'):
+        alice = self.make_participant(username, claimed_time='now', is_suspicious=False,
+                                      braintree_customer_id='fake-customer')
+        self.db.run("""
+            INSERT INTO exchange_routes (participant, network, address, error)
+                 VALUES (%s, 'braintree-cc', 'fake-token', '')
+        """, (alice.id,))
+        return Participant.from_username(username)
+
+    def test_card_holds_survive_injected_errors(self):
+        alice = self.make_payer()
+        with FakeBraintree(error_rate=0.5, errors=(429, 503), seed=42) as bt:
+            hold, error = create_card_hold(self.db, alice, D('20.00'))
+            assert error == ''
+            assert hold.status == 'authorized'
+            cancel_card_hold(hold, self.db)
+        assert bt.transactions[hold.id]['status'] == 'voided'
+        assert sum(bt.calls.values()) > 2
+
+    def test_open_card_holds_are_picked_up_from_the_journal(self):
+        alice = self.make_payer()
+        bob = self.make_payer('bob')
+        payday_id = self.db.one("INSERT INTO paydays DEFAULT VALUES RETURNING id")
+        with FakeBraintree() as bt:
+            a, error = create_card_hold(self.db, alice, D('20.00'))
+            b, error = create_card_hold(self.db, bob, D('20.00'))
+            cancel_card_hold(b, self.db)
+        holds = get_open_card_holds(self.db, payday_id)
+        assert list(holds) == [alice.id]
+        assert holds[alice.id].id == a.id
+        assert holds[alice.id].amount == D(bt.transactions[a.id]['amount'])
+        assert get_open_card_holds(self.db, payday_id + 1) is None
+
+    def test_payday_resumes_with_journaled_holds(self):
+        alice = self.make_payer()
+        team = self.make_team(is_approved=True)
+        alice.set_payment_instruction(team, '20.00')
+        Payday.start()
+        with FakeBraintree() as bt:
+            stale = braintree.Transaction(None, bt.add_hold(alice.id, '10.00'))
+            journal_card_hold(self.db, 'reuse', alice.id, stale)
+            Payday.start().run()
+        assert bt.transactions[stale.id]['status'] == 'voided'
+        assert Participant.from_username('alice').balance == 0
+
+    def test_payday_resumes_with_holds_it_did_not_journal(self):
+        alice = self.make_payer()
+        bob = self.make_payer('bob')
+        team = self.make_team(is_approved=True)
+        alice.set_payment_instruction(team, '20.00')
+        bob.set_payment_instruction(team, '20.00')
+        payday = Payday.start()
+        with FakeBraintree() as bt:
+            journaled = braintree.Transaction(None, bt.add_hold(alice.id, '21.00'))
+            journal_card_hold(self.db, 'hold', alice.id, journaled)
+            duplicate = bt.add_hold(alice.id, '21.00')['id']
+            unjournaled = bt.add_hold(bob.id, '21.00')['id']  # we crashed before journaling it
+            with self.db.get_cursor() as cursor:
+                payday.prepare(cursor)
+                holds = payday.create_card_holds(cursor)
+        assert holds[alice.id].id == journaled.id
+        assert holds[bob.id].id == unjournaled
+        assert bt.transactions[duplicate]['status'] == 'voided'
+        assert bt.calls['POST transactions'] == 0
+
+    def test_payday_reconciles_existing_holds_page_by_page(self):
+        alice = self.make_payer()
+        bob = self.make_payer('bob')
+        carl = self.make_payer('carl')
+        team = self.make_team(is_approved=True)
+        alice.set_payment_instruction(team, '20.00')
+        bob.set_payment_instruction(team, '20.00')
+        with FakeBraintree() as bt:
+            # Not in the journal, like holds made before it existed.
+            reusable = braintree.Transaction(None, bt.add_hold(alice.id, '21.00'))
+            stale = [bt.add_hold(carl.id, '10.00')['id'] for i in range(3)]
+            payday = Payday.start()
+            with mock.patch.object(Payday, 'HOLDS_PAGE_SIZE', 2):
+                with self.db.get_cursor() as cursor:
+                    payday.prepare(cursor)
+                    holds = payday.create_card_holds(cursor)
+        assert sorted(holds) == [alice.id, bob.id]
+        assert holds[alice.id].id == reusable.id
+        assert bt.calls['POST transactions'] == 1  # a new hold for bob only
+        assert [bt.transactions[i]['status'] for i in stale] == ['voided'] * 3
+        recorded = self.db.all("SELECT participant_id, reused FROM braintree_holds")
+        assert sorted(recorded) == [(alice.id, True)] + [(carl.id, False)] * 3
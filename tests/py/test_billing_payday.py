@@ -11,10 +11,12 @@ import pytest
 from gratipay.billing.exchanges import create_card_hold, MINIMUM_CHARGE
 from gratipay.billing.payday import NoPayday, Payday
 from gratipay.exceptions import NegativeBalance
+from gratipay.models import check_db
 from gratipay.models.participant import Participant
 from gratipay.testing import Foobar
 from gratipay.testing.billing import BillingHarness
 from gratipay.testing.emails import EmailHarness
+from gratipay.utils.emails import decode_context
 
 
 class TestPayday(BillingHarness):
@@ -186,6 +188,47 @@ class TestPayday(BillingHarness):
         nusers = self.db.one("SELECT nusers FROM paydays")
         assert nusers == 1
 
+    @mock.patch.object(Payday, 'fetch_card_holds')
+    def test_stats_recorded_during_payin_match_a_full_scan(self, fch):
+        Enterprise = self.make_team(is_approved=True)
+        team = self.make_team('Gratiteam', owner=self.homer, is_approved=True)
+        self.obama.set_payment_instruction(Enterprise, '6.00')  # below MINIMUM_CHARGE
+        self.make_exchange('balanced-cc', 10, 0, self.roman)
+        self.roman.set_payment_instruction(team, '1.00')
+        fch.return_value = {}
+        payday = Payday.start()
+        payday.payin()
+        with self.db.get_cursor() as cursor:
+            recorded = payday.get_recorded_stats(cursor)
+            assert recorded == payday.scan_stats(cursor)
+        assert recorded[1:] == (2, D('1.00'))
+
+    @mock.patch.object(Payday, 'fetch_card_holds')
+    def test_update_stats_falls_back_to_a_full_scan(self, fch):
+        Enterprise = self.make_team(is_approved=True)
+        self.obama.set_payment_instruction(Enterprise, '6.00')
+        fch.return_value = {}
+        payday = Payday.start()
+        payday.payin()
+        self.db.run("DELETE FROM payday_stats")
+        payday.update_stats()
+        assert self.fetch_payday()['nusers'] == 1
+
+    @mock.patch.object(Payday, 'fetch_card_holds')
+    def test_verify_stats_prefers_the_full_scan(self, fch):
+        Enterprise = self.make_team(is_approved=True)
+        self.obama.set_payment_instruction(Enterprise, '6.00')
+        fch.return_value = {}
+        payday = Payday.start()
+        payday.payin()
+        self.db.run("""
+            INSERT INTO payday_stats (payday, participant_id, team_id, amount, direction)
+                 VALUES (%s, %s, %s, 0, 'to-team')
+        """, (payday.id, self.homer.id, Enterprise.id))
+        with mock.patch.object(Payday, 'verify_stats', True):
+            payday.update_stats()
+        assert self.fetch_payday()['nusers'] == 1
+
     @pytest.mark.xfail(reason="haven't migrated transfer_takes yet")
     @mock.patch.object(Payday, 'fetch_card_holds')
     @mock.patch('gratipay.billing.payday.create_card_hold')
@@ -373,6 +416,31 @@ class TestPayin(BillingHarness):
             assert holds[self.obama.id] is fake_hold
             assert hold.status == 'voided'
 
+    @mock.patch.object(Payday, 'fetch_card_holds')
+    def test_payin_resumes_after_the_last_checkpoint(self, fch):
+        fch.return_value = {}
+        team = self.make_team(is_approved=True)
+        alice = self.make_participant('alice', claimed_time='now')
+        self.make_exchange('balanced-cc', 20, 0, alice)
+        alice.set_payment_instruction(team, '5.00')
+
+        with mock.patch.object(Payday, 'process_draws') as process_draws:
+            process_draws.side_effect = Foobar
+            with self.assertRaises(Foobar):
+                Payday.start().payin()
+        assert self.db.one("SELECT payin_stage FROM paydays") == 3
+        assert self.db.one("SELECT count(*) FROM payday_payments") == 1
+
+        with mock.patch.object(Payday, 'prepare') as prepare:
+            payday = Payday.start()
+            assert payday.payin_stage == 3
+            payday.payin()
+            assert not prepare.called
+        assert self.db.one("SELECT payin_stage FROM paydays") == len(Payday.PAYIN_STAGES)
+        assert Participant.from_username('alice').balance == D('15.00')
+        assert Participant.from_username('picard').balance == D('5.00')
+        assert self.db.one("SELECT count(*) FROM payments") == 2
+
     @pytest.mark.xfail(reason="Don't think we'll need this anymore since we aren't using balanced, "
                               "leaving it here till I'm sure.")
     @mock.patch('gratipay.billing.payday.CardHold')
@@ -492,6 +560,73 @@ class TestPayin(BillingHarness):
             else:
                 assert p.balance == 0
 
+    def run_engine(self, engine):
+        payday = Payday.start(engine=engine)
+        out = {}
+        try:
+            with self.db.get_cursor() as cursor:
+                payday.prepare(cursor)
+                cursor.run("UPDATE payday_participants SET card_hold_ok=true "
+                           "WHERE username='bob'")
+                payday.process_payment_instructions(cursor)
+                check_db(cursor)
+                out['participants'] = cursor.all("SELECT username, new_balance "
+                                                 "FROM payday_participants ORDER BY id")
+                out['teams'] = cursor.all("SELECT slug, balance FROM payday_teams ORDER BY id")
+                out['payments'] = sorted(cursor.all("SELECT participant, team, amount, direction "
+                                                    "FROM payday_payments"))
+                out['dues'] = cursor.all("SELECT participant_id, team_id, due "
+                                         "FROM current_payment_instructions "
+                                         "ORDER BY participant_id, team_id")
+                out['events'] = [e.payload for e in cursor.all("SELECT payload FROM events "
+                                                               "WHERE type='payday' ORDER BY id")]
+                raise Foobar
+        except Foobar:
+            pass
+        return out
+
+    def test_bulk_engine_matches_trigger_engine(self):
+        alice = self.make_participant('alice', claimed_time='now', balance=10)
+        bob = self.make_participant('bob', claimed_time='now')
+        carl = self.make_participant('carl', claimed_time='now', balance=100)
+        Enterprise = self.make_team('The Enterprise', 'picard', is_approved=True)
+        Trident = self.make_team('The Trident', 'shelby', is_approved=True)
+        Stargazer = self.make_team('The Stargazer', 'data', is_approved=True)
+        alice.set_payment_instruction(Enterprise, '6.00')
+        alice.set_payment_instruction(Trident, '5.00')      # doesn't fit, skipped
+        alice.set_payment_instruction(Stargazer, '3.00')    # fits again
+        self.obama.set_payment_instruction(Enterprise, '4.00')  # parked as due
+        bob.set_payment_instruction(Trident, '20.00')       # covered by a card hold
+        carl.set_payment_instruction(Enterprise, '1.00')
+        carl.set_payment_instruction(Stargazer, '2.00')
+
+        trigger = self.run_engine('trigger')
+        self.db.self_check()
+        bulk = self.run_engine('bulk')
+        self.db.self_check()
+
+        assert bulk == trigger
+        assert dict(trigger['participants'])['alice'] == D('1.00')
+        assert dict(trigger['teams'])['TheTrident'] == D('20.00')
+        assert self.db.one("SELECT count(*) FROM events") == 0  # rolled back
+
+    def test_start_rejects_unknown_engines(self):
+        with self.assertRaises(ValueError):
+            Payday.start(engine='warp')
+
+    @mock.patch.object(Payday, 'fetch_card_holds')
+    def test_payday_moves_money_with_bulk_engine(self, fch):
+        Enterprise = self.make_team(is_approved=True)
+        self.obama.set_payment_instruction(Enterprise, '5.00')
+        self.db.run("UPDATE payment_instructions SET due = '5.00'")
+
+        fch.return_value = {}
+        Payday.start(engine='bulk').run()
+
+        assert Participant.from_username('picard').balance == D('10.00')
+        assert Participant.from_username('obama').balance == D('0.00')
+        assert self.obama.get_due(Enterprise) == D('0.00')
+
     def test_process_draws(self):
         alice = self.make_participant('alice', claimed_time='now', balance=1)
         picard = self.make_participant('picard', claimed_time='now', last_paypal_result='')
@@ -551,6 +686,36 @@ class TestPayin(BillingHarness):
         assert Participant.from_id(bruce.id).balance == 0
         assert Participant.from_id(billy.id).balance == 18
 
+    def make_absorption_chain(self, usernames):
+        for archived, absorber in zip(usernames, usernames[1:]):
+            self.db.run("""
+                INSERT INTO absorptions (absorbed_was, absorbed_by, archived_as)
+                     VALUES (%s, %s, %s)
+            """, (archived, absorber, archived))
+
+    def test_take_over_balances_follows_deep_chains(self):
+        usernames = ['link-%i' % i for i in range(20)]
+        for username in usernames[:-1]:
+            self.make_participant(username, balance=1)
+        last = self.make_participant(usernames[-1], balance=0)
+        self.make_absorption_chain(usernames)
+        Payday.start().take_over_balances()
+        assert Participant.from_id(last.id).balance == 19
+        assert self.db.one("SELECT sum(balance) FROM participants "
+                           "WHERE username <> %s", (last.username,)) == 0
+        transfers = self.db.all("SELECT tipper, tippee FROM transfers "
+                                "WHERE context = 'take-over'")
+        assert sorted(transfers) == sorted((u, last.username) for u in usernames[:-1])
+
+    def test_take_over_balances_refuses_cycles(self):
+        self.make_participant('alice', balance=10)
+        self.make_participant('bob', balance=0)
+        self.make_absorption_chain(['alice', 'bob', 'alice'])
+        with pytest.raises(Exception) as e:
+            Payday.start().take_over_balances()
+        assert e.value.args[0] == 'absorption cycle involving alice'
+        assert Participant.from_username('alice').balance == 10
+
     @mock.patch.object(Payday, 'fetch_card_holds')
     @mock.patch('gratipay.billing.payday.capture_card_hold')
     def test_payin_dumps_transfers_for_debugging(self, cch, fch):
@@ -590,3 +755,27 @@ class TestNotifyParticipants(EmailHarness):
             assert self.get_last_email()['to'] == 'kalel <kalel@example.net>'
             assert 'Gratiteam' in self.get_last_email()['body_text']
             assert 'Gratiteam' in self.get_last_email()['body_html']
+
+    def test_it_notifies_many_participants_at_once(self):
+        enterprise = self.make_team('The Enterprise', is_approved=True)
+        gratiteam = self.make_team('Gratiteam', owner='gratiowner', is_approved=True)
+        kalel = self.make_participant('kalel', claimed_time='now', notify_charge=3)
+        lex = self.make_participant('lex', claimed_time='now', notify_charge=2)
+        mxy = self.make_participant('mxy', claimed_time='now', notify_charge=0)
+        kalel.set_payment_instruction(enterprise, 10)
+        kalel.set_payment_instruction(gratiteam, 20)
+        lex.set_payment_instruction(enterprise, 10)
+
+        payday = Payday.start()
+        self.make_exchange('balanced-cc', 30, 0, kalel, 'succeeded')
+        self.make_exchange('balanced-cc', 10, 0, lex, 'failed')  # lex opted out of these
+        self.make_exchange('balanced-cc', 10, 0, mxy, 'succeeded')
+        payday.end()
+        payday.notify_participants()
+
+        queued = self.db.all("SELECT participant, spt_name, context FROM email_queue")
+        assert [(q.participant, q.spt_name) for q in queued] == [(kalel.id, 'charge_succeeded')]
+        context = decode_context(queued[0].context)
+        assert context['nteams'] == 2
+        assert context['top_team'] == 'Gratiteam'
+        assert context['exchange']['amount'] == 30
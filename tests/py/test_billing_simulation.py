@@ -0,0 +1,59 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from decimal import Decimal as D
+import json
+
+import pytest
+
+from gratipay.billing.exchanges import MINIMUM_CHARGE
+from gratipay.billing.simulation import Simulation
+from gratipay.models.participant import Participant
+from gratipay.testing.billing import BillingHarness
+
+
+class TestSimulation(BillingHarness):
+
+    def simulate(self, **kw):
+        return Simulation(self.db, **kw).run()
+
+    def test_simulation_reports_every_stage(self):
+        report = self.simulate()
+        assert [s['name'] for s in report['stages']] == list(Simulation.STAGES)
+        for stage in report['stages']:
+            assert stage['wall_time'] >= stage['sql_time'] >= 0
+            assert stage['peak_memory'] > 0
+        json.dumps(report)  # machine-readable
+
+    def test_simulation_leaves_no_trace(self):
+        alice = self.make_participant('alice', claimed_time='now', balance=20)
+        Enterprise = self.make_team(is_approved=True)
+        alice.set_payment_instruction(Enterprise, '5.00')
+        self.obama.set_payment_instruction(Enterprise, MINIMUM_CHARGE)
+
+        report = self.simulate()
+
+        assert report['total']['rows'] > 0
+        assert Participant.from_username('alice').balance == D('20.00')
+        assert Participant.from_username('picard').balance == 0
+        assert self.db.one("SELECT count(*) FROM paydays") == 0
+        assert self.db.one("SELECT count(*) FROM payments") == 0
+        assert self.db.one("SELECT count(*) FROM exchanges") == 0
+        assert self.db.one("SELECT count(*) FROM events WHERE type='payday'") == 0
+
+    def test_simulation_fakes_card_holds(self):
+        Enterprise = self.make_team(is_approved=True)
+        self.obama.set_payment_instruction(Enterprise, MINIMUM_CHARGE)
+        with self.db.get_connection() as connection:
+            cursor = connection.cursor()
+            cursor.run("INSERT INTO paydays DEFAULT VALUES")
+            Simulation(self.db).start(cursor).prepare(cursor)
+            holds = Simulation.create_card_holds(cursor)
+            assert list(holds) == [self.obama.id]
+            assert holds[self.obama.id].amount == D('10.00')
+
+    def test_simulation_supports_the_bulk_engine(self):
+        assert self.simulate(engine='bulk')['engine'] == 'bulk'
+
+    def test_simulation_rejects_unknown_engines(self):
+        with pytest.raises(ValueError):
+            self.simulate(engine='warp')
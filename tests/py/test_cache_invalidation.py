@@ -0,0 +1,118 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import select
+from contextlib import contextmanager
+
+import pytest
+
+from gratipay.models.participant import Participant
+from gratipay.models.team import Team
+from gratipay.testing import Foobar, Harness
+from gratipay.utils.cache_invalidation import CHANNEL, Listener, publish
+
+
+class TestCacheInvalidation(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.listener = Listener(self.db)
+        self.heard = []
+
+    def tearDown(self):
+        Participant.publish_changes = Team.publish_changes = False
+        Harness.tearDown(self)
+
+    @contextmanager
+    def notifications(self):
+        """Collect the payloads published while we're in a ``with`` block.
+        """
+        with self.db.get_connection() as conn:
+            conn.autocommit = True
+            conn.cursor().execute("LISTEN " + CHANNEL)
+            payloads = []
+            yield payloads
+            select.select([conn], [], [], 0.5)
+            conn.poll()
+            payloads.extend(n.payload for n in conn.notifies)
+
+    def test_dispatch_calls_the_handlers_for_a_kind(self):
+        self.listener.subscribe('team', self.heard.append)
+        self.listener.subscribe('participant', lambda id: self.heard.append(-id))
+        self.listener.dispatch('team:7')
+        self.listener.dispatch('participant:42')
+        self.listener.dispatch('unknown:1')
+        assert self.heard == [7, -42]
+
+    def test_caches_are_cleared_once_we_listen_again(self):
+        start = self.db.one("SELECT clock_timestamp()")
+        def clear(id):
+            self.heard.append(self.db.one("""
+                SELECT count(*)
+                  FROM pg_stat_activity
+                 WHERE query = %s
+                   AND state_change > %s
+            """, ("LISTEN " + CHANNEL, start)))
+            raise Foobar
+        self.listener.subscribe('*', clear)
+        with pytest.raises(Foobar):
+            self.listener.listen(reconnecting=True)
+        assert self.heard == [1]
+
+    def test_publish_notifies_listeners_when_the_transaction_commits(self):
+        with self.notifications() as payloads:
+            publish(self.db, 'team', 7)
+        assert payloads == ['team:7']
+
+    def test_nothing_is_published_when_the_transaction_is_rolled_back(self):
+        with self.notifications() as payloads:
+            try:
+                with self.db.get_cursor() as cursor:
+                    publish(cursor, 'team', 7)
+                    raise ZeroDivisionError
+            except ZeroDivisionError:
+                pass
+        assert payloads == []
+
+    def test_participants_publish_their_changes(self):
+        alice = self.make_participant('alice')
+        Participant.publish_changes = True
+        with self.notifications() as payloads:
+            alice.update_session('deadbeef', alice.session_expires)
+        assert payloads == ['participant:%i' % alice.id]
+
+    def test_teams_publish_their_changes(self):
+        team = self.make_team()
+        Team.publish_changes = True
+        with self.notifications() as payloads:
+            team.update(name='New Name')
+        assert payloads == ['team:%i' % team.id]
+
+    def test_participant_changes_that_are_rolled_back_are_not_published(self):
+        alice = self.make_participant('alice')
+        Participant.publish_changes = True
+        with self.notifications() as payloads:
+            try:
+                with self.db.get_cursor() as cursor:
+                    alice.update_is_free_rider(True, cursor)
+                    raise ZeroDivisionError
+            except ZeroDivisionError:
+                pass
+        assert payloads == []
+
+    def test_team_changes_that_are_rolled_back_are_not_published(self):
+        team = self.make_team()
+        Team.publish_changes = True
+        with self.notifications() as payloads:
+            try:
+                with self.db.get_cursor() as cursor:
+                    team.update_receiving(cursor)
+                    raise ZeroDivisionError
+            except ZeroDivisionError:
+                pass
+        assert payloads == []
+
+    def test_nothing_is_published_by_default(self):
+        alice = self.make_participant('alice')
+        with self.notifications() as payloads:
+            alice.update_session('deadbeef', alice.session_expires)
+        assert payloads == []
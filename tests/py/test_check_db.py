@@ -0,0 +1,117 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from decimal import Decimal as D
+
+import pytest
+
+from gratipay.models import check_db
+from gratipay.testing import Harness
+from gratipay.utils import query_log
+
+
+class TestLedger(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.alice = self.make_participant('alice', claimed_time='now')
+        self.make_exchange('balanced-cc', 50, 0, self.alice)
+
+    def ledger(self, username='alice'):
+        return self.db.one("SELECT expected, dirty FROM participant_ledger "
+                           "WHERE participant = %s", (username,), back_as=dict)
+
+    def test_exchanges_go_into_the_ledger(self):
+        assert self.ledger() == {'expected': D('50.00'), 'dirty': True}
+
+    def test_failed_exchanges_dont_count(self):
+        self.make_exchange('balanced-cc', 20, 0, self.alice, status='failed')
+        assert self.ledger()['expected'] == D('50.00')
+
+    def test_transfers_go_into_the_ledger(self):
+        bob = self.make_participant('bob', claimed_time='now')
+        self.db.run("""
+            INSERT INTO transfers (tipper, tippee, amount, context)
+                 VALUES ('alice', 'bob', 10, 'tip');
+            UPDATE participants SET balance = balance - 10 WHERE username = 'alice';
+            UPDATE participants SET balance = balance + 10 WHERE username = 'bob';
+        """)
+        assert self.ledger()['expected'] == D('40.00')
+        assert self.ledger(bob.username)['expected'] == D('10.00')
+        self.db.self_check()
+
+    def test_payments_go_into_both_ledgers(self):
+        team = self.make_team(is_approved=True)
+        self.db.run("""
+            INSERT INTO payments (participant, team, amount, direction)
+                 VALUES ('alice', %s, 5, 'to-team');
+        """, (team.slug,))
+        assert self.ledger()['expected'] == D('45.00')
+        assert self.db.one("SELECT balance FROM team_ledger") == D('5.00')
+
+    def test_renaming_a_participant_keeps_the_ledger(self):
+        self.alice.change_username('alicia')
+        assert self.ledger('alicia')['expected'] == D('50.00')
+        self.db.self_check()
+        self.db.audit()
+
+
+class TestCheckDB(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.alice = self.make_participant('alice', claimed_time='now')
+        self.make_exchange('balanced-cc', 50, 0, self.alice)
+
+    def test_self_check_passes(self):
+        self.db.self_check()
+        self.db.audit()
+
+    def test_self_check_only_looks_at_what_changed(self):
+        self.db.self_check()
+        assert self.db.one("SELECT count(*) FROM participant_ledger WHERE dirty") == 0
+        self.db.run("UPDATE participant_ledger SET expected = 0")  # bypasses the triggers
+        self.db.self_check()
+        with pytest.raises(AssertionError):
+            self.db.audit()
+
+    def test_self_check_catches_balance_changes(self):
+        self.db.self_check()
+        self.db.run("UPDATE participants SET balance = 100 WHERE username = 'alice'")
+        with pytest.raises(AssertionError):
+            self.db.self_check()
+        # The check was rolled back, so it's still pending.
+        with pytest.raises(AssertionError):
+            self.db.self_check()
+
+    def test_self_check_only_reads_when_nothing_changed(self):
+        self.db.self_check()
+        with query_log.recording() as log:
+            self.db.self_check()
+        assert not [sql for sql, ms in log.queries if 'UPDATE' in sql]
+
+    def test_self_check_keeps_flags_set_while_it_fails(self):
+        self.db.run("UPDATE participants SET balance = 100 WHERE username = 'alice'")
+        with self.db.get_cursor() as cursor:
+            with pytest.raises(AssertionError):
+                check_db(cursor)
+            assert cursor.one("SELECT dirty FROM participant_ledger") is True
+
+    def test_audit_catches_balances_without_a_ledger(self):
+        bob = self.make_participant('bob', claimed_time='now')
+        self.db.run("UPDATE participants SET balance = 10 WHERE username = 'bob'")
+        assert self.db.one("SELECT count(*) FROM participant_ledger "
+                           "WHERE participant = 'bob'") == 0
+        self.db.self_check()  # doesn't scan all participants
+        with pytest.raises(AssertionError) as e:
+            self.db.audit()
+        assert bob.username in str(e.value)
+
+    def test_self_check_catches_team_balances(self):
+        team = self.make_team(is_approved=True)
+        self.db.run("""
+            INSERT INTO payments (participant, team, amount, direction)
+                 VALUES ('alice', %s, 5, 'to-team');
+            UPDATE participants SET balance = balance - 5 WHERE username = 'alice';
+        """, (team.slug,))
+        with pytest.raises(AssertionError):
+            self.db.self_check()
@@ -0,0 +1,64 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+from glob import glob
+from tempfile import mkdtemp
+
+import mock
+
+from gratipay.testing import Harness
+from gratipay.wireup import compile_assets
+
+
+class TestCompileAssets(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.website = self.client.website
+        self.cache_dir = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        Harness.tearDown(self)
+
+    def compile(self, asset_url='/assets/'):
+        compile_assets(self.website, self.cache_dir, asset_url)
+        return sorted(os.listdir(self.cache_dir))
+
+    def test_compiled_assets_are_cached(self):
+        cached = self.compile()
+        assert [name.split('-', 1)[1] for name in cached] == ['assets_gratipay.css',
+                                                             'assets_gratipay.js']
+        with open(os.path.join(self.cache_dir, cached[0])) as f:
+            css = f.read()
+        with open(self.website.www_root + '/assets/gratipay.css') as f:
+            assert f.read() == css
+
+    def test_cached_assets_are_reused(self):
+        self.compile()
+        with mock.patch('gratipay.wireup.Client') as Client:
+            self.compile()
+        assert not Client.called
+
+    def test_changing_a_setting_replaces_cached_assets(self):
+        before = self.compile()
+        after = self.compile(asset_url='https://assets.example.com/')
+        assert len(after) == 2
+        assert not set(before) & set(after)
+
+    def test_pruning_leaves_other_assets_alone(self):
+        assets = self.website.www_root + '/assets/'
+        with open(assets + 'foo-bar.css.spt', 'w') as f:
+            f.write('[---]\n[---] text/css via scss\na { color: red; }\n')
+        stale = os.path.join(self.cache_dir, 'deadbeef-assets_foo-bar.css')
+        other = os.path.join(self.cache_dir, 'deadbeef-assets_baz-bar.css')
+        for path in (stale, other):
+            open(path, 'w').close()
+        try:
+            self.compile()
+        finally:
+            for path in glob(assets + 'foo-bar.css*'):
+                os.unlink(path)
+        assert not os.path.exists(stale)
+        assert os.path.exists(other)
@@ -1,13 +1,21 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import json
+import pickle
+import threading
 import time
+from datetime import datetime
+from decimal import Decimal as D
+
+import mock
 
 from gratipay.exceptions import CannotRemovePrimaryEmail, EmailAlreadyTaken, EmailNotVerified
 from gratipay.exceptions import TooManyEmailAddresses, ResendingTooFast
 from gratipay.models.participant import Participant
+from gratipay.testing.email_benchmark import bench_render, make_participants, render_uncached
 from gratipay.testing.emails import EmailHarness
 from gratipay.utils import emails, encode_for_querystring
+from gratipay.utils.email_worker import EmailWorker, TokenBucket, reencode_queue
 
 
 class TestEmail(EmailHarness):
@@ -262,3 +270,169 @@ class TestEmail(EmailHarness):
         Participant.dequeue_emails()
         assert self.mailer.call_count == 0
         assert self.db.one("SELECT spt_name FROM email_queue") is None
+
+    def test_can_queue_emails_in_bulk(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        moe = self.make_participant('moe', email_address='moe@example.com')
+        n = Participant.queue_emails_bulk([ (larry.id, 'verification', {})
+                                          , (moe.id, 'verification', {})
+                                           ])
+        assert n == 2
+        assert self.db.all("SELECT participant FROM email_queue ORDER BY id") == [larry.id, moe.id]
+        Participant.dequeue_emails()
+        assert self.mailer.call_count == 2
+        assert self.db.one("SELECT count(*) FROM email_queue") == 0
+
+    def test_queueing_no_emails_in_bulk_is_a_noop(self):
+        assert Participant.queue_emails_bulk([]) == 0
+
+
+    def test_contexts_survive_encoding(self):
+        context = {'exchange': {'amount': D('10.00'), 'note': 'caf\xe9'}, 'nteams': 2}
+        encoded = emails.encode_context(context)
+        assert encoded.startswith(emails.CONTEXT_VERSION)
+        decoded = emails.decode_context(encoded)
+        assert decoded == context
+        assert type(decoded['exchange']['amount']) is D
+
+    def test_contexts_that_cant_be_encoded_are_refused(self):
+        with self.assertRaises(TypeError):
+            emails.encode_context({'when': datetime(2016, 6, 17)})
+
+    def test_can_queue_emails_in_bulk_with_copy(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        with mock.patch.object(Participant, 'QUEUE_COPY_THRESHOLD', 1):
+            n = Participant.queue_emails_bulk([(larry.id, 'charge_succeeded', {
+                'exchange': {'id': 1, 'amount': D('10.00'), 'fee': D('0.59'), 'note': 'x\\y'},
+                'nteams': 1, 'top_team': 'Gratipay',
+            })] * 3)
+        assert n == 3
+        context = self.db.one("SELECT context FROM email_queue LIMIT 1")
+        assert emails.decode_context(context)['exchange']['note'] == 'x\\y'
+        Participant.dequeue_emails()
+        assert self.mailer.call_count == 3
+
+    def queue_pickled(self, participant, context):
+        self.db.run("""
+            INSERT INTO email_queue (participant, spt_name, context)
+                 VALUES (%s, 'verification', %s)
+        """, (participant.id, bytearray(pickle.dumps(context))))
+
+    def test_pickled_contexts_are_still_dequeued(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        self.queue_pickled(larry, {})
+        Participant.dequeue_emails()
+        assert self.mailer.call_count == 1
+
+    def test_reencode_queue_converts_pickled_contexts(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        self.queue_pickled(larry, {'amount': D('1.00')})
+        self.queue_pickled(larry, {'when': datetime(2016, 6, 17)})
+        larry.queue_email('verification')
+        assert reencode_queue(self.db, batch_size=1) == (1, 1)
+        contexts = self.db.all("SELECT context FROM email_queue ORDER BY id")
+        assert bytes(contexts[0]).startswith(emails.CONTEXT_VERSION)
+        assert emails.decode_context(contexts[0]) == {'amount': D('1.00')}
+        assert not bytes(contexts[1]).startswith(emails.CONTEXT_VERSION)
+
+
+class TestEmailWorker(EmailHarness):
+
+    def queue(self, n):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        Participant.queue_emails_bulk([(larry.id, 'verification', {})] * n)
+
+    def test_claims_dont_overlap(self):
+        self.queue(5)
+        a = EmailWorker(self.db, batch_size=3).claim()
+        b = EmailWorker(self.db, batch_size=3).claim()
+        assert len(a) == 3
+        assert len(b) == 2
+        assert not set(m.id for m in a) & set(m.id for m in b)
+        assert EmailWorker(self.db).claim() == []
+
+    def test_concurrent_claims_get_the_next_free_rows(self):
+        self.queue(5)
+        claimed = {}
+        with self.db.get_cursor() as cursor:
+            claimed['a'] = EmailWorker(self.db, batch_size=3).claim(cursor)
+            t = threading.Thread(target=lambda: claimed.update(b=EmailWorker(self.db).claim()))
+            t.start()
+            t.join(0.5)
+            assert t.is_alive()  # waiting for our claim to commit
+        t.join()
+        assert len(claimed['a']) == 3
+        assert len(claimed['b']) == 2
+        assert not set(m.id for m in claimed['a']) & set(m.id for m in claimed['b'])
+
+    def test_expired_claims_are_claimed_again(self):
+        self.queue(2)
+        EmailWorker(self.db, lease=-1).claim()
+        assert len(EmailWorker(self.db).claim()) == 2
+
+    def test_worker_sends_everything(self):
+        self.queue(7)
+        worker = EmailWorker(self.db, batch_size=3, threads=2, rate=100)
+        worker.run()
+        assert self.mailer.call_count == 7
+        assert worker.sent == 7
+        assert worker.report() == 0
+
+    def test_failed_emails_stay_in_the_queue(self):
+        self.queue(2)
+        self.mailer.side_effect = [None, Exception('oops')]
+        worker = EmailWorker(self.db)
+        worker.run()
+        assert (worker.sent, worker.failed) == (1, 1)
+        assert self.db.one("SELECT count(*) FROM email_queue") == 1
+
+    def test_token_bucket_allows_a_burst_then_spaces_out(self):
+        now = [0.0]
+        bucket = TokenBucket(2, clock=lambda: now[0])
+        with mock.patch('gratipay.utils.email_worker.sleep') as sleep:
+            bucket.take()
+            bucket.take()
+            assert not sleep.called
+            bucket.take()
+            bucket.take()
+        assert [c[0][0] for c in sleep.call_args_list] == [0.5, 1.0]
+
+
+class TestEmailRenderer(EmailHarness):
+
+    def setUp(self):
+        EmailHarness.setUp(self)
+        self.renderer = Participant._email_renderer
+        self.context = { 'exchange': mock.Mock(id=1, amount=D('10.00'), fee=D('0.59'))
+                       , 'nteams': 2
+                       , 'top_team': "Gratipay's team"
+                        }
+
+    def test_render_matches_the_uncached_path(self):
+        for p in make_participants(3):
+            cached = self.renderer.render(p, 'charge_succeeded', dict(self.context))
+            uncached = render_uncached(p, 'charge_succeeded', dict(self.context))
+            assert cached['Message']['Subject']['Data'] == uncached['Subject']
+            assert cached['Message']['Body']['Text']['Data'] == uncached['Text']
+            assert cached['Message']['Body']['Html']['Data'] == uncached['Html']
+
+    def test_layouts_are_cached_per_locale_and_unsubscribe_link(self):
+        self.renderer.layouts.clear()
+        participants = make_participants(4)
+        self.renderer.render_many('charge_succeeded', participants, **self.context)
+        self.renderer.render_many('charge_succeeded', participants, include_unsubscribe=False,
+                                  **self.context)
+        locales = set(self.renderer.get_locale(p.email_lang) for p in participants)
+        assert len(self.renderer.layouts) == len(locales) * 2 * 2  # text and html
+
+    def test_render_many_skips_participants_without_an_address(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        moe = self.make_participant('moe')
+        emails = self.renderer.render_many('verification', [larry, moe])
+        assert emails[0]['Destination']['ToAddresses'] == ['larry <larry@example.com>']
+        assert emails[1] is None
+
+    def test_bench_render(self):
+        report = bench_render(self.renderer, 'charge_succeeded', make_participants(5),
+                              self.context, repeat=1)
+        assert set(report['ms_per_message']) == {'uncached', 'cached'}
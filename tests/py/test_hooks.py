@@ -1,6 +1,8 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from base64 import b64encode
+from gzip import GzipFile
+from io import BytesIO
 
 from aspen.http.request import Request
 from aspen.http.response import Response
@@ -8,6 +10,7 @@ from aspen.http.response import Response
 from gratipay.security import csrf
 from gratipay.security.user import SESSION
 from gratipay.testing import Harness
+from gratipay.utils.http_caching import MANIFEST, Asset, choose_encoding
 
 
 class Tests(Harness):
@@ -101,16 +104,53 @@ class Tests2(Harness):
         r = self.client.GET('/assets/jquery.min.js')
         assert r.headers['Access-Control-Allow-Origin'] == 'https://gratipay.com'
         assert r.headers['Cache-Control'] == 'public, max-age=5'
-        assert 'Vary' not in r.headers
+        assert r.headers['Vary'] == 'Accept-Encoding'
         assert not r.headers.cookie
 
     def test_caching_of_assets_with_etag(self):
         r = self.client.GET(self.client.website.asset('jquery.min.js'))
         assert r.headers['Access-Control-Allow-Origin'] == 'https://gratipay.com'
         assert r.headers['Cache-Control'] == 'public, max-age=31536000'
-        assert 'Vary' not in r.headers
+        assert r.headers['Vary'] == 'Accept-Encoding'
         assert not r.headers.cookie
 
+    def test_assets_are_served_precompressed(self):
+        plain = self.client.GET('/assets/jquery.min.js')
+        r = self.client.GET('/assets/jquery.min.js', HTTP_ACCEPT_ENCODING=b'gzip, deflate')
+        assert r.headers['Content-Encoding'] == 'gzip'
+        assert r.headers['Etag'] == plain.headers['Etag']
+        assert len(r.body) < len(plain.body)
+        assert GzipFile(fileobj=BytesIO(r.body)).read() == plain.body
+        assert 'Content-Encoding' not in plain.headers
+
+    def test_assets_are_served_uncompressed_when_a_variant_is_gone(self):
+        path = self.client.website.www_root + '/assets/jquery.min.js'
+        asset = MANIFEST[path]
+        MANIFEST[path] = Asset(asset.etag, {'gzip': path + '.gone.gz'})
+        try:
+            r = self.client.GET('/assets/jquery.min.js', HTTP_ACCEPT_ENCODING=b'gzip')
+        finally:
+            MANIFEST[path] = asset
+        assert r.code == 200
+        assert 'Content-Encoding' not in r.headers
+
+    def test_compression_can_be_refused(self):
+        r = self.client.GET('/assets/jquery.min.js', HTTP_ACCEPT_ENCODING=b'gzip;q=0')
+        assert 'Content-Encoding' not in r.headers
+
+    def test_images_are_not_compressed(self):
+        r = self.client.GET('/assets/gratipay.opengraph.png', HTTP_ACCEPT_ENCODING=b'gzip')
+        assert 'Content-Encoding' not in r.headers
+        assert 'Vary' not in r.headers
+
+    def test_choose_encoding(self):
+        assert choose_encoding('gzip, deflate', {'gzip': ''}) == 'gzip'
+        assert choose_encoding('*', {'gzip': ''}) == 'gzip'
+        assert choose_encoding('deflate', {'gzip': ''}) is None
+        assert choose_encoding('gzip; q=0', {'gzip': ''}) is None
+        assert choose_encoding('gzip', {}) is None
+        assert choose_encoding(None, {'gzip': ''}) is None
+
     def test_caching_of_simplates(self):
         r = self.client.GET('/about/')
         assert r.headers['Cache-Control'] == 'no-cache'
@@ -0,0 +1,83 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+
+from algorithm import Algorithm
+
+from gratipay.testing import Harness
+from gratipay.utils import profiler
+
+
+class FakeDispatchResult(object):
+    def __init__(self, match):
+        self.match = match
+
+
+class FakeWebsite(object):
+    www_root = '/srv/www'
+
+
+def dispatch(website):
+    return {'dispatch_result': FakeDispatchResult(website.www_root + '/~/%username/index.html.spt')}
+
+def render(dispatch_result, suffix='!'):
+    return {'body': dispatch_result.match + suffix}
+
+def check(exception=None):
+    pass
+
+
+class TestProfiler(object):
+
+    def run_algorithm(self, *functions):
+        website = FakeWebsite()
+        website.algorithm = Algorithm(*functions)
+        profiler.instrument(website)
+        state = website.algorithm.run(website=website)
+        return website, state
+
+    def test_instrument_keeps_the_algorithm_working(self):
+        website, state = self.run_algorithm(dispatch, render, check)
+        assert state['body'].endswith('index.html.spt!')
+        assert website.algorithm.get_names()[1:-1] == ['dispatch', 'render', 'check']
+
+    def test_steps_are_recorded_per_route(self):
+        website, state = self.run_algorithm(dispatch, render, check, check)
+        steps = website.profiler.to_dict()['routes']['/~/%username/index.html.spt']
+        assert sorted(steps) == ['check', 'check#2', 'dispatch', 'render', 'total']
+        assert all(h['n'] == 1 for h in steps.values())
+
+    def test_undispatched_requests_have_a_route_too(self):
+        website, state = self.run_algorithm(check)
+        assert list(website.profiler.to_dict()['routes']) == ['(not dispatched)']
+
+    def test_log_resets_the_profile(self):
+        website, state = self.run_algorithm(dispatch, render)
+        website.profiler.log(reset=True)
+        assert website.profiler.to_dict()['routes'] == {}
+
+
+class TestProfileEndpoint(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.make_participant('admin', is_admin=True)
+        self.make_participant('alice')
+
+    def tearDown(self):
+        self.client.website.profiler = None
+        Harness.tearDown(self)
+
+    def test_profile_is_403_for_non_admin(self):
+        assert self.client.GxT('/dashboard/profile.json', auth_as='alice').code == 403
+
+    def test_profile_is_404_when_profiling_is_off(self):
+        assert self.client.GxT('/dashboard/profile.json', auth_as='admin').code == 404
+
+    def test_profile_shows_percentiles_per_route(self):
+        self.client.website.profiler = profiler.Profiler()
+        self.client.website.profiler.record('/about/index.spt', [('render', 3.0)], 4.0)
+        r = self.client.GET('/dashboard/profile.json', auth_as='admin')
+        routes = json.loads(r.body)['routes']
+        assert routes['/about/index.spt']['render']['p50'] == 3
+        assert routes['/about/index.spt']['total']['n'] == 1
@@ -2,6 +2,8 @@ from __future__ import print_function, unicode_literals
 
 import json
 
+from mock import patch
+
 from aspen.utils import utcnow
 from gratipay.testing import Harness
 from gratipay.models.participant import Participant
@@ -69,3 +71,59 @@ foo({
     "taking": "3.00",
     "username": "picard"
 })''' % dict(user_id=picard.id, elsewhere_id=picard.get_accounts_elsewhere()['github'].id)
+
+    def test_public_json_is_publicly_cacheable(self):
+        self.make_participant('alice', last_bill_result='')
+        response = self.client.GET('/~alice/public.json', auth_as='alice')
+        assert response.headers['Cache-Control'] == 'public, max-age=60'
+        assert response.headers['Etag']
+        assert not response.headers.cookie
+
+    def test_public_json_answers_if_none_match_with_304(self):
+        self.make_participant('alice', last_bill_result='')
+        etag = self.client.GET('/~alice/public.json').headers['Etag']
+        with patch.object(Participant, 'to_dict') as to_dict:
+            response = self.client.GET('/~alice/public.json', HTTP_IF_NONE_MATCH=etag,
+                                       raise_immediately=False)
+        assert response.code == 304
+        assert response.headers['Etag'] == etag
+        assert not to_dict.called
+
+    def test_public_json_etag_changes_with_the_data(self):
+        alice = self.make_participant('alice', last_bill_result='')
+        etag = self.client.GET('/~alice/public.json').headers['Etag']
+        alice.set_payment_instruction(self.make_team(is_approved=True), '1.00')
+        response = self.client.GET('/~alice/public.json', HTTP_IF_NONE_MATCH=etag)
+        assert response.code == 200
+        assert response.headers['Etag'] != etag
+        assert json.loads(response.body)['giving'] == '1.00'
+
+    def test_public_json_bodies_are_cached(self):
+        self.make_participant('alice', last_bill_result='')
+        first = self.client.GET('/~alice/public.json?callback=foo').body
+        with patch.object(Participant, 'to_dict') as to_dict:
+            second = self.client.GET('/~alice/public.json?callback=foo').body
+        assert second == first
+        assert not to_dict.called
+
+    def test_jsonp_and_json_have_different_etags(self):
+        self.make_participant('alice', last_bill_result='')
+        plain = self.client.GET('/~alice/public.json')
+        jsonp = self.client.GET('/~alice/public.json?callback=foo')
+        assert plain.headers['Etag'] != jsonp.headers['Etag']
+        assert jsonp.headers['Content-Type'] == 'application/javascript'
+
+    def test_jsonp_rejects_bad_callbacks(self):
+        self.make_participant('alice', last_bill_result='')
+        response = self.client.GxT('/~alice/public.json?callback=alert(1)')
+        assert response.code == 400
+
+    def test_team_public_json_answers_if_none_match_with_304(self):
+        self.make_team(is_approved=True)
+        response = self.client.GET('/TheEnterprise/public.json')
+        assert json.loads(response.body)['slug'] == 'TheEnterprise'
+        assert response.headers['Cache-Control'] == 'public, max-age=60'
+        response = self.client.GET('/TheEnterprise/public.json',
+                                   HTTP_IF_NONE_MATCH=response.headers['Etag'],
+                                   raise_immediately=False)
+        assert response.code == 304
@@ -0,0 +1,123 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import mock
+import pytest
+
+from gratipay.testing import Foobar, Harness
+from gratipay.utils.query_cache import LRUQueryCache
+
+
+def double(n):
+    return n * 2
+
+def fail(n):
+    raise Foobar
+
+
+class TestLRUQueryCache(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.cache = LRUQueryCache(self.db, max_age=60)
+        self.spawned = []
+        self.cache.spawn = self.spawned.append
+
+    def expire(self):
+        for entry in self.cache.entries.values():
+            entry.timestamp -= 61
+
+    def test_results_are_cached(self):
+        assert self.cache.one("SELECT 1") == 1
+        with mock.patch.object(self.db, 'one') as one:
+            assert self.cache.one("SELECT 1") == 1
+        assert not one.called
+        assert self.cache.stats()['hits'] == 1
+        assert self.cache.stats()['misses'] == 1
+
+    def test_keys_include_the_callback(self):
+        assert self.cache.one("SELECT 21") == 21
+        assert self.cache.one("SELECT 21", process=double) == 42
+        assert self.cache.one("SELECT %s", (1,)) == 1
+        assert self.cache.one("SELECT %s", (2,)) == 2
+        assert self.cache.one("SELECT 1", default=0, back_as=tuple) == 1
+        assert self.cache.stats()['entries'] == 5
+
+    def test_stale_results_are_served_while_one_caller_refreshes(self):
+        self.make_participant('alice', balance=1)
+        sql = "SELECT balance FROM participants"
+        assert self.cache.one(sql) == 1
+        self.db.run("UPDATE participants SET balance = 2")
+        self.expire()
+        assert self.cache.one(sql) == 1
+        assert self.cache.one(sql) == 1
+        assert len(self.spawned) == 1
+        self.spawned[0]()
+        assert self.cache.one(sql) == 2
+        stats = self.cache.stats()
+        assert (stats['stale_hits'], stats['refreshes'], stats['hits']) == (2, 1, 1)
+
+    def test_failed_refreshes_keep_the_stale_result(self):
+        assert self.cache.one("SELECT 1", process=double) == 2
+        self.expire()
+        key = list(self.cache.entries)[0]
+        self.cache._refresh(key, lambda: fail(1))
+        assert self.cache.one("SELECT 1", process=double) == 2
+        assert len(self.spawned) == 1  # tried again
+
+    def test_exceptions_are_not_cached(self):
+        with pytest.raises(Foobar):
+            self.cache.one("SELECT 1", process=fail)
+        assert self.cache.stats()['entries'] == 0
+        assert self.cache.loading == {}
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.max_entries = 2
+        self.cache.one("SELECT 1")
+        self.cache.one("SELECT 2")
+        self.cache.one("SELECT 1")
+        self.cache.one("SELECT 3")
+        assert [key[1] for key in self.cache.entries] == ["SELECT 1", "SELECT 3"]
+        assert self.cache.stats()['evictions'] == 1
+
+    def test_cache_stays_within_its_byte_budget(self):
+        self.cache.all("SELECT generate_series(1, 100)")
+        size = self.cache.nbytes
+        self.cache.max_bytes = size * 3 // 2
+        self.cache.all("SELECT generate_series(101, 200)")
+        assert [key[1] for key in self.cache.entries] == ["SELECT generate_series(101, 200)"]
+        assert self.cache.nbytes == size
+        self.cache.all("SELECT generate_series(1, 1000)")  # too big to cache at all
+        assert len(self.cache.entries) == 1
+
+    def test_invalidate_drops_tagged_entries(self):
+        assert self.cache.one("SELECT 1", tags=[('team', 1)]) == 1
+        assert self.cache.one("SELECT 2", tags=[('team', 2)]) == 2
+        assert self.cache.one("SELECT 3") == 3
+        self.cache.invalidate(('team', 1))
+        assert self.cache.stats()['entries'] == 2
+        assert self.cache.one("SELECT 1", tags=[('team', 1)]) == 1
+        assert self.cache.stats()['misses'] == 4
+
+    def test_refreshes_that_race_with_invalidate_are_discarded(self):
+        self.make_participant('alice', balance=1)
+        sql = "SELECT balance FROM participants"
+        tags = [('participant', 1)]
+        assert self.cache.one(sql, tags=tags) == 1
+        self.expire()
+        assert self.cache.one(sql, tags=tags) == 1
+        self.cache.invalidate(('participant', 1))
+        self.spawned[0]()
+        assert self.cache.stats()['refreshes'] == 1
+        assert self.cache.stats()['entries'] == 0
+        assert self.cache.loads == set()
+
+    def test_invalidate_leaves_unrelated_refreshes_alone(self):
+        self.make_participant('alice', balance=1)
+        sql = "SELECT balance FROM participants"
+        assert self.cache.one(sql) == 1
+        self.db.run("UPDATE participants SET balance = 2")
+        self.expire()
+        assert self.cache.one(sql) == 1
+        self.cache.invalidate(('participant', 1))
+        self.spawned[0]()
+        assert self.cache.one(sql) == 2
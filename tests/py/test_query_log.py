@@ -0,0 +1,91 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+
+from aspen import Response
+
+from gratipay.testing import Harness
+from gratipay.utils import query_log
+
+
+class TestQueryLog(Harness):
+
+    def test_recording_counts_statements(self):
+        with query_log.recording() as log:
+            self.db.run("SELECT 1")
+            self.db.one("SELECT 2", back_as=dict)
+            self.db.all("SELECT 3", back_as=tuple)
+        assert [sql for sql, ms in log.queries] == ["SELECT 1", "SELECT 2", "SELECT 3"]
+        assert log.count == 3
+        assert log.time >= 0
+
+    def test_get_cursor_works_without_arguments(self):
+        with query_log.recording() as log:
+            with self.db.get_cursor() as cursor:
+                assert cursor.one("SELECT 1 AS n").n == 1
+        assert log.count == 1
+
+    def test_recordings_nest(self):
+        with query_log.recording() as outer:
+            self.db.run("SELECT 1")
+            with query_log.recording() as inner:
+                self.db.run("SELECT 2")
+        assert outer.count == 2
+        assert inner.count == 1
+
+    def test_other_threads_are_not_recorded(self):
+        with query_log.recording() as log:
+            t = threading.Thread(target=self.db.run, args=("SELECT 1",))
+            t.start()
+            t.join()
+        assert log.count == 0
+
+    def test_repeated_statements_are_flagged(self):
+        with query_log.recording() as log:
+            for i in range(5):
+                self.db.one("SELECT %s", (i,))
+            self.db.run("SELECT 1")
+        assert log.repeated() == [(5, "SELECT %s")]
+        assert log.repeated(threshold=6) == []
+
+    def test_responses_have_sql_headers(self):
+        self.make_team(is_approved=True)
+        with query_log.recording() as log:
+            response = self.client.GET('/')
+        assert response.headers['X-SQL-Queries'] == str(log.count)
+        assert response.headers['X-SQL-Time'].endswith('ms')
+
+    def test_query_budget_fails_when_exceeded(self):
+        with self.assertRaises(AssertionError):
+            with self.query_budget(1):
+                self.db.run("SELECT 1")
+                self.db.run("SELECT 2")
+
+    def test_query_budget_fails_on_repeated_statements(self):
+        with self.assertRaises(AssertionError):
+            with self.query_budget(10):
+                for i in range(5):
+                    self.db.one("SELECT %s", (i,))
+
+    def test_homepage_queries_dont_grow_with_teams(self):
+        for i in range(6):
+            self.make_team('Team %i' % i, is_approved=True)
+        with self.query_budget(5):
+            self.client.GET('/')
+
+    def test_sql_headers_can_be_sent_for_non_ascii_statements(self):
+        website = self.client.website
+        sql_headers, website.sql_headers = website.sql_headers, True
+        query_log.start()
+        try:
+            for i in range(5):
+                self.db.one("SELECT 'caf\u00e9' || %s, '" + 'x' * 100 + "'", (i,))
+        finally:
+            response = Response(200)
+            query_log.end(website, {}, response)
+            website.sql_headers = sql_headers
+        assert response.headers['X-SQL-Slowest'].endswith("...")
+        assert response.headers['X-SQL-Repeated'].startswith("5x SELECT 'caf?' ||")
+        status = []
+        response({}, lambda *a: status.append(a))
+        assert status[0][0] == '200 OK'
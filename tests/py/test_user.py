@@ -4,8 +4,11 @@ from Cookie import SimpleCookie
 
 from aspen.utils import utcnow
 import gratipay
+from gratipay.models.participant import Participant
+from gratipay.security.session_cache import SessionCache
 from gratipay.security.user import User, SESSION, SESSION_REFRESH
 from gratipay.testing import Harness
+from gratipay.utils import query_log
 
 
 class TestUser(Harness):
@@ -143,3 +146,82 @@ class TestUser(Harness):
         assert not alice.ANON
         alice.sign_out(SimpleCookie())
         assert alice.ANON
+
+
+class TestSessionCache(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.now = 1000
+        self.cache = Participant.session_cache = SessionCache(ttl=10, clock=lambda: self.now)
+        self.make_participant('alice')
+        user = User.from_username('alice')
+        user.sign_in(SimpleCookie())
+        self.token = user.participant.session_token
+
+    def tearDown(self):
+        Participant.session_cache = None
+        Harness.tearDown(self)
+
+    def load(self):
+        return User.from_session_token(self.token).participant
+
+    def test_sessions_are_loaded_from_the_cache(self):
+        assert self.load().username == 'alice'
+        with query_log.recording() as log:
+            assert self.load().username == 'alice'
+        assert log.count == 0
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
+
+    def test_cached_sessions_expire(self):
+        self.load()
+        self.now += 11
+        with query_log.recording() as log:
+            self.load()
+        assert log.count == 1
+
+    def test_cache_is_bounded(self):
+        self.cache.maxsize = 1
+        self.load()
+        self.make_participant('bob')
+        bob = User.from_username('bob')
+        bob.sign_in(SimpleCookie())
+        User.from_session_token(bob.participant.session_token)
+        assert list(self.cache.tokens) == [bob.participant.id]
+
+    def test_signing_out_invalidates_the_cache(self):
+        user = User(self.load())
+        user.sign_out(SimpleCookie())
+        assert User.from_session_token(self.token).ANON
+
+    def test_changes_invalidate_the_cache(self):
+        alice = self.load()
+        alice.change_username('alicia')
+        assert self.load().username == 'alicia'
+
+    def test_closing_invalidates_the_cache(self):
+        self.load().close()
+        assert User.from_session_token(self.token).ANON
+
+    def test_session_extensions_are_batched(self):
+        user = User(self.load())
+        old_expires = user.participant.session_expires
+        user.participant.set_session_expires(old_expires - SESSION_REFRESH)
+        user = User(self.load())
+        cookies = SimpleCookie()
+        with query_log.recording() as log:
+            user.keep_signed_in(cookies)
+        assert log.count == 0
+        assert SESSION in cookies
+        new_expires = self.load().session_expires
+        assert new_expires > old_expires - SESSION_REFRESH
+        assert self.cache.flush(self.db) == 1
+        assert self.db.one("SELECT session_expires FROM participants") == new_expires
+        assert self.cache.flush(self.db) == 0
+
+    def test_flush_doesnt_revive_signed_out_sessions(self):
+        alice = self.load()
+        self.cache.extend(alice.id, utcnow() + SESSION_REFRESH * 10)
+        User(alice).sign_out(SimpleCookie())
+        self.cache.flush(self.db)
+        assert self.db.one("SELECT session_token FROM participants") is None
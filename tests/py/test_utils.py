@@ -1,12 +1,18 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import os
+import shutil
 from datetime import datetime, timedelta
 from decimal import Decimal as D
+from tempfile import mkdtemp
 
 import pytest
 from aspen.http.response import Response
+from babel.messages.pofile import read_po
+from markupsafe import escape as htmlescape
 from gratipay import utils
 from gratipay.testing import Harness
+from gratipay.testing.i18n_benchmark import bench_i18n
 from gratipay.utils import i18n, markdown, pricing, encode_for_querystring, decode_from_querystring
 from gratipay.utils.username import safely_reserve_a_username, FailedToReserveUsername, \
                                                                            RanOutOfUsernameAttempts
@@ -252,3 +258,107 @@ class Tests(Harness):
 
     def test_dfq_returns_default_if_passed_on_error(self):
         assert decode_from_querystring('abcd', default='error') == 'error'
+
+
+class TestLocales(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.dir = mkdtemp()
+        self.po_path = os.path.join(self.dir, 'fr.po')
+        shutil.copy('i18n/core/fr.po', self.po_path)
+        self.errors = []
+        self.locales = i18n.Locales()
+        self.locales.add_loader('fr', i18n.LocaleLoader('fr', self.po_path, self.tell_sentry))
+        self.locales.alias('fr', 'fr_fr')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        Harness.tearDown(self)
+
+    def tell_sentry(self, exception, state):
+        self.errors.append(exception)
+
+    def test_locales_are_loaded_on_first_use(self):
+        assert 'fr' in self.locales
+        assert not dict.__contains__(self.locales, 'fr')
+        fr = self.locales['fr']
+        assert fr.language == 'fr'
+        assert self.locales.get('fr_fr') is fr
+
+    def test_locales_that_fail_to_load_are_none(self):
+        self.locales.add_loader('xx', i18n.LocaleLoader('xx', self.dir + '/xx.po',
+                                                        self.tell_sentry))
+        assert self.locales.get('xx') is None
+        assert self.locales.get('xx') is None
+        assert len(self.errors) == 1
+
+    def test_unknown_locales_are_missing(self):
+        assert 'xx' not in self.locales
+        assert self.locales.get('xx') is None
+        with pytest.raises(KeyError):
+            self.locales['xx']
+
+    def test_catalogs_are_compiled_on_first_load(self):
+        self.locales['fr']
+        assert os.path.exists(os.path.join(self.dir, 'fr.catalog'))
+
+    def test_compiled_catalogs_match_po_files(self):
+        with open(self.po_path) as f:
+            po = read_po(f)
+        i18n.compile_catalog(self.po_path)
+        compiled = i18n.read_catalog(self.po_path)
+        assert isinstance(compiled, i18n.CompiledCatalog)
+        assert compiled.plural_expr == po.plural_expr
+        for message in po:
+            if message.id and not message.context:
+                assert compiled.get(message.id).string == message.string
+
+    def test_stale_compiled_catalogs_are_ignored(self):
+        i18n.compile_catalog(self.po_path)
+        catalog_path = os.path.join(self.dir, 'fr.catalog')
+        with open(catalog_path, 'wb') as f:
+            f.write(b'garbage')
+        assert i18n.read_catalog(self.po_path).get('Save')
+        with open(catalog_path, 'rb') as f:
+            assert f.read() != b'garbage'
+
+
+class TestI18nCaches(Harness):
+
+    def test_negotiate_remembers_headers(self):
+        langs, loc = i18n.negotiate('fr-FR,fr;q=0.8')
+        assert langs == ('fr_fr', 'fr', 'en', 'en_us')
+        assert i18n.negotiate('fr-FR,fr;q=0.8') is i18n.negotiate('fr-FR,fr;q=0.8')
+        assert loc is i18n.match_lang(langs)
+
+    def test_negotiate_forgets_the_least_recently_used_headers(self):
+        for n in range(i18n.NEGOTIATED_MAX + 10):
+            i18n.negotiate('en;q=0.%i' % n)
+        assert len(i18n._negotiated) == i18n.NEGOTIATED_MAX
+        assert 'en;q=0.0' not in i18n._negotiated
+
+    def test_locale_helpers_are_shared(self):
+        a, b = {}, {}
+        i18n.add_helpers_to_context(None, a, i18n.LOCALE_EN)
+        i18n.add_helpers_to_context(None, b, i18n.LOCALE_EN)
+        assert a['format_number'] is b['format_number']
+        assert a['_'] is not b['_']
+
+    def test_cached_templates_are_escaped_per_renderer(self):
+        context = {}
+        i18n.add_helpers_to_context(None, context, i18n.LOCALE_EN)
+        assert context['_']('<b>{0}</b>', '&') == '<b>&</b>'
+        context['escape'] = htmlescape
+        assert context['_']('<b>{0}</b>', '&') == '&lt;b&gt;&amp;&lt;/b&gt;'
+        context['escape'] = lambda s: s.upper()
+        assert context['_']('<b>{0}</b>', 'a') == '<B>a</B>'
+        assert len(i18n.LOCALE_EN.templates) >= 2
+
+    def test_i18n_benchmark(self):
+        report = bench_i18n(self.client.website, '/about/stats', 5, repeat=1)
+        assert report['messages_per_request'] > 0
+        assert set(report['ms_per_request']) == { 'setup_uncached', 'setup_cached'
+                                                , 'messages_uncached', 'messages_cached'
+                                                , 'page'
+                                                 }
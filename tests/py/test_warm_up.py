@@ -0,0 +1,62 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+from tempfile import mkdtemp
+
+from jinja2 import DictLoader, Environment
+
+from gratipay.renderers.bytecode_cache import BytecodeCache
+from gratipay.testing import Harness
+from gratipay.utils.warm_up import warm_up
+
+
+class TestBytecodeCache(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.cache_dir = mkdtemp()
+        self.cache = BytecodeCache(self.cache_dir, '%s.test')
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        Harness.tearDown(self)
+
+    def render(self, source, **context):
+        loader = DictLoader({'foo.spt': source})
+        environment = Environment(loader=loader, bytecode_cache=self.cache)
+        return environment.get_template('foo.spt').render(**context)
+
+    def test_compiled_templates_are_stored(self):
+        assert self.render('Hi {{ name }}', name='Alice') == 'Hi Alice'
+        assert len(os.listdir(self.cache_dir)) == 1
+        assert self.render('Hi {{ name }}', name='Bob') == 'Hi Bob'
+        assert len(os.listdir(self.cache_dir)) == 1
+
+    def test_pages_with_the_same_name_dont_overwrite_each_other(self):
+        assert self.render('Hi {{ name }}', name='Alice') == 'Hi Alice'
+        assert self.render('Bye {{ name }}', name='Alice') == 'Bye Alice'
+        assert len(os.listdir(self.cache_dir)) == 2
+
+    def test_truncated_files_are_recompiled(self):
+        self.render('Hi {{ name }}', name='Alice')
+        path = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        with open(path, 'r+b') as f:
+            f.truncate(20)
+        assert self.render('Hi {{ name }}', name='Bob') == 'Hi Bob'
+        assert os.path.getsize(path) > 20
+
+
+class TestWarmUp(Harness):
+
+    def test_warm_up_loads_everything(self):
+        n, errors = warm_up(self.client.website)
+        assert errors == []
+        assert n > 100
+
+    def test_renderers_use_separate_patterns_in_the_bytecode_cache(self):
+        factories = self.client.website.renderer_factories
+        escaped = factories['jinja2_htmlescaped'].meta.bytecode_cache
+        unescaped = factories['jinja2'].meta.bytecode_cache
+        assert escaped.directory == unescaped.directory
+        assert escaped.pattern != unescaped.pattern